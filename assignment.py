@@ -0,0 +1,145 @@
+"""
+Min-cost assignment of rows (orders) to columns (drivers)
+
+Costs come as a NumPy matrix with np.inf for pairs that must not be
+matched. solve() runs the Hungarian algorithm in its shortest augmenting
+path form (one Dijkstra-like pass over the columns per row, with dual
+potentials keeping reduced costs non-negative), vectorized over columns.
+It matches as many rows as possible first and minimizes the total cost
+among such matchings.
+
+When a deadline is given and passes mid-solve, the rows matched so far
+keep their columns and the rest are matched greedily, so a batch never
+runs much over its latency budget.
+"""
+import time
+
+import numpy as np
+
+
+def greedy(cost, rows=None, taken=None):
+    """
+    Match rows in order, each to its cheapest free column
+
+    `rows` limits and orders the rows to match, and `taken` marks columns
+    already in use. Returns a list of (row, column) pairs.
+    """
+    cost = np.asarray(cost, dtype=np.float64)
+    free = np.ones(cost.shape[1], dtype=bool) if taken is None else ~taken
+    pairs = []
+    for row in range(cost.shape[0]) if rows is None else rows:
+        candidates = np.where(free, cost[row], np.inf)
+        column = int(np.argmin(candidates))
+        if candidates[column] != np.inf:
+            pairs.append((row, column))
+            free[column] = False
+    return pairs
+
+
+def _hungarian(cost, deadline):
+    """
+    Shortest augmenting path assignment of an n x m matrix with n <= m and
+    finite costs; returns (column of each row, or -1 if unmatched, finished)
+    """
+    n, m = cost.shape
+    v = np.zeros(m)
+    row_of = np.full(m, -1, dtype=np.int64)
+    column_of = np.full(n, -1, dtype=np.int64)
+
+    # Row reduction: each row's cheapest column costs zero, and rows whose
+    # cheapest column nobody has claimed yet take it without a search.
+    # Column potentials stay at zero, as unmatched columns require
+    u = cost.min(axis=1)
+    cheapest = cost.argmin(axis=1)
+    for row in range(n):
+        if row_of[cheapest[row]] < 0:
+            row_of[cheapest[row]] = row
+            column_of[row] = cheapest[row]
+
+    finished = True
+    for start in np.nonzero(column_of < 0)[0].tolist():
+        if deadline is not None and time.monotonic() > deadline:
+            finished = False
+            break
+
+        # Dijkstra over columns from the new row, on reduced costs. Columns
+        # still to visit are remaining[:left]; visited ones are swapped out
+        remaining = np.arange(m)
+        left = m
+        shortest = np.full(m, np.inf)
+        path = np.full(m, -1, dtype=np.int64)
+        visited_rows = []
+        row = start
+        distance = 0.0
+        while True:
+            visited_rows.append(row)
+            columns = remaining[:left]
+            reduced = distance + cost[row, columns] - u[row] - v[columns]
+            better = reduced < shortest[columns]
+            improved = columns[better]
+            path[improved] = row
+            shortest[improved] = reduced[better]
+
+            k = int(np.argmin(shortest[columns]))
+            column = int(columns[k])
+            distance = shortest[column]
+            remaining[k], remaining[left - 1] = remaining[left - 1], remaining[k]
+            left -= 1
+            if row_of[column] < 0:
+                break
+            row = int(row_of[column])
+
+        # Move the potentials so reduced costs stay non-negative
+        visited_columns = remaining[left:]
+        u[start] += distance
+        others = np.array(visited_rows[1:], dtype=np.int64)
+        u[others] += distance - shortest[column_of[others]]
+        v[visited_columns] -= distance - shortest[visited_columns]
+
+        # Flip the matching along the path
+        while True:
+            row = int(path[column])
+            row_of[column] = row
+            column_of[row], column = column, column_of[row]
+            if row == start:
+                break
+
+    return column_of, finished
+
+
+def solve(cost, deadline=None):
+    """
+    Min-cost assignment; returns ([(row, column), ...], optimal)
+
+    `optimal` is False when `deadline` (time.monotonic()) passed and the
+    remaining rows were matched greedily instead.
+    """
+    cost = np.asarray(cost, dtype=np.float64)
+    n, m = cost.shape
+    if not n or not m:
+        return [], True
+
+    transposed = n > m
+    if transposed:
+        cost = cost.T
+        n, m = m, n
+
+    # Forbidden pairs cost more than any matching of allowed pairs, so
+    # they are only used when a row has nothing else; those are dropped
+    allowed = np.isfinite(cost)
+    largest = cost[allowed].max() if allowed.any() else 0.0
+    penalty = (largest + 1) * (n + 1)
+    assigned, optimal = _hungarian(np.where(allowed, cost, penalty), deadline)
+
+    if not optimal:
+        taken = np.zeros(m, dtype=bool)
+        taken[assigned[assigned >= 0]] = True
+        for row, column in greedy(cost, np.nonzero(assigned < 0)[0], taken):
+            assigned[row] = column
+
+    pairs = [
+        (column, row) if transposed else (row, column)
+        for row, column in enumerate(assigned.tolist())
+        if column >= 0 and allowed[row, column]
+    ]
+    return pairs, optimal
@@ -0,0 +1,97 @@
+"""
+Contention benchmark for Database.accept_order
+
+Fires many concurrent accepts from different drivers at the same few
+pending orders and checks that every order was won by exactly one driver.
+
+Run from the repository root:
+    python -m benchmarks.accept_contention --orders 20 --drivers 300
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from db import Database
+
+
+async def run(orders_count, drivers_count, attempts_per_driver, pool_size):
+    db_path = os.path.join(tempfile.mkdtemp(), "accept_contention.db")
+    db = Database(db_path, pool_size=pool_size)
+    await db.init()
+
+    # Setup: one passenger per order and a fleet of available drivers
+    order_ids = []
+    for i in range(orders_count):
+        passenger_id = 1_000_000 + i
+        await db.register_user(passenger_id, 'passenger', f"Passenger {i}", "+70000000000")
+        order_ids.append(await db.create_order(passenger_id, "A", "B", "economy", 5.0, 175))
+
+    driver_ids = list(range(1, drivers_count + 1))
+    for driver_id in driver_ids:
+        await db.register_user(driver_id, 'driver', f"Driver {driver_id}", "+70000000000")
+        await db.register_driver(driver_id, "Car", f"A{driver_id:03d}AA")
+
+    # Every driver hammers random orders from the same small set
+    wins = []
+
+    async def driver_loop(driver_id):
+        for _ in range(attempts_per_driver):
+            order_id = random.choice(order_ids)
+            if await db.accept_order(order_id, driver_id):
+                wins.append((order_id, driver_id))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(driver_loop(driver_id) for driver_id in driver_ids))
+    elapsed = time.perf_counter() - started
+
+    # Correctness: one winner per order, and the database agrees with it
+    winners = {}
+    double_wins = 0
+    for order_id, driver_id in wins:
+        if order_id in winners:
+            double_wins += 1
+        winners[order_id] = driver_id
+
+    mismatches = 0
+    for order_id in order_ids:
+        order = await db.get_order(order_id)
+        if order['status'] == 'accepted' and winners.get(order_id) != order['driver_id']:
+            mismatches += 1
+        if order_id in winners:
+            driver = await db.get_driver(winners[order_id])
+            if driver['status'] != 'busy':
+                mismatches += 1
+
+    write_stats = db.write_stats()
+    await db.close()
+
+    total = drivers_count * attempts_per_driver
+    print(f"accept attempts:  {total} ({drivers_count} drivers x {attempts_per_driver}) on {orders_count} orders")
+    print(f"pool size:        {pool_size}")
+    print(f"elapsed:          {elapsed:.3f} s")
+    print(f"throughput:       {total / elapsed:.0f} accepts/s")
+    print(f"commit groups:    {write_stats['commits']} (avg {write_stats['avg_group_size']:.1f} writes, "
+          f"avg {write_stats['avg_commit_time'] * 1000:.2f} ms, max queue depth {write_stats['max_queue_depth']})")
+    print(f"orders won:       {len(winners)} / {orders_count}")
+    print(f"double wins:      {double_wins}")
+    print(f"db mismatches:    {mismatches}")
+    return double_wins == 0 and mismatches == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=20)
+    parser.add_argument("--drivers", type=int, default=300)
+    parser.add_argument("--attempts", type=int, default=2, help="accept attempts per driver")
+    parser.add_argument("--pool-size", type=int, default=4)
+    args = parser.parse_args()
+
+    ok = asyncio.run(run(args.orders, args.drivers, args.attempts, args.pool_size))
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Batch assignment benchmark: min-cost matching vs greedy
+
+Scatters pending orders and free drivers over the city and matches them
+the way a dispatch batch does: a pickup-distance matrix, pairs beyond the
+search radius forbidden, solved by assignment.solve() and, for comparison,
+by greedy first-come matching (each order in turn takes its nearest free
+driver). Reports solve time, matched orders and pickup distance, then
+shows the deadline fallback with a budget the largest batch can't meet.
+
+The solver matches as many orders as the radius allows before minimizing
+distance, so with a tight radius it matches more orders at a higher total;
+a large --radius compares matchings of the same size.
+
+Run from the repository root:
+    python -m benchmarks.batch_assignment --sizes 100 300 1000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from assignment import greedy, solve
+from geomatrix import equirectangular_matrix
+
+# Moscow, roughly inside the outer ring road
+CITY_BOX = ((55.57, 55.91), (37.37, 37.85))
+
+
+def random_points(rng, count):
+    (lat_min, lat_max), (lon_min, lon_max) = CITY_BOX
+    return np.column_stack([rng.uniform(lat_min, lat_max, count), rng.uniform(lon_min, lon_max, count)])
+
+
+def summary(cost, pairs):
+    distances = [cost[row, column] for row, column in pairs]
+    return f"{len(pairs)} matched, {sum(distances):.0f} km total, {np.mean(distances) if distances else 0:.2f} km each"
+
+
+def run(sizes, radius_km, budget, seed):
+    rng = np.random.default_rng(seed)
+    largest = None
+    for size in sizes:
+        orders, drivers = random_points(rng, size), random_points(rng, size)
+        started = time.perf_counter()
+        cost = equirectangular_matrix(orders, drivers)
+        cost[cost > radius_km] = np.inf
+        build_ms = (time.perf_counter() - started) * 1000
+
+        started = time.perf_counter()
+        pairs, _ = solve(cost)
+        solve_ms = (time.perf_counter() - started) * 1000
+
+        started = time.perf_counter()
+        greedy_pairs = greedy(cost)
+        greedy_ms = (time.perf_counter() - started) * 1000
+
+        print(f"{size} orders x {size} drivers (cost matrix {build_ms:.1f} ms)")
+        print(f"  min-cost: {solve_ms:7.1f} ms, {summary(cost, pairs)}")
+        print(f"  greedy:   {greedy_ms:7.1f} ms, {summary(cost, greedy_pairs)}")
+        largest = cost
+
+    started = time.perf_counter()
+    pairs, optimal = solve(largest, time.monotonic() + budget)
+    elapsed = (time.perf_counter() - started) * 1000
+    print(f"\nlargest batch with a {budget * 1000:.0f} ms budget: {elapsed:.1f} ms, "
+          f"{'optimal' if optimal else 'finished greedily'}, {summary(largest, pairs)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs='+', default=[100, 300, 1000])
+    parser.add_argument("--radius", type=float, default=5.0, help="Search radius, km")
+    parser.add_argument("--budget", type=float, default=0.1, help="Seconds for the fallback demonstration")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    run(args.sizes, args.radius, args.budget, args.seed)
+
+
+if __name__ == "__main__":
+    main()
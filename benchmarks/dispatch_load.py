@@ -0,0 +1,131 @@
+"""
+Dispatch benchmark: time to accept under load
+
+Runs the order dispatcher against the in-memory engine with simulated
+drivers scattered over the city. Orders arrive at a steady rate; every
+offered driver answers after a short delay and accepts, declines or
+ignores the offer (which then times out). Accepted rides finish after a
+while and the driver becomes available again. Timeouts are scaled down so
+a run takes seconds. Each fanout in --fanout gets a run offering orders as
+they arrive, then --batch-interval gets a run with batch assignment;
+pickup distance shows what batching buys.
+
+Run from the repository root:
+    python -m benchmarks.dispatch_load --drivers 2000 --rate 100 --duration 10
+"""
+import argparse
+import asyncio
+import random
+
+from dispatch import OrderDispatcher
+from memory_db import MemoryDatabase
+from spatial import distance_km
+
+# Moscow, roughly inside the outer ring road
+CITY_BOX = ((55.57, 55.91), (37.37, 37.85))
+
+
+def random_point(rng):
+    (lat_min, lat_max), (lon_min, lon_max) = CITY_BOX
+    return rng.uniform(lat_min, lat_max), rng.uniform(lon_min, lon_max)
+
+
+async def run(drivers, rate, duration, fanout, batch_interval, timeout, accept, ignore, ride_time, seed):
+    rng = random.Random(seed)
+    db = MemoryDatabase()
+    await db.init()
+    driver_ids = list(range(100_000, 100_000 + drivers))
+    for driver_id in driver_ids:
+        await db.register_user(driver_id, 'driver', f"Driver {driver_id}", "+70000000000")
+        await db.register_driver(driver_id, "Car", f"A{driver_id}AA")
+        await db.update_driver_location(driver_id, *random_point(rng))
+
+    dispatcher = OrderDispatcher(db, timeout=timeout, fanout=fanout, batch_interval=batch_interval)
+    tasks = set()
+    pickup_km = []
+
+    async def ride(order_id, driver_id):
+        await asyncio.sleep(ride_time * rng.uniform(0.5, 1.5))
+        await db.transition_order(order_id, driver_id, 'accepted', 'driver_arrived')
+        await db.transition_order(order_id, driver_id, 'driver_arrived', 'completed')
+
+    async def respond(driver_id, order):
+        await asyncio.sleep(timeout * rng.uniform(0.05, 0.5))
+        answer = rng.random()
+        if answer < ignore:
+            return
+        if answer < ignore + accept:
+            position = db.driver_index.position(driver_id)
+            if await db.accept_order(order['order_id'], driver_id):
+                dispatcher.accepted(order['order_id'], driver_id)
+                pickup_km.append(distance_km(*position, order['pickup_latitude'], order['pickup_longitude']))
+                await ride(order['order_id'], driver_id)
+            return
+        await db.record_decline(order['order_id'], driver_id)
+        dispatcher.declined(order['order_id'], driver_id)
+
+    async def send_offer(driver_id, order):
+        # Drivers answer in their own time, like messages do
+        task = asyncio.create_task(respond(driver_id, order))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    await dispatcher.start(send_offer)
+
+    passenger_id = 0
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    while loop.time() - started < duration:
+        passenger_id += 1
+        await db.register_user(passenger_id, 'passenger', f"Passenger {passenger_id}", "+70000000000")
+        order_id = await db.create_order(
+            passenger_id, "A", "B", 'economy', 5.0, 400, pickup=random_point(rng)
+        )
+        dispatcher.submit(order_id)
+        await asyncio.sleep(rng.expovariate(rate))
+
+    # Let the last orders run their course
+    await asyncio.sleep(timeout * (dispatcher.max_rounds + 1))
+    stats = dispatcher.stats()
+    await dispatcher.close()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    mode = f"batch every {batch_interval} s" if batch_interval else f"fanout {fanout}"
+    print(f"{mode}: {stats['submitted']} orders, {stats['accepted']} accepted, "
+          f"{stats['unassigned']} unassigned, {stats['offers']} offers "
+          f"({stats['declines']} declined, {stats['timeouts']} timed out)")
+    if stats['accepted']:
+        print(f"  time to accept: p50 {stats['accept_time_p50']:.2f} s, p95 {stats['accept_time_p95']:.2f} s "
+              f"(timeout {timeout} s), {stats['offers_per_order']:.2f} offers per accepted order, "
+              f"pickup {sum(pickup_km) / len(pickup_km):.2f} km on average")
+    if stats['batches']:
+        print(f"  {stats['batches']} batches, slowest {stats['batch_time_max'] * 1000:.0f} ms, "
+              f"{stats['batch_fallbacks']} fell back to greedy")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--drivers", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=100, help="Orders per second")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds of incoming orders")
+    parser.add_argument("--fanout", type=int, nargs='+', default=[1, 2, 3])
+    parser.add_argument("--batch-interval", type=float, default=0.5, help="Seconds between batches, 0 to skip")
+    parser.add_argument("--timeout", type=float, default=1.0, help="Acceptance timeout, seconds")
+    parser.add_argument("--accept", type=float, default=0.5, help="Share of offers accepted")
+    parser.add_argument("--ignore", type=float, default=0.2, help="Share of offers left to time out")
+    parser.add_argument("--ride-time", type=float, default=5.0, help="Mean seconds a ride keeps a driver busy")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    runs = [(fanout, 0) for fanout in args.fanout]
+    if args.batch_interval:
+        runs.append((1, args.batch_interval))
+    for fanout, batch_interval in runs:
+        asyncio.run(run(args.drivers, args.rate, args.duration, fanout, batch_interval, args.timeout,
+                        args.accept, args.ignore, args.ride_time, args.seed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Gazetteer benchmark: index build, open and lookup latency
+
+Generates a synthetic city (streets x houses), compiles it into a
+gazetteer index and times opening the index and each kind of lookup:
+exact street and house, street prefix, misspelled street and a house
+number missing from the extract.
+
+Run from the repository root:
+    python -m benchmarks.gazetteer_lookup --streets 5000 --houses 60
+"""
+import argparse
+import csv
+import os
+import random
+import tempfile
+import time
+
+from gazetteer import build, Gazetteer
+
+SYLLABLES = ['ба', 'ве', 'го', 'да', 'ле', 'ми', 'но', 'ро', 'са', 'ти', 'ку', 'ря', 'шо', 'чи', 'зе', 'лу']
+SUFFIXES = ['ская', 'ный', 'ская набережная', 'ский проспект', 'ский переулок']
+
+
+def make_streets(count, rng):
+    """Unique random street names"""
+    names = set()
+    while len(names) < count:
+        stem = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+        names.add(stem + rng.choice(SUFFIXES))
+    return sorted(names)
+
+
+def misspell(word, rng):
+    """Replace one letter after the first"""
+    i = rng.randint(1, len(word) - 1)
+    return word[:i] + rng.choice('абвгдежзиклмнопрст') + word[i + 1:]
+
+
+def timed(lookups, gazetteer):
+    """Mean lookup latency in microseconds and the share of found addresses"""
+    started = time.perf_counter()
+    found = sum(gazetteer.lookup(address) is not None for address in lookups)
+    return (time.perf_counter() - started) / len(lookups) * 1e6, found / len(lookups)
+
+
+def run(streets, houses, lookups, seed):
+    rng = random.Random(seed)
+    directory = tempfile.mkdtemp()
+    csv_path = os.path.join(directory, "addresses.csv")
+    index_path = os.path.join(directory, "gazetteer.idx")
+
+    names = make_streets(streets, rng)
+    with open(csv_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['street', 'house', 'lat', 'lon'])
+        for name in names:
+            lat, lon = 55.55 + rng.random() * 0.4, 37.35 + rng.random() * 0.5
+            # Odd numbers only, so even ones exercise the nearest-house search
+            for house in range(1, 2 * houses, 2):
+                writer.writerow([name, house, f"{lat + house * 1e-5:.6f}", f"{lon:.6f}"])
+
+    started = time.perf_counter()
+    count = build(csv_path, index_path)
+    print(f"built {count} addresses in {time.perf_counter() - started:.2f} s, "
+          f"{os.path.getsize(index_path) / 1e6:.1f} MB index")
+
+    started = time.perf_counter()
+    gazetteer = Gazetteer(index_path)
+    print(f"opened in {(time.perf_counter() - started) * 1000:.2f} ms")
+
+    picks = [(rng.choice(names), rng.randrange(1, 2 * houses, 2)) for _ in range(lookups)]
+    cases = {
+        'exact': [f"ул. {name}, д. {house}" for name, house in picks],
+        'street prefix': [f"{name.split()[0][:-2]} {house}" for name, house in picks],
+        'misspelled street': [f"{misspell(name.split()[0], rng)} {house}" for name, house in picks],
+        'missing house': [f"{name} {house + 1}" for name, house in picks],
+    }
+
+    print(f"\n{'lookup':<20}{'mean, us':>10}{'found':>8}")
+    for name, addresses in cases.items():
+        mean_us, found = timed(addresses, gazetteer)
+        print(f"{name:<20}{mean_us:>10.1f}{found:>8.0%}")
+
+    gazetteer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streets", type=int, default=5000)
+    parser.add_argument("--houses", type=int, default=60, help="Houses per street")
+    parser.add_argument("--lookups", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    run(args.streets, args.houses, args.lookups, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Geocoder benchmark: event loop responsiveness under slow geocoding
+
+Runs a burst of fare quotes against a stand-in geocoder that blocks its
+thread for a fixed delay, like Nominatim on a bad day, while a heartbeat
+coroutine measures how late the event loop wakes it up. Also abandons a
+share of the quotes mid-flight to check that cancellation frees the
+concurrency slots, and can send all quotes to a few popular destinations
+to show identical in-flight lookups being shared.
+
+Run from the repository root:
+    python -m benchmarks.geocoder_latency --quotes 40 --delay 0.3
+"""
+import argparse
+import asyncio
+import random
+import time
+from types import SimpleNamespace
+
+from geo import GeoService, RequestAbandoned
+
+
+class SlowGeocoder:
+    """Blocking geocoder stand-in with a fixed delay per request"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.calls = 0
+
+    def geocode(self, address, timeout=None):
+        self.calls += 1
+        time.sleep(self.delay)
+        return SimpleNamespace(latitude=55.75 + random.uniform(-0.1, 0.1), longitude=37.62 + random.uniform(-0.1, 0.1))
+
+
+async def heartbeat(interval, lags, stop):
+    """Record how late the loop runs a coroutine that sleeps for `interval`"""
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+
+
+async def run(quotes, delay, concurrency, abandon_share, destinations):
+    geocoder = SlowGeocoder(delay)
+    geo_service = GeoService(geocoder=geocoder, concurrency=concurrency, timeout=delay * 10)
+
+    lags, stop = [], asyncio.Event()
+    monitor = asyncio.create_task(heartbeat(0.01, lags, stop))
+
+    async def quote(user_id):
+        destination = f"B {user_id % destinations if destinations else user_id}"
+        try:
+            return await geo_service.run_for_user(user_id, geo_service.calculate_distance(f"A {user_id}", destination))
+        except RequestAbandoned:
+            return None
+
+    started = time.perf_counter()
+    tasks = [asyncio.create_task(quote(user_id)) for user_id in range(quotes)]
+
+    # Some users press "back" while their quote is still queued
+    await asyncio.sleep(delay / 2)
+    abandoned = random.sample(range(quotes), int(quotes * abandon_share))
+    for user_id in abandoned:
+        geo_service.cancel_user_requests(user_id)
+
+    results = await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await monitor
+    await geo_service.close()
+
+    completed = sum(result is not None for result in results)
+    print(f"quotes: {completed} completed, {quotes - completed} abandoned in {elapsed:.2f} s")
+    print(f"geocoder calls: {geocoder.calls}, shared in-flight lookups: {geo_service.shared_lookups}")
+    print(f"event loop lag: max {max(lags) * 1000:.1f} ms, mean {sum(lags) / len(lags) * 1000:.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quotes", type=int, default=40)
+    parser.add_argument("--delay", type=float, default=0.3, help="Seconds each geocoder request blocks")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--abandon", type=float, default=0.25, help="Share of quotes abandoned mid-flight")
+    parser.add_argument("--destinations", type=int, default=0, help="Distinct destinations (0 = one per quote)")
+    args = parser.parse_args()
+
+    asyncio.run(run(args.quotes, args.delay, args.concurrency, args.abandon, args.destinations))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Live location benchmark: per-fix writes vs the coalescing location buffer
+
+Simulates a fleet of drivers sharing live location, each sending a fix
+every few seconds, against a temporary SQLite database. First every fix
+is written as it arrives (concurrently, so the group-commit writer already
+batches what it can), then the same stream goes through LocationBuffer.
+Reports commits per second and how far each path falls behind.
+
+Run from the repository root:
+    python -m benchmarks.location_ingest --drivers 5000 --period 3 --duration 6
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from db import Database
+from locations import LocationBuffer
+
+TICK = 0.1
+
+
+async def setup(drivers):
+    db = Database(os.path.join(tempfile.mkdtemp(), "location_ingest.db"))
+    await db.init()
+    for driver_id in range(drivers):
+        await db.register_user(driver_id, 'driver', f"Driver {driver_id}", "+70000000000")
+        await db.register_driver(driver_id, "Car", f"A{driver_id}AA")
+    return db
+
+
+async def stream(drivers, period, duration, seed, handle):
+    """Feed fixes to `handle` in real time; returns (fixes, seconds spent behind schedule)"""
+    rng = random.Random(seed)
+    positions = {driver_id: (55.6 + rng.random() * 0.3, 37.4 + rng.random() * 0.4) for driver_id in range(drivers)}
+    per_tick = drivers * TICK / period
+    sent, carry = 0, 0.0
+    started = time.perf_counter()
+
+    for tick in range(int(duration / TICK)):
+        carry += per_tick
+        batch = []
+        while carry >= 1:
+            carry -= 1
+            driver_id = rng.randrange(drivers)
+            lat, lon = positions[driver_id]
+            positions[driver_id] = (lat + rng.uniform(-0.0005, 0.0005), lon + rng.uniform(-0.0008, 0.0008))
+            batch.append((driver_id, *positions[driver_id]))
+        await handle(batch)
+        sent += len(batch)
+
+        # Sleep until the next tick, if there is time left
+        delay = started + (tick + 1) * TICK - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    lag = max(0.0, time.perf_counter() - started - duration)
+    return sent, lag
+
+
+async def run(drivers, period, duration, flush_interval, seed):
+    print(f"{drivers} drivers, a fix every {period} s each = {drivers / period:.0f} fixes/s for {duration} s\n")
+
+    # Every fix straight to the database
+    db = await setup(drivers)
+    commits_before = db.write_stats()['commits']
+
+    async def write_each(batch):
+        await asyncio.gather(*(db.update_driver_location(*fix) for fix in batch))
+
+    sent, lag = await stream(drivers, period, duration, seed, write_each)
+    commits = db.write_stats()['commits'] - commits_before
+    await db.close()
+    print(f"per-fix writes: {sent} fixes, {commits} commits ({commits / duration:.0f}/s), {lag:.2f} s behind")
+
+    # Through the buffer
+    db = await setup(drivers)
+    commits_before = db.write_stats()['commits']
+    buffer = LocationBuffer(db, flush_interval=flush_interval)
+    buffer.start()
+
+    async def record(batch):
+        for fix in batch:
+            buffer.record(*fix)
+
+    sent, lag = await stream(drivers, period, duration, seed, record)
+    await buffer.close()
+    commits = db.write_stats()['commits'] - commits_before
+    stats = buffer.stats()
+    await db.close()
+    print(f"location buffer: {sent} fixes, {commits} commits ({commits / duration:.1f}/s), {lag:.2f} s behind, "
+          f"{stats['persisted']} rows persisted in {stats['flushes']} flushes")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--drivers", type=int, default=5000)
+    parser.add_argument("--period", type=float, default=3, help="Seconds between fixes of one driver")
+    parser.add_argument("--duration", type=float, default=6, help="Seconds to stream")
+    parser.add_argument("--flush-interval", type=float, default=2)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    asyncio.run(run(args.drivers, args.period, args.duration, args.flush_interval, args.seed))
+
+
+if __name__ == "__main__":
+    main()
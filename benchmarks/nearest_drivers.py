@@ -0,0 +1,90 @@
+"""
+Nearest-driver benchmark: grid index vs brute force
+
+Scatters drivers over the city, marks a share of them busy, then times
+"k nearest available drivers within R km" queries against the in-memory
+grid index and checks every answer against a brute-force NumPy scan.
+Also times position updates, which is what live locations cost.
+
+Run from the repository root:
+    python -m benchmarks.nearest_drivers --drivers 50000 --queries 2000
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+from geomatrix import equirectangular_matrix, top_k
+from spatial import DriverIndex
+
+# Moscow, roughly inside the outer ring road
+CITY_BOX = ((55.57, 55.91), (37.37, 37.85))
+
+
+def random_point(rng):
+    (lat_min, lat_max), (lon_min, lon_max) = CITY_BOX
+    return rng.uniform(lat_min, lat_max), rng.uniform(lon_min, lon_max)
+
+
+def run(drivers, queries, k, radius_km, busy_share, seed):
+    rng = random.Random(seed)
+    index = DriverIndex()
+
+    positions = [random_point(rng) for _ in range(drivers)]
+    available = [rng.random() >= busy_share for _ in range(drivers)]
+
+    started = time.perf_counter()
+    for driver_id, (lat, lon) in enumerate(positions):
+        index.move(driver_id, lat, lon)
+        index.set_available(driver_id, available[driver_id])
+    print(f"indexed {drivers} drivers ({len(index)} available) in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+    # Drivers moving a few hundred meters, as live locations do
+    started = time.perf_counter()
+    for _ in range(queries):
+        driver_id = rng.randrange(drivers)
+        lat, lon = positions[driver_id]
+        positions[driver_id] = (lat + rng.uniform(-0.003, 0.003), lon + rng.uniform(-0.005, 0.005))
+        index.move(driver_id, *positions[driver_id])
+    print(f"position update: {(time.perf_counter() - started) / queries * 1e6:.1f} us")
+
+    pickups = [random_point(rng) for _ in range(queries)]
+    started = time.perf_counter()
+    answers = [index.nearest(lat, lon, k, radius_km) for lat, lon in pickups]
+    elapsed = time.perf_counter() - started
+    print(f"nearest {k} within {radius_km} km: {elapsed / queries * 1e6:.1f} us per query")
+
+    # Brute force over available drivers with the same distance formula
+    available_ids = np.array([driver_id for driver_id in range(drivers) if available[driver_id]])
+    available_points = np.array([positions[driver_id] for driver_id in available_ids])
+    started = time.perf_counter()
+    indices, _ = top_k(equirectangular_matrix(pickups, available_points), k, radius_km)
+    elapsed = time.perf_counter() - started
+    print(f"brute force (vectorized, all queries at once): {elapsed / queries * 1e6:.1f} us per query")
+
+    mismatches = 0
+    for answer, row in zip(answers, indices):
+        expected = [int(available_ids[i]) for i in row if i >= 0]
+        if [driver_id for driver_id, _ in answer] != expected:
+            mismatches += 1
+    print(f"answers differing from brute force: {mismatches}")
+    return not mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--drivers", type=int, default=50000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--radius", type=float, default=5.0, help="Search radius, km")
+    parser.add_argument("--busy", type=float, default=0.5, help="Share of busy drivers")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    ok = run(args.drivers, args.queries, args.k, args.radius, args.busy, args.seed)
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Order expiry benchmark: tens of thousands of live timers
+
+Fills the in-memory engine with open orders, some pending and some
+accepted by a driver, rebuilds the expiry timers from storage the way a
+restart does, then lets every order run past its deadline. Deadlines are
+scaled down to seconds and staggered over --spread seconds, so orders
+expire at a steady rate. Reports the rebuild time, how late timers fire,
+and the worst event loop stall while the sweeper works: other handlers
+must stay responsive.
+
+Run from the repository root:
+    python -m benchmarks.order_expiry --orders 50000
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from dispatch import OrderDispatcher
+from expiry import OrderExpiry
+from memory_db import MemoryDatabase
+
+
+async def run(orders, accepted, deadline, spread, seed):
+    rng = random.Random(seed)
+    db = MemoryDatabase()
+    await db.init()
+    await db.register_user(1, 'passenger', "Passenger", "+70000000000")
+    driver_id = 100_000
+    for _ in range(orders):
+        order_id = await db.create_order(1, "A", "B", 'economy', 5.0, 400)
+        if rng.random() < accepted:
+            driver_id += 1
+            await db.register_user(driver_id, 'driver', f"Driver {driver_id}", "+70000000000")
+            await db.register_driver(driver_id, "Car", f"A{driver_id}AA")
+            await db.accept_order(order_id, driver_id)
+
+    # Backdate status changes so deadlines fall over the next `spread` seconds;
+    # timestamps have second resolution, so orders expire in bursts
+    now = time.time()
+    for order in db.orders.values():
+        changed_at = now - deadline + rng.uniform(0, spread)
+        order['status_changed_at'] = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(changed_at))
+
+    expired = []
+
+    async def notify(order, status):
+        expired.append(status)
+
+    stall = 0.0
+
+    async def ticker():
+        nonlocal stall
+        loop = asyncio.get_running_loop()
+        while True:
+            before = loop.time()
+            await asyncio.sleep(0.01)
+            stall = max(stall, loop.time() - before - 0.01)
+
+    deadlines = {'pending': deadline, 'accepted': deadline}
+    expiry = OrderExpiry(db, OrderDispatcher(db), deadlines=deadlines, redispatch_after=0)
+    started = time.perf_counter()
+    await expiry.start(notify)
+    rebuild = time.perf_counter() - started
+    print(f"{orders} open orders: timers rebuilt in {rebuild * 1000:.0f} ms "
+          f"({rebuild / orders * 1e6:.1f} us per order), {expiry.stats()['timers']} live")
+
+    ticking = asyncio.create_task(ticker())
+    while len(expired) < orders and time.perf_counter() - started < spread + 30:
+        await asyncio.sleep(0.1)
+    elapsed = time.perf_counter() - started
+    ticking.cancel()
+    stats = expiry.stats()
+    await expiry.close()
+
+    print(f"{len(expired)} expired in {elapsed:.1f} s ({stats['expired']}), {stats['checks']} checks")
+    print(f"  latest timer {stats['lag_max'] * 1000:.1f} ms late, worst event loop stall {stall * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=50_000)
+    parser.add_argument("--accepted", type=float, default=0.3, help="Share of orders accepted by a driver")
+    parser.add_argument("--deadline", type=float, default=5.0, help="Seconds an order may stay in its status")
+    parser.add_argument("--spread", type=float, default=5.0, help="Seconds over which deadlines fall")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    asyncio.run(run(args.orders, args.accepted, args.deadline, args.spread, args.seed))
+
+
+if __name__ == "__main__":
+    main()
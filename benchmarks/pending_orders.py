@@ -0,0 +1,136 @@
+"""
+Pending order listing benchmark: SQL scan vs the in-memory order book
+
+Fills a temporary SQLite database with ride history and a backlog of
+pending orders spread over the city, then times listing pending orders
+the way a driver's "view orders" tap does: the orders JOIN users query
+this used to run, and the order book, unfiltered and filtered by ride
+class and by distance from the driver. Also reports how long rebuilding
+the book takes at startup and what adding and removing an order costs.
+
+Run from the repository root:
+    python -m benchmarks.pending_orders --pending 1000 10000 --history 100000
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from db import Database
+from orderbook import PendingOrderBook
+
+# Moscow, roughly inside the outer ring road
+CITY_BOX = ((55.57, 55.91), (37.37, 37.85))
+
+LEGACY_QUERY = '''
+    SELECT o.*, u.full_name, u.phone, u.rating FROM orders o
+    JOIN users u ON o.passenger_id = u.user_id
+    WHERE o.status = 'pending'
+    ORDER BY o.created_at
+'''
+
+
+def random_point(rng):
+    (lat_min, lat_max), (lon_min, lon_max) = CITY_BOX
+    return rng.uniform(lat_min, lat_max), rng.uniform(lon_min, lon_max)
+
+
+async def fill(db, pending, history, passengers, rng):
+    """Insert users and orders in bulk, bypassing the order book"""
+    def order(status):
+        latitude, longitude = random_point(rng)
+        return (rng.randint(1, passengers), "A", "B", rng.choice(['economy', 'comfort']), 5.0, 400, status,
+                latitude, longitude)
+
+    async def write(conn):
+        await conn.executemany(
+            "INSERT INTO users (user_id, role, full_name, phone) VALUES (?, 'passenger', ?, '+70000000000')",
+            [(user_id, f"Passenger {user_id}") for user_id in range(1, passengers + 1)]
+        )
+        await conn.executemany(
+            '''INSERT INTO orders
+               (passenger_id, from_address, to_address, ride_class, distance, estimated_cost, status,
+                pickup_latitude, pickup_longitude, status_changed_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)''',
+            [order('completed') for _ in range(history)] + [order('pending') for _ in range(pending)]
+        )
+
+    await db.writer.submit(write)
+
+
+async def timed(repeat, make):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = await make()
+    return (time.perf_counter() - started) / repeat * 1000, len(result)
+
+
+async def run(pending, history, passengers, repeat, seed):
+    rng = random.Random(seed)
+    path = os.path.join(tempfile.mkdtemp(), "pending_orders.db")
+    db = Database(path)
+    await db.init()
+    await fill(db, pending, history, passengers, rng)
+    await db.close()
+
+    # Reopen so the book is rebuilt the way it is at startup
+    db = Database(path)
+    started = time.perf_counter()
+    await db.init()
+    startup = (time.perf_counter() - started) * 1000
+
+    async def legacy():
+        async with db.pool.acquire() as conn:
+            async with conn.execute(LEGACY_QUERY) as cursor:
+                return await cursor.fetchall()
+
+    driver = random_point(rng)
+    print(f"{pending} pending orders, {history} in history (startup with book rebuild {startup:.0f} ms)")
+    for name, make in (
+        ("SQL scan", legacy),
+        ("order book", lambda: db.get_pending_orders()),
+        ("book, one ride class", lambda: db.get_pending_orders(ride_class='comfort')),
+        ("book, within 5 km", lambda: db.get_pending_orders(near=driver, radius_km=5)),
+    ):
+        elapsed, count = await timed(repeat, make)
+        print(f"  {name:22} {elapsed:8.2f} ms per listing, {count} orders")
+    await db.close()
+
+    # Book maintenance alone: orders arrive in time order and leave in any order
+    book = PendingOrderBook()
+    passenger = {'full_name': "Passenger", 'phone': "+70000000000", 'rating': 5.0}
+    orders = [
+        {'order_id': order_id, 'created_at': f"2024-01-01 00:00:{order_id:09d}", 'passenger_id': order_id % passengers,
+         'from_address': "A", 'to_address': "B", 'ride_class': 'economy', 'distance': 5.0, 'estimated_cost': 400,
+         'pickup_latitude': None, 'pickup_longitude': None}
+        for order_id in range(pending)
+    ]
+    started = time.perf_counter()
+    for order in orders:
+        book.add(order, passenger)
+    added = (time.perf_counter() - started) / pending * 1e6
+    rng.shuffle(orders)
+    started = time.perf_counter()
+    for order in orders:
+        book.remove(order['order_id'])
+    removed = (time.perf_counter() - started) / pending * 1e6
+    print(f"  book add {added:.1f} us, remove {removed:.1f} us per order")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pending", type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument("--history", type=int, default=100_000, help="Completed orders in the table")
+    parser.add_argument("--passengers", type=int, default=20_000)
+    parser.add_argument("--repeat", type=int, default=20, help="Listings timed per variant")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    for pending in args.pending:
+        asyncio.run(run(pending, args.history, args.passengers, args.repeat, args.seed))
+
+
+if __name__ == "__main__":
+    main()
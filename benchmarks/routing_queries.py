@@ -0,0 +1,176 @@
+"""
+Routing benchmark: queries per second on a city-sized road graph
+
+Generates a synthetic city (a jittered street grid with faster arterials,
+a ring road and a river crossed only by a few bridges), builds it with
+routing.build() and times:
+  - A* with landmark bounds, the query the bot runs on a cache miss
+  - the same search without landmarks (plain Dijkstra), for comparison
+  - routes between points through the route cache, with a skewed mix of
+    hot origin/destination pairs
+Routes are checked against a full Dijkstra from the source, and compared
+with straight-line distance, which is what fares used before.
+
+Run from the repository root:
+    python -m benchmarks.routing_queries --size 300 --queries 300
+"""
+import argparse
+import csv
+import math
+import os
+import random
+import tempfile
+import time
+
+from geomatrix import haversine_matrix
+from routing import Router, build, _dijkstra
+
+CENTER = (55.75, 37.62)
+STEP_KM = 0.12
+KM_PER_DEGREE = 111.195
+
+
+def write_city(directory, size, seed):
+    """Write nodes.csv and edges.csv of a size x size street grid, returning their paths"""
+    rng = random.Random(seed)
+    lat_step = STEP_KM / KM_PER_DEGREE
+    lon_step = STEP_KM / (KM_PER_DEGREE * math.cos(math.radians(CENTER[0])))
+    river = size // 2
+    ring = (size // 6, size - 1 - size // 6)
+
+    def node_id(row, column):
+        return row * size + column
+
+    nodes_path = os.path.join(directory, "nodes.csv")
+    with open(nodes_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['id', 'lat', 'lon'])
+        for row in range(size):
+            for column in range(size):
+                writer.writerow([
+                    node_id(row, column),
+                    CENTER[0] + (row - size / 2 + rng.uniform(-0.3, 0.3)) * lat_step,
+                    CENTER[1] + (column - size / 2 + rng.uniform(-0.3, 0.3)) * lon_step
+                ])
+
+    def speed(line, along_ring):
+        if along_ring:
+            return 80
+        return 50 if line % 20 == 0 else 30
+
+    edges_path = os.path.join(directory, "edges.csv")
+    with open(edges_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['from', 'to', 'speed_kmh', 'oneway'])
+        for row in range(size):
+            for column in range(size):
+                # Eastward: streets along the row
+                if column + 1 < size and rng.random() > 0.03:
+                    on_ring = row in ring and ring[0] <= column < ring[1]
+                    writer.writerow([node_id(row, column), node_id(row, column + 1), speed(row, on_ring),
+                                     int(not on_ring and rng.random() < 0.1)])
+                # Northward: streets along the column, cut by the river except on bridges
+                if row + 1 < size and rng.random() > 0.03:
+                    if row == river and column % 40 != 20:
+                        continue
+                    on_ring = column in ring and ring[0] <= row < ring[1]
+                    writer.writerow([node_id(row, column), node_id(row + 1, column), speed(column, on_ring),
+                                     int(not on_ring and rng.random() < 0.1)])
+
+    return nodes_path, edges_path
+
+
+def time_queries(router, pairs):
+    """Run shortest_path over node pairs; returns (results, queries per second, settled per query)"""
+    settled_before, queries_before = router.settled, router.queries
+    started = time.perf_counter()
+    results = [router.shortest_path(source, target) for source, target in pairs]
+    elapsed = time.perf_counter() - started
+    settled = (router.settled - settled_before) / (router.queries - queries_before)
+    return results, len(pairs) / elapsed, settled
+
+
+def run(size, queries, hot_pairs, requests, seed):
+    rng = random.Random(seed)
+    directory = tempfile.mkdtemp()
+    graph_path = os.path.join(directory, "roads.graph")
+
+    nodes_path, edges_path = write_city(directory, size, seed)
+    started = time.perf_counter()
+    nodes, edges = build(nodes_path, edges_path, graph_path)
+    print(f"graph: {nodes} nodes, {edges} edges, {os.path.getsize(graph_path) / 2 ** 20:.1f} MiB, "
+          f"built in {time.perf_counter() - started:.1f} s")
+
+    started = time.perf_counter()
+    router = Router(graph_path)
+    print(f"opened in {(time.perf_counter() - started) * 1000:.1f} ms\n")
+
+    pairs = [(rng.randrange(nodes), rng.randrange(nodes)) for _ in range(queries)]
+    routes, qps, settled = time_queries(router, pairs)
+    print(f"A* with {router.active_landmarks} of {router.landmarks} landmarks: "
+          f"{qps:.0f} queries/s, {settled:.0f} nodes settled per query")
+
+    plain = Router(graph_path, active_landmarks=0)
+    sample = pairs[:max(1, queries // 10)]
+    _, plain_qps, plain_settled = time_queries(plain, sample)
+    print(f"without landmarks (Dijkstra): {plain_qps:.0f} queries/s, {plain_settled:.0f} nodes settled per query")
+    plain.close()
+
+    # Check a sample against full Dijkstra over the same arrays
+    offsets, targets, times = list(router._offsets), list(router._targets), list(router._times)
+    mismatches = 0
+    for (source, target), route in list(zip(pairs, routes))[:20]:
+        expected = _dijkstra(offsets, targets, times, source)[target]
+        if route is None:
+            mismatches += expected != math.inf
+        elif abs(route[1] * 60 - expected) > 1e-3 * max(1.0, expected):
+            mismatches += 1
+    print(f"routes differing from full Dijkstra (of 20): {mismatches}")
+
+    # Road distance vs straight line, which is what fares were based on
+    coords = router._coords
+    ratios, river_ratios = [], []
+    for (source, target), route in zip(pairs, routes):
+        if route is None or source == target:
+            continue
+        straight = haversine_matrix([coords[source]], [coords[target]])[0, 0]
+        if straight < 1:
+            continue
+        ratios.append(route[0] / straight)
+        if (source // size < size // 2) != (target // size < size // 2):
+            river_ratios.append(route[0] / straight)
+    print(f"route / straight-line distance: {sum(ratios) / len(ratios):.2f} on average, "
+          f"{sum(river_ratios) / max(1, len(river_ratios)):.2f} across the river\n")
+
+    # Points, as the bot sees them, with a few hot pairs taking most requests
+    hot = [(tuple(map(float, coords[rng.randrange(nodes)])), tuple(map(float, coords[rng.randrange(nodes)]))) for _ in range(hot_pairs)]
+    weights = [1 / (rank + 1) for rank in range(hot_pairs)]
+    mix = rng.choices(hot, weights, k=requests)
+    started = time.perf_counter()
+    for from_coords, to_coords in mix:
+        router.route(from_coords, to_coords)
+    elapsed = time.perf_counter() - started
+    cache = router.cache.stats()
+    print(f"route() over {hot_pairs} hot pairs: {requests / elapsed:.0f} requests/s, "
+          f"cache hit rate {cache['hit_rate']:.0%}")
+
+    del coords
+    router.close()
+    return not mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=300, help="Grid side in intersections")
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--hot-pairs", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    ok = run(args.size, args.queries, args.hot_pairs, args.requests, args.seed)
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Storage engine benchmark: SQLite vs in-memory
+
+Replays the same ride workload (order, accept, status buttons, completion,
+ratings, history, earnings) against both engines, reports the latency of
+each operation, and cross-checks that both engines end in the same state.
+
+Run from the repository root:
+    python -m benchmarks.storage_engines --rides 500
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+
+from db import Database
+from memory_db import MemoryDatabase
+
+
+class Timer:
+    """Accumulates wall time per operation name"""
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    async def __call__(self, name, awaitable):
+        started = time.perf_counter()
+        result = await awaitable
+        self.totals[name] += time.perf_counter() - started
+        self.counts[name] += 1
+        return result
+
+    def mean_us(self, name):
+        return self.totals[name] / self.counts[name] * 1e6 if self.counts[name] else 0
+
+
+def random_point(rng):
+    """Random location in the city"""
+    return 55.6 + rng.random() * 0.3, 37.4 + rng.random() * 0.4
+
+
+async def workload(db, rides, passengers, drivers, seed):
+    """Run the ride workload and return (timer, state snapshot)"""
+    rng = random.Random(seed)
+    timer = Timer()
+
+    for user_id in range(1, passengers + 1):
+        await timer('register_user', db.register_user(user_id, 'passenger', f"Passenger {user_id}", "+70000000000"))
+    driver_ids = list(range(10_000, 10_000 + drivers))
+    for driver_id in driver_ids:
+        await timer('register_user', db.register_user(driver_id, 'driver', f"Driver {driver_id}", "+70000000000"))
+        await timer('register_driver', db.register_driver(driver_id, "Car", f"A{driver_id}AA"))
+        await timer('update_driver_location', db.update_driver_location(driver_id, *random_point(rng)))
+
+    for _ in range(rides):
+        passenger_id = rng.randint(1, passengers)
+        driver_id = rng.choice(driver_ids)
+
+        await timer('get_user', db.get_user(passenger_id))
+        if await timer('get_active_order', db.get_active_order(passenger_id)):
+            continue
+        order_id = await timer('create_order', db.create_order(
+            passenger_id, "A", "B", rng.choice(['economy', 'comfort']), 5.0, rng.randint(150, 900)
+        ))
+        await timer('get_pending_orders', db.get_pending_orders())
+        if not await timer('accept_order', db.accept_order(order_id, driver_id)):
+            continue
+
+        if rng.random() < 0.1:
+            await timer('transition_order', db.transition_order(order_id, passenger_id, 'accepted', 'cancelled'))
+            continue
+        await timer('transition_order', db.transition_order(order_id, driver_id, 'accepted', 'driver_started'))
+        await timer('transition_order', db.transition_order(order_id, driver_id, 'driver_started', 'driver_arrived'))
+        await timer('transition_order', db.transition_order(order_id, driver_id, 'driver_arrived', 'completed'))
+        await timer('update_driver_location', db.update_driver_location(driver_id, *random_point(rng)))
+        await timer('add_rating', db.add_rating(order_id, passenger_id, driver_id, rng.randint(1, 5)))
+        await timer('add_rating', db.add_rating(order_id, driver_id, passenger_id, rng.randint(1, 5)))
+        await timer('get_order_history', db.get_order_history(passenger_id, 'passenger'))
+        await timer('get_driver_earnings', db.get_driver_earnings(driver_id, 'week'))
+
+    # Snapshot of everything the bot can observe
+    snapshot = {}
+    for user_id in list(range(1, passengers + 1)) + driver_ids:
+        user = await db.get_user(user_id)
+        history = [order['order_id'] async for order in db.iter_order_history(user_id, 'passenger', batch_size=7)]
+        snapshot[user_id] = (
+            round(user['rating'], 6), user['rating_count'], history,
+            await db.get_completed_orders_count(user_id, 'driver'),
+            await db.get_driver_earnings(user_id)
+        )
+    snapshot['pending'] = [order['order_id'] for order in await db.get_pending_orders()]
+    snapshot['available'] = sorted(driver['user_id'] for driver in await db.get_available_drivers())
+    snapshot['nearest'] = [driver_id for driver_id, _ in db.find_nearest_drivers(55.75, 37.62, k=10, radius_km=50)]
+    return timer, snapshot
+
+
+async def run(rides, passengers, drivers, seed):
+    sqlite_db = Database(os.path.join(tempfile.mkdtemp(), "storage_engines.db"))
+    memory_db = MemoryDatabase()
+
+    results = {}
+    for name, db in (('sqlite', sqlite_db), ('memory', memory_db)):
+        await db.init()
+        started = time.perf_counter()
+        results[name] = await workload(db, rides, passengers, drivers, seed)
+        elapsed = time.perf_counter() - started
+        await db.close()
+        print(f"{name:>7}: {elapsed:.2f} s total")
+
+    cache = sqlite_db.cache_stats()
+    print(f"sqlite profile cache: {cache['hits']} hits, {cache['misses']} misses ({cache['hit_rate']:.0%})")
+
+    sqlite_timer, sqlite_state = results['sqlite']
+    memory_timer, memory_state = results['memory']
+
+    print(f"\n{'operation':<22}{'sqlite, us':>12}{'memory, us':>12}{'ratio':>8}")
+    for name in sqlite_timer.counts:
+        sqlite_us, memory_us = sqlite_timer.mean_us(name), memory_timer.mean_us(name)
+        ratio = sqlite_us / memory_us if memory_us else float('inf')
+        print(f"{name:<22}{sqlite_us:>12.1f}{memory_us:>12.1f}{ratio:>8.0f}")
+
+    mismatches = [key for key in sqlite_state if sqlite_state[key] != memory_state.get(key)]
+    print(f"\nstate mismatches between engines: {len(mismatches)}")
+    for key in mismatches[:5]:
+        print(f"  {key}: sqlite={sqlite_state[key]} memory={memory_state.get(key)}")
+    return not mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rides", type=int, default=500)
+    parser.add_argument("--passengers", type=int, default=100)
+    parser.add_argument("--drivers", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    ok = asyncio.run(run(args.rides, args.passengers, args.drivers, args.seed))
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import time
+from collections import OrderedDict
+
+# Marks a cache miss, so None can be cached as a value
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Size-bounded LRU cache whose entries also expire after a TTL
+
+    Writers call invalidate() after changing the underlying data. A reader
+    takes a token() before its database round trip and passes it to set():
+    if anything was invalidated in between, the possibly stale value is not
+    cached.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value), oldest first
+        self._generation = 0
+
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Get a cached value or MISSING"""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return MISSING
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def token(self):
+        """Get a token to pass to set() after loading a value"""
+        return self._generation
+
+    def set(self, key, value, token=None, ttl=None):
+        """
+        Cache a value, unless something was invalidated since `token` was taken
+
+        The entry expires after `ttl` seconds, the cache's TTL by default.
+        """
+        if token is not None and token != self._generation:
+            return
+
+        self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        """Drop a key after its underlying data changed"""
+        self._generation += 1
+        self.invalidations += 1
+        self._entries.pop(key, None)
+
+    def clear(self):
+        """Drop all entries"""
+        self._generation += 1
+        self._entries.clear()
+
+    def stats(self):
+        """Get hit/miss counters and the current size"""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations
+        }
@@ -5,12 +5,12 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State, default_state
 
 import keyboards as kb
-from db import Database
-from config import MESSAGES
+from db import db
+from geo import geo_service
+from config import MESSAGES, HISTORY_PAGE_SIZE
 
-# Initialize router and database
+# Initialize router
 router = Router()
-db = Database()
 
 # States
 class CommonStates(StatesGroup):
@@ -19,7 +19,8 @@ class CommonStates(StatesGroup):
 @router.message(Command("start"))
 async def cmd_start(message: Message, state: FSMContext):
     """Handler for the /start command"""
-    # Reset any active state
+    # Reset any active state and drop geocoding for an abandoned order
+    geo_service.cancel_user_requests(message.from_user.id)
     await state.clear()
     
     # Check if user is already registered
@@ -78,7 +79,8 @@ async def back_to_menu(callback: CallbackQuery, state: FSMContext):
     """Handler to return to the main menu"""
     await callback.answer()
     
-    # Clear any active state
+    # Clear any active state and drop geocoding for an abandoned order
+    geo_service.cancel_user_requests(callback.from_user.id)
     await state.clear()
     
     # Check user role
@@ -105,6 +107,69 @@ async def show_rating(callback: CallbackQuery):
         reply_markup=kb.get_back_to_menu()
     )
 
+@router.callback_query(F.data.startswith("history_"))
+async def show_history_page(callback: CallbackQuery):
+    """Show next or previous order history page (format: history_role_direction_createdat_orderid)"""
+    await callback.answer()
+    
+    _, role, direction, created_at, order_id = callback.data.split("_")
+    cursor = (created_at, int(order_id))
+    
+    if direction == 'older':
+        await send_order_history(callback.message, callback.from_user.id, role, before=cursor)
+    else:
+        await send_order_history(callback.message, callback.from_user.id, role, after=cursor)
+
+async def send_order_history(message, user_id, role, before=None, after=None):
+    """Send one page of the user's order history with navigation buttons"""
+    # Fetch one extra order to find out whether there is a page beyond this one
+    orders = await db.get_order_history(user_id, role, limit=HISTORY_PAGE_SIZE + 1, before=before, after=after)
+    
+    if after is not None:
+        has_newer = len(orders) > HISTORY_PAGE_SIZE
+        has_older = True
+        orders = orders[-HISTORY_PAGE_SIZE:]
+    else:
+        has_newer = before is not None
+        has_older = len(orders) > HISTORY_PAGE_SIZE
+        orders = orders[:HISTORY_PAGE_SIZE]
+    
+    if not orders:
+        await message.answer(
+            MESSAGES["no_history"],
+            reply_markup=kb.get_back_to_menu()
+        )
+        return
+    
+    # Format and show orders
+    response = "<b>История ваших поездок:</b>\n\n"
+    
+    for i, order in enumerate(orders, 1):
+        status_emoji = {
+            'completed': '✅',
+            'cancelled': '❌',
+            'pending': '⏳',
+            'accepted': '🚗',
+            'in_progress': '🚕'
+        }.get(order['status'], '')
+        
+        response += (
+            f"{i}. {status_emoji} <b>Заказ #{order['order_id']}</b>\n"
+            f"   {order['from_address']} → {order['to_address']}\n"
+            f"   Класс: {'Комфорт' if order['ride_class'] == 'comfort' else 'Эконом'}\n"
+            f"   Стоимость: {order['actual_cost'] or order['estimated_cost']} руб.\n"
+            f"   Дата: {order['created_at'][:10]}\n\n"
+        )
+    
+    newer_cursor = (orders[0]['created_at'], orders[0]['order_id']) if has_newer else None
+    older_cursor = (orders[-1]['created_at'], orders[-1]['order_id']) if has_older else None
+    
+    await message.answer(
+        response,
+        reply_markup=kb.get_history_keyboard(role, newer_cursor, older_cursor),
+        parse_mode="HTML"
+    )
+
 # Helper function to format order for display
 async def format_order_info(order, include_user_info=False):
     """Format order information for display"""
@@ -164,4 +229,13 @@ async def format_order_info(order, include_user_info=False):
         # In a real bot, you would fetch and include user info here
         pass
         
-    return result
\ No newline at end of file
+    return result
+
+
+async def send_order_expired(bot, order, status):
+    """Tell the passenger, and the driver if any, that an order ran out of time, called by the expiry sweeper"""
+    if status == 'pending':
+        await bot.send_message(order['passenger_id'], MESSAGES["order_expired"], reply_markup=kb.get_passenger_menu())
+        return
+    await bot.send_message(order['passenger_id'], MESSAGES["order_stalled"], reply_markup=kb.get_passenger_menu())
+    await bot.send_message(order['driver_id'], MESSAGES["order_stalled_driver"], reply_markup=kb.get_driver_menu())
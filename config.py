@@ -8,7 +8,44 @@ load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 
 # Database settings
+DB_ENGINE = "sqlite"  # "sqlite", or "memory" for load tests and ephemeral bots
 DB_NAME = "fifty_drive.db"
+DB_POOL_SIZE = 4  # Long-lived connections shared by all routers
+DB_BUSY_TIMEOUT = 5000  # Milliseconds to wait for a locked database
+DB_CACHE_SIZE = -16000  # Page cache per connection (negative = KiB)
+DB_MMAP_SIZE = 256 * 1024 * 1024  # Bytes of the database file to memory-map
+DB_STATEMENT_CACHE_SIZE = 128  # Prepared statements cached per connection
+DB_WRITE_BATCH_SIZE = 64  # Max write operations committed together
+DB_WRITE_MAX_LATENCY = 0  # Seconds the writer waits to grow a group (0 = only what is queued)
+PROFILE_CACHE_SIZE = 10000  # Users and drivers kept in the in-process cache
+PROFILE_CACHE_TTL = 300  # Seconds before a cached profile is re-read
+
+# Geocoding settings
+GEOCODER_CONCURRENCY = 4  # Geocoder requests in flight at once
+GEOCODER_TIMEOUT = 5  # Seconds before a geocoder request is abandoned
+GEOCODER_DEADLINE = 8  # Seconds to resolve all addresses of one quote
+GEOCODE_PREFETCH_TTL = 10 * 60  # Seconds a finished prefetch waits for its quote before it is dropped
+GEOCODE_CACHE_DB = "geocode_cache.db"  # Persistent cache of geocoded addresses
+GEOCODE_CACHE_SIZE = 100000  # Addresses kept in the persistent cache
+GEOCODE_CACHE_MEMORY_SIZE = 5000  # Addresses kept in process memory in front of it
+GEOCODE_CACHE_TTL = 30 * 24 * 3600  # Seconds before an address is geocoded again
+GAZETTEER_PATH = "gazetteer.idx"  # Offline address index, built with `python gazetteer.py build`
+GAZETTEER_PRIMARY = False  # Look addresses up offline first, the geocoder is then only the fallback
+ROUTING_GRAPH_PATH = "roads.graph"  # Offline road graph, built with `python routing.py build`
+ROUTING_SNAP_KM = 0.5  # Points farther than this from the road graph use straight-line distance
+ROUTE_CACHE_SIZE = 20000  # Routes between graph nodes kept in memory
+ROUTE_CACHE_TTL = 24 * 3600  # Seconds before a cached route is computed again
+
+# Driver locations
+DRIVER_GRID_CELL_KM = 0.5  # Cell size of the in-memory nearest-driver index
+DRIVER_GRID_LATITUDE = 55.75  # City latitude the index's longitude steps are sized for
+NEAREST_DRIVERS_RADIUS_KM = 5  # Default search radius for nearby drivers
+LOCATION_FLUSH_INTERVAL = 10  # Seconds between batched writes of live driver locations
+LOCATION_HISTORY_SIZE = 8  # Recent location fixes kept in memory per driver
+
+# Travel time model, learned from completed rides per hour of the week
+TRAVEL_SPEED_PRIOR_KMH = 25  # Speed assumed before there is data
+TRAVEL_SPEED_PRIOR_KM = 30  # Kilometers of rides an hour needs before its own average dominates
 
 # Ride classes and pricing
 RIDE_CLASSES = {
@@ -21,9 +58,35 @@ MIN_RATING = 1
 MAX_RATING = 5
 DEFAULT_RATING = 5
 
+# Running rating aggregates keep both a plain and a time-decayed average.
+# The half-life is baked into stored aggregates, so don't change it on a live database.
+RATING_DECAY_HALF_LIFE_DAYS = 90
+RATING_USE_DECAY = False  # Show the decayed average as users.rating
+
+# Orders per order history page
+HISTORY_PAGE_SIZE = 10
+
 # Timeout for order acceptance (seconds)
 ORDER_ACCEPTANCE_TIMEOUT = 60
 
+# Order dispatch
+DISPATCH_FANOUT = 2  # Drivers offered an order at once
+DISPATCH_MAX_ROUNDS = 5  # Offer rounds before an order is left to drivers browsing pending orders
+DISPATCH_BATCH_INTERVAL = 0  # Seconds between batch assignments of waiting orders to drivers (0 = offer on arrival)
+DISPATCH_BATCH_BUDGET = 1.0  # Seconds a batch may spend solving before the rest is matched greedily
+DECLINE_MEMORY_TTL = 30 * 60  # Seconds a declined order is kept away from the driver who declined it
+DECLINE_RATE_PRIOR = 0.2  # Decline rate assumed for drivers without history
+DECLINE_RATE_PRIOR_WEIGHT = 10  # Answered orders a driver needs before their own rate dominates
+
+# Order expiry: seconds an order may stay in a status before it is cancelled.
+# Keep them non-decreasing along the ride, pending -> accepted -> driver_started.
+ORDER_EXPIRY_DEADLINES = {
+    'pending': 20 * 60,
+    'accepted': 30 * 60,
+    'driver_started': 45 * 60
+}
+ORDER_REDISPATCH_AFTER = 6 * 60  # Seconds between offering a still pending order to drivers again (0 = never)
+
 # Message templates
 MESSAGES = {
     "welcome": "Добро пожаловать в Fifty Drive! Выберите роль:",
@@ -37,11 +100,16 @@ MESSAGES = {
     "order_from": "Введите адрес отправления:",
     "order_to": "Введите адрес назначения:",
     "select_class": "Выберите класс поездки:",
+    "address_not_found": "Не удалось найти адрес. Проверьте его и попробуйте снова.",
     "order_confirmation": "Подтвердите заказ:\nОт: {from_address}\nДо: {to_address}\nКласс: {ride_class}\nПримерная стоимость: {estimated_cost} руб.\nПримерное время прибытия: {estimated_arrival} мин.",
     "order_created": "Заказ создан! Ожидайте подтверждения от водителя.",
     "order_accepted": "Водитель принял ваш заказ и скоро прибудет!",
     "order_declined": "Водитель отклонил заказ. Ищем другого водителя...",
     "order_cancelled": "Заказ отменен.",
+    "order_expired": "Не удалось найти водителя, заказ отменен. Попробуйте заказать такси снова.",
+    "order_stalled": "Поездка так и не началась, заказ отменен автоматически.",
+    "order_stalled_driver": "Поездка так и не началась, заказ отменен автоматически. "
+                            "Ваш статус изменен на 'Занят', чтобы снова получать заказы, смените его в меню.",
     "order_completed": "Поездка завершена. Спасибо, что воспользовались Fifty Drive!",
     "driver_started": "Водитель выехал и скоро будет на месте!",
     "driver_arrived": "Водитель прибыл на место посадки!",
@@ -55,5 +123,6 @@ MESSAGES = {
     "status_changed": "Ваш статус изменен на: {status}",
     "new_order": "Новый заказ!\nОт: {from_address}\nДо: {to_address}\nКласс: {ride_class}\nПримерная стоимость: {estimated_cost} руб.\nРасстояние: {distance} км",
     "earnings_today": "Ваш заработок за сегодня: {amount} руб.",
-    "earnings_total": "Ваш общий заработок: {amount} руб."
+    "earnings_total": "Ваш общий заработок: {amount} руб.",
+    "location_received": "Местоположение получено. Транслируйте геопозицию, чтобы пассажиры видели вас рядом."
 }
\ No newline at end of file
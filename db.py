@@ -1,118 +1,365 @@
+import asyncio
+import contextlib
 import aiosqlite
 import datetime
-from config import DB_NAME, DEFAULT_RATING
-
-
-class Database:
-    def __init__(self):
-        self.db_name = DB_NAME
+import time
+from migrations import apply_migrations, backfill_driver_earnings
+from storage import StorageEngine, rating_weight, validate_transition, earnings_period_start
+from memory_db import MemoryDatabase
+from cache import TTLCache, MISSING
+from travel_time import ride_sample, sample_keys
+from config import (
+    DB_NAME, DB_ENGINE, DEFAULT_RATING, DB_POOL_SIZE, DB_BUSY_TIMEOUT,
+    DB_CACHE_SIZE, DB_MMAP_SIZE, DB_STATEMENT_CACHE_SIZE,
+    DB_WRITE_BATCH_SIZE, DB_WRITE_MAX_LATENCY, PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL,
+    RATING_USE_DECAY
+)
+
+async def connect(db_name, isolation_level="IMMEDIATE"):
+    """Open a single connection and apply performance pragmas"""
+    # Implicit transactions start with BEGIN IMMEDIATE so writers take
+    # the lock up front instead of failing on upgrade under WAL
+    conn = await aiosqlite.connect(
+        db_name,
+        isolation_level=isolation_level,
+        cached_statements=DB_STATEMENT_CACHE_SIZE
+    )
+    conn.row_factory = aiosqlite.Row
+
+    await conn.execute("PRAGMA journal_mode = WAL")
+    await conn.execute("PRAGMA synchronous = NORMAL")
+    await conn.execute(f"PRAGMA busy_timeout = {int(DB_BUSY_TIMEOUT)}")
+    await conn.execute(f"PRAGMA cache_size = {int(DB_CACHE_SIZE)}")
+    await conn.execute(f"PRAGMA mmap_size = {int(DB_MMAP_SIZE)}")
+    await conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+
+class ConnectionPool:
+    """Small pool of long-lived aiosqlite connections"""
+
+    def __init__(self, db_name, size=DB_POOL_SIZE):
+        self.db_name = db_name
+        self.size = size
+        self._connections = []
+        self._idle = None
+
+    async def open(self):
+        """Open all connections once; repeated calls are no-ops"""
+        if self._idle is not None:
+            return
+
+        self._idle = asyncio.Queue()
+        for _ in range(self.size):
+            conn = await connect(self.db_name)
+            self._connections.append(conn)
+            self._idle.put_nowait(conn)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        """Borrow a connection, returning it to the pool afterwards"""
+        if self._idle is None:
+            raise RuntimeError("Connection pool is not open, call Database.init() first")
+
+        conn = await self._idle.get()
+        try:
+            yield conn
+        finally:
+            # Never hand out a connection with a half-finished transaction
+            if conn.in_transaction:
+                await conn.rollback()
+            self._idle.put_nowait(conn)
+
+    async def close(self):
+        """Close all connections"""
+        for conn in self._connections:
+            await conn.close()
+        self._connections = []
+        self._idle = None
+
+
+class WriteQueue:
+    """
+    Single writer task that commits queued write operations in small groups
+
+    An operation is an async callable taking the writer connection. Each one
+    runs inside its own SAVEPOINT, so a failing operation is rolled back alone
+    while the rest of its group still commits. Callers await a future that
+    resolves once the group holding their operation is committed.
+    """
+
+    def __init__(self, db_name, batch_size=DB_WRITE_BATCH_SIZE, max_latency=DB_WRITE_MAX_LATENCY):
+        self.db_name = db_name
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.conn = None
+        self._queue = None
+        self._task = None
+        self._closing = False
+
+        # Metrics
+        self.max_queue_depth = 0
+        self.commits = 0
+        self.operations = 0
+        self.failed_operations = 0
+        self.commit_time_total = 0.0
+        self.commit_time_max = 0.0
+        self.commit_time_last = 0.0
+
+    async def open(self):
+        """Open the writer connection and start the writer task"""
+        if self._task is not None:
+            return
+
+        # Autocommit mode: the writer issues BEGIN / SAVEPOINT / COMMIT itself
+        self.conn = await connect(self.db_name, isolation_level=None)
+        self._closing = False
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def submit(self, operation):
+        """Queue a write operation and wait for its committed result"""
+        if self._task is None or self._closing:
+            raise RuntimeError("Write queue is not open, call Database.init() first")
+
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((operation, future))
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+        return await future
+
+    async def _next_batch(self):
+        """Wait for the first operation, then gather more up to the size and latency limits"""
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_latency
+
+        while len(batch) < self.batch_size and batch[-1] is not None:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        """Writer loop, a None item in the queue stops it after the current group"""
+        while True:
+            batch = await self._next_batch()
+            stop = batch[-1] is None
+            operations = [item for item in batch if item is not None]
+            if operations:
+                await self._commit_group(operations)
+            if stop:
+                return
+
+    async def _commit_group(self, operations):
+        """Run a group of operations in one transaction and resolve their futures"""
+        started = time.perf_counter()
+        outcomes = []
+        try:
+            await self.conn.execute("BEGIN IMMEDIATE")
+            for operation, future in operations:
+                if future.cancelled():
+                    continue
+                await self.conn.execute("SAVEPOINT operation")
+                try:
+                    result = await operation(self.conn)
+                except Exception as e:
+                    await self.conn.execute("ROLLBACK TO operation")
+                    await self.conn.execute("RELEASE operation")
+                    outcomes.append((future, None, e))
+                else:
+                    await self.conn.execute("RELEASE operation")
+                    outcomes.append((future, result, None))
+            await self.conn.execute("COMMIT")
+        except Exception as e:
+            # The whole group is lost, e.g. the database stayed locked past busy_timeout
+            if self.conn.in_transaction:
+                await self.conn.execute("ROLLBACK")
+            outcomes = [(future, None, e) for future, _ in operations]
+
+        elapsed = time.perf_counter() - started
+        self.commits += 1
+        self.commit_time_total += elapsed
+        self.commit_time_max = max(self.commit_time_max, elapsed)
+        self.commit_time_last = elapsed
+
+        for future, result, error in outcomes:
+            self.operations += 1
+            if future.done():
+                continue
+            if error is not None:
+                self.failed_operations += 1
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def stats(self):
+        """Get queue depth, group size and commit latency metrics"""
+        return {
+            'queue_depth': self._queue.qsize() if self._queue else 0,
+            'max_queue_depth': self.max_queue_depth,
+            'commits': self.commits,
+            'operations': self.operations,
+            'failed_operations': self.failed_operations,
+            'avg_group_size': self.operations / self.commits if self.commits else 0,
+            'avg_commit_time': self.commit_time_total / self.commits if self.commits else 0,
+            'max_commit_time': self.commit_time_max,
+            'last_commit_time': self.commit_time_last
+        }
+
+    async def close(self):
+        """Commit everything already queued, then stop the writer"""
+        if self._task is not None:
+            self._closing = True
+            self._queue.put_nowait(None)
+            await self._task
+            self._task = None
+        if self.conn is not None:
+            await self.conn.close()
+            self.conn = None
+
+
+class Database(StorageEngine):
+    """SQLite storage engine"""
+
+    def __init__(self, db_name=DB_NAME, pool_size=DB_POOL_SIZE):
+        super().__init__()
+        self.db_name = db_name
+        # Reads go through the pool, all writes through the single writer
+        self.pool = ConnectionPool(db_name, pool_size)
+        self.writer = WriteQueue(db_name)
+        # Users and drivers rarely change, writes below invalidate their entries
+        self.profile_cache = TTLCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
 
     async def init(self):
-        """Initialize database and create tables if they don't exist"""
-        async with aiosqlite.connect(self.db_name) as db:
-            # Users table
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    role TEXT NOT NULL,
-                    full_name TEXT NOT NULL,
-                    phone TEXT NOT NULL,
-                    rating REAL DEFAULT 5.0,
-                    registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-
-            # Drivers table
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS drivers (
-                    user_id INTEGER PRIMARY KEY,
-                    car_model TEXT NOT NULL,
-                    car_number TEXT NOT NULL,
-                    status TEXT DEFAULT 'available',
-                    total_earnings REAL DEFAULT 0,
-                    FOREIGN KEY (user_id) REFERENCES users (user_id)
-                )
-            ''')
-
-            # Orders table
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS orders (
-                    order_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    passenger_id INTEGER NOT NULL,
-                    driver_id INTEGER,
-                    from_address TEXT NOT NULL,
-                    to_address TEXT NOT NULL,
-                    ride_class TEXT NOT NULL,
-                    distance REAL,
-                    estimated_cost REAL,
-                    actual_cost REAL,
-                    status TEXT DEFAULT 'pending',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    started_at TIMESTAMP,
-                    completed_at TIMESTAMP,
-                    passenger_rating INTEGER,
-                    driver_rating INTEGER,
-                    FOREIGN KEY (passenger_id) REFERENCES users (user_id),
-                    FOREIGN KEY (driver_id) REFERENCES users (user_id)
-                )
-            ''')
-
-            # Ratings table
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS ratings (
-                    rating_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    order_id INTEGER NOT NULL,
-                    from_user_id INTEGER NOT NULL,
-                    to_user_id INTEGER NOT NULL,
-                    rating INTEGER NOT NULL,
-                    comment TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (order_id) REFERENCES orders (order_id),
-                    FOREIGN KEY (from_user_id) REFERENCES users (user_id),
-                    FOREIGN KEY (to_user_id) REFERENCES users (user_id)
-                )
-            ''')
-
-            await db.commit()
+        """Open the connection pool, bring the schema up to date and start the writer"""
+        await self.pool.open()
+
+        async with self.pool.acquire() as conn:
+            await apply_migrations(conn)
+            await self._load_driver_index(conn)
+            await self._load_speed_model(conn)
+            await self._load_declines(conn)
+            await self._load_order_book(conn)
+
+        await self.writer.open()
+
+    async def _load_driver_index(self, conn):
+        """Rebuild the in-memory driver index from stored locations and statuses"""
+        self.driver_index.clear()
+        async with conn.execute("SELECT user_id, status, latitude, longitude FROM drivers") as cursor:
+            async for row in cursor:
+                if row['latitude'] is not None:
+                    self.driver_index.move(row['user_id'], row['latitude'], row['longitude'])
+                self.driver_index.set_available(row['user_id'], row['status'] == 'available')
+
+    async def close(self):
+        """Flush pending writes and close all connections"""
+        await self.writer.close()
+        await self.pool.close()
+
+    async def _load_speed_model(self, conn):
+        """Load the travel speed statistics, a few hundred rows at most"""
+        self.speed_model.clear()
+        async with conn.execute("SELECT hour_of_week, zone, distance_km, hours, rides FROM travel_speed_stats") as cursor:
+            async for row in cursor:
+                self.speed_model.load(*row)
+
+    async def _load_order_book(self, conn):
+        """Rebuild the pending order book from pending orders and their passengers"""
+        self.order_book.clear()
+        async with conn.execute('''
+            SELECT o.*, u.full_name, u.phone, u.rating FROM orders o
+            JOIN users u ON o.passenger_id = u.user_id
+            WHERE o.status = 'pending'
+        ''') as cursor:
+            async for row in cursor:
+                self.order_book.add(row, row)
+
+    async def _load_declines(self, conn):
+        """Load per-driver decline counters and unexpired declines of pending orders"""
+        self.declines.clear()
+        async with conn.execute('''
+            SELECT driver_id, SUM(declines) AS declines, SUM(accepts) AS accepts FROM (
+                SELECT driver_id, COUNT(*) AS declines, 0 AS accepts FROM order_declines GROUP BY driver_id
+                UNION ALL
+                SELECT driver_id, 0, COUNT(*) FROM orders WHERE driver_id IS NOT NULL GROUP BY driver_id
+            ) GROUP BY driver_id
+        ''') as cursor:
+            async for row in cursor:
+                self.declines.load_counts(row['driver_id'], row['declines'], row['accepts'])
+
+        # Oldest first, so the expiry queue is filled in order
+        async with conn.execute('''
+            SELECT d.order_id, d.driver_id, (julianday('now') - julianday(d.declined_at)) * 86400 AS age
+            FROM order_declines d JOIN orders o ON o.order_id = d.order_id
+            WHERE o.status = 'pending' AND d.declined_at > datetime('now', ?)
+            ORDER BY d.declined_at
+        ''', (f"-{int(self.declines.ttl)} seconds",)) as cursor:
+            async for row in cursor:
+                self.declines.remember(row['order_id'], row['driver_id'], row['age'])
 
     # User management
     async def register_user(self, user_id, role, full_name, phone):
         """Register a new user"""
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute(
-                "INSERT OR REPLACE INTO users (user_id, role, full_name, phone) VALUES (?, ?, ?, ?)",
+        async def write(conn):
+            async with conn.execute(
+                "INSERT OR REPLACE INTO users (user_id, role, full_name, phone) VALUES (?, ?, ?, ?) RETURNING rating",
                 (user_id, role, full_name, phone)
-            )
-            await db.commit()
+            ) as cursor:
+                return await cursor.fetchone()
+
+        user = await self.writer.submit(write)
+        self.profile_cache.invalidate(('user', user_id))
+        self.order_book.update_passenger(user_id, full_name, phone, user['rating'])
 
     async def register_driver(self, user_id, car_model, car_number):
         """Register driver details"""
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute(
+        async def write(conn):
+            await conn.execute(
                 "INSERT OR REPLACE INTO drivers (user_id, car_model, car_number) VALUES (?, ?, ?)",
                 (user_id, car_model, car_number)
             )
-            await db.commit()
+
+        await self.writer.submit(write)
+        self.profile_cache.invalidate(('driver', user_id))
+        # The replaced row starts available, without a location
+        self.driver_index.remove(user_id)
+        self.driver_index.set_available(user_id, True)
 
     async def get_user(self, user_id):
-        """Get user data by ID"""
-        async with aiosqlite.connect(self.db_name) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cursor:
-                return await cursor.fetchone()
+        """Get user data by ID, served from the profile cache when fresh"""
+        return await self._get_profile('user', "SELECT * FROM users WHERE user_id = ?", user_id)
 
     async def get_driver(self, user_id):
-        """Get driver data by ID"""
-        async with aiosqlite.connect(self.db_name) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute("SELECT * FROM drivers WHERE user_id = ?", (user_id,)) as cursor:
-                return await cursor.fetchone()
+        """Get driver data by ID, served from the profile cache when fresh"""
+        return await self._get_profile('driver', "SELECT * FROM drivers WHERE user_id = ?", user_id)
+
+    async def _get_profile(self, kind, query, user_id):
+        """Read-through lookup in the profile cache"""
+        key = (kind, user_id)
+        profile = self.profile_cache.get(key)
+        if profile is not MISSING:
+            return profile
+
+        token = self.profile_cache.token()
+        async with self.pool.acquire() as conn:
+            async with conn.execute(query, (user_id,)) as cursor:
+                profile = await cursor.fetchone()
+
+        self.profile_cache.set(key, profile, token)
+        return profile
 
     async def get_available_drivers(self):
         """Get all available drivers"""
-        async with aiosqlite.connect(self.db_name) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute('''
+        async with self.pool.acquire() as conn:
+            async with conn.execute('''
                 SELECT u.*, d.* FROM users u
                 JOIN drivers d ON u.user_id = d.user_id
                 WHERE d.status = 'available'
@@ -121,217 +368,436 @@ class Database:
 
     async def update_driver_status(self, user_id, status):
         """Update driver status"""
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute(
+        async def write(conn):
+            await conn.execute(
                 "UPDATE drivers SET status = ? WHERE user_id = ?",
                 (status, user_id)
             )
-            await db.commit()
+
+        await self.writer.submit(write)
+        self.profile_cache.invalidate(('driver', user_id))
+        self.driver_index.set_available(user_id, status == 'available')
+
+    async def update_driver_locations(self, locations):
+        """Store current locations of many drivers in one write"""
+        locations = list(locations)
+
+        async def write(conn):
+            await conn.executemany(
+                "UPDATE drivers SET latitude = ?, longitude = ?, location_updated_at = CURRENT_TIMESTAMP WHERE user_id = ?",
+                [(latitude, longitude, user_id) for user_id, latitude, longitude in locations]
+            )
+
+        await self.writer.submit(write)
+        for user_id, latitude, longitude in locations:
+            self.profile_cache.invalidate(('driver', user_id))
+            self.driver_index.move(user_id, latitude, longitude)
 
     async def update_user_rating(self, user_id, new_rating):
         """Update user rating"""
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute(
-                "UPDATE users SET rating = ? WHERE user_id = ?",
+        async def write(conn):
+            async with conn.execute(
+                "UPDATE users SET rating = ? WHERE user_id = ? RETURNING full_name, phone",
                 (new_rating, user_id)
-            )
-            await db.commit()
+            ) as cursor:
+                return await cursor.fetchone()
+
+        user = await self.writer.submit(write)
+        self.profile_cache.invalidate(('user', user_id))
+        if user:
+            self.order_book.update_passenger(user_id, user['full_name'], user['phone'], new_rating)
 
     # Order management
-    async def create_order(self, passenger_id, from_address, to_address, ride_class, distance, estimated_cost):
-        """Create a new order"""
-        async with aiosqlite.connect(self.db_name) as db:
-            cursor = await db.execute(
-                '''INSERT INTO orders 
-                   (passenger_id, from_address, to_address, ride_class, distance, estimated_cost, status) 
-                   VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                (passenger_id, from_address, to_address, ride_class, distance, estimated_cost, 'pending')
-            )
-            order_id = cursor.lastrowid
-            await db.commit()
-            return order_id
+    async def create_order(self, passenger_id, from_address, to_address, ride_class, distance, estimated_cost,
+                           pickup=None):
+        """Create a new order and add it to the pending order book"""
+        pickup_latitude, pickup_longitude = pickup or (None, None)
+        passenger = await self.get_user(passenger_id)
+
+        async def write(conn):
+            async with conn.execute(
+                '''INSERT INTO orders
+                   (passenger_id, from_address, to_address, ride_class, distance, estimated_cost, status,
+                    pickup_latitude, pickup_longitude, status_changed_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                   RETURNING *''',
+                (passenger_id, from_address, to_address, ride_class, distance, estimated_cost, 'pending',
+                 pickup_latitude, pickup_longitude)
+            ) as cursor:
+                return await cursor.fetchone()
+
+        order = await self.writer.submit(write)
+        # Listing pending orders joins passengers, one without a profile isn't listed
+        if passenger:
+            self.order_book.add(order, passenger)
+        return order['order_id']
 
     async def get_order(self, order_id):
         """Get order by ID"""
-        async with aiosqlite.connect(self.db_name) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute("SELECT * FROM orders WHERE order_id = ?", (order_id,)) as cursor:
+        async with self.pool.acquire() as conn:
+            async with conn.execute("SELECT * FROM orders WHERE order_id = ?", (order_id,)) as cursor:
                 return await cursor.fetchone()
 
     async def get_active_order(self, user_id, role='passenger'):
         """Get active order for a user"""
         field = 'passenger_id' if role == 'passenger' else 'driver_id'
-        async with aiosqlite.connect(self.db_name) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.acquire() as conn:
             query = f"SELECT * FROM orders WHERE {field} = ? AND status != 'completed' AND status != 'cancelled' ORDER BY created_at DESC LIMIT 1"
-            async with db.execute(query, (user_id,)) as cursor:
+            async with conn.execute(query, (user_id,)) as cursor:
                 return await cursor.fetchone()
 
-    async def get_pending_orders(self):
-        """Get all pending orders"""
-        async with aiosqlite.connect(self.db_name) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute('''
-                SELECT o.*, u.full_name, u.phone, u.rating FROM orders o
-                JOIN users u ON o.passenger_id = u.user_id
-                WHERE o.status = 'pending'
-                ORDER BY o.created_at
-            ''') as cursor:
+    async def get_open_orders(self):
+        """Get all orders that are not completed or cancelled"""
+        async with self.pool.acquire() as conn:
+            async with conn.execute(
+                "SELECT * FROM orders WHERE status != 'completed' AND status != 'cancelled'"
+            ) as cursor:
                 return await cursor.fetchall()
 
+    async def record_decline(self, order_id, driver_id):
+        """
+        Record a driver's decline of a pending order
+
+        Declines are kept in order_declines for audit; the in-memory decline
+        memory is what keeps the order away from the driver. A repeated
+        decline of the same order counts once.
+        """
+        async def write(conn):
+            async with conn.execute(
+                "INSERT OR IGNORE INTO order_declines (order_id, driver_id) VALUES (?, ?)",
+                (order_id, driver_id)
+            ) as cursor:
+                return cursor.rowcount > 0
+
+        if await self.writer.submit(write):
+            self.declines.record(order_id, driver_id)
+
     async def accept_order(self, order_id, driver_id):
-        """Driver accepts an order"""
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute(
-                "UPDATE orders SET driver_id = ?, status = 'accepted' WHERE order_id = ? AND status = 'pending'",
+        """
+        Driver accepts an order, atomically
+
+        The conditional UPDATE is the compare-and-swap: only one driver can
+        move the order out of 'pending'. Returns the accepted order, or None
+        if the order was taken, cancelled or doesn't exist.
+        """
+        async def write(conn):
+            async with conn.execute(
+                '''
+                UPDATE orders SET driver_id = ?, status = 'accepted', status_changed_at = CURRENT_TIMESTAMP
+                WHERE order_id = ? AND status = 'pending'
+                RETURNING *
+                ''',
                 (driver_id, order_id)
-            )
-            await db.commit()
-            # Update driver status
-            await db.execute(
-                "UPDATE drivers SET status = 'busy' WHERE user_id = ?",
-                (driver_id,)
-            )
-            await db.commit()
-
-    async def start_ride(self, order_id):
-        """Start a ride"""
-        now = datetime.datetime.now().isoformat()
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute(
-                "UPDATE orders SET status = 'in_progress', started_at = ? WHERE order_id = ?",
-                (now, order_id)
-            )
-            await db.commit()
-
-    async def complete_order(self, order_id, actual_cost=None):
-        """Complete an order"""
-        now = datetime.datetime.now().isoformat()
-        async with aiosqlite.connect(self.db_name) as db:
-            # Get order details
-            db.row_factory = aiosqlite.Row
-            async with db.execute("SELECT * FROM orders WHERE order_id = ?", (order_id,)) as cursor:
+            ) as cursor:
                 order = await cursor.fetchone()
 
             if not order:
-                return False
-
-            # Use estimated cost if actual cost is not provided
-            if actual_cost is None:
-                actual_cost = order['estimated_cost']
-
-            # Update order
-            await db.execute(
-                "UPDATE orders SET status = 'completed', completed_at = ?, actual_cost = ? WHERE order_id = ?",
-                (now, actual_cost, order_id)
-            )
+                return None
 
-            # Update driver status and earnings
-            await db.execute(
-                "UPDATE drivers SET status = 'available', total_earnings = total_earnings + ? WHERE user_id = ?",
-                (actual_cost, order['driver_id'])
+            # Update driver status in the same transaction
+            await conn.execute(
+                "UPDATE drivers SET status = 'busy' WHERE user_id = ?",
+                (driver_id,)
             )
-
-            await db.commit()
-            return True
-
-    async def cancel_order(self, order_id, driver_id=None):
-        """Cancel an order"""
-        async with aiosqlite.connect(self.db_name) as db:
-            # Get order details
-            db.row_factory = aiosqlite.Row
-            async with db.execute("SELECT * FROM orders WHERE order_id = ?", (order_id,)) as cursor:
+            return order
+
+        order = await self.writer.submit(write)
+        if order:
+            self.profile_cache.invalidate(('driver', driver_id))
+            self.driver_index.set_available(driver_id, False)
+            self.declines.forget_order(order_id)
+            self.declines.record_accept(driver_id)
+            self.order_book.remove(order_id)
+        return order
+
+    async def transition_order(self, order_id, actor_id, from_states, to_state, actual_cost=None,
+                               driver_status='available'):
+        """
+        Move an order from one of `from_states` to `to_state` in one statement
+
+        The status check and the update are a single conditional UPDATE, so
+        invalid or concurrent transitions are rejected atomically. `actor_id`
+        must be the order's passenger or driver (None skips the check for
+        system actions). A cancellation puts the order's driver, if any,
+        into `driver_status`. Returns the updated order, or None if rejected.
+        """
+        from_states = validate_transition(from_states, to_state)
+
+        params = {'order_id': order_id, 'actor_id': actor_id, 'to_state': to_state}
+        assignments = ["status = :to_state", "status_changed_at = CURRENT_TIMESTAMP"]
+        if to_state == 'in_progress':
+            assignments.append("started_at = :now")
+        elif to_state == 'completed':
+            # Use estimated cost if actual cost is not provided
+            assignments.append("completed_at = :now")
+            assignments.append("actual_cost = COALESCE(:actual_cost, estimated_cost)")
+        params['now'] = datetime.datetime.now().isoformat()
+        params['actual_cost'] = actual_cost
+
+        placeholders = ", ".join(f":from_{i}" for i in range(len(from_states)))
+        params.update({f"from_{i}": state for i, state in enumerate(from_states)})
+
+        query = f"""
+            UPDATE orders SET {", ".join(assignments)}
+            WHERE order_id = :order_id
+              AND status IN ({placeholders})
+              AND (:actor_id IS NULL OR :actor_id IN (passenger_id, driver_id))
+            RETURNING *
+        """
+
+        async def write(conn):
+            async with conn.execute(query, params) as cursor:
                 order = await cursor.fetchone()
 
             if not order:
-                return False
-
-            # Update order
-            await db.execute(
-                "UPDATE orders SET status = 'cancelled' WHERE order_id = ?",
-                (order_id,)
-            )
+                return None
 
-            # Update driver status if driver_id is provided or order has a driver
-            if driver_id or order['driver_id']:
-                driver_to_update = driver_id if driver_id else order['driver_id']
-                await db.execute(
-                    "UPDATE drivers SET status = 'available' WHERE user_id = ?",
-                    (driver_to_update,)
+            # Release the driver in the same transaction
+            if to_state == 'completed':
+                await conn.execute(
+                    "UPDATE drivers SET status = 'available', total_earnings = total_earnings + ? WHERE user_id = ?",
+                    (order['actual_cost'], order['driver_id'])
+                )
+                await conn.execute(
+                    '''
+                    INSERT INTO driver_daily_earnings (driver_id, day, amount, rides) VALUES (?, ?, ?, 1)
+                    ON CONFLICT (driver_id, day) DO UPDATE SET
+                        amount = amount + excluded.amount,
+                        rides = rides + 1
+                    ''',
+                    (order['driver_id'], order['completed_at'][:10], order['actual_cost'])
                 )
 
-            await db.commit()
-            return True
+                # Learn the ride's speed, if it was started and timed properly
+                sample = ride_sample(order)
+                if sample is not None:
+                    hour, zone, distance, hours = sample
+                    await conn.executemany(
+                        '''
+                        INSERT INTO travel_speed_stats (hour_of_week, zone, distance_km, hours, rides) VALUES (?, ?, ?, ?, 1)
+                        ON CONFLICT (hour_of_week, zone) DO UPDATE SET
+                            distance_km = distance_km + excluded.distance_km,
+                            hours = hours + excluded.hours,
+                            rides = rides + 1
+                        ''',
+                        [(*key, distance, hours) for key in sample_keys(hour, zone)]
+                    )
+            elif to_state == 'cancelled' and order['driver_id']:
+                await conn.execute(
+                    "UPDATE drivers SET status = ? WHERE user_id = ?",
+                    (driver_status, order['driver_id'])
+                )
 
-    async def get_order_history(self, user_id, role='passenger', limit=10):
-        """Get order history for a user"""
+            return order
+
+        order = await self.writer.submit(write)
+        # Completion and cancellation changed the driver's status or earnings
+        if order and order['driver_id'] and to_state in ('completed', 'cancelled'):
+            self.profile_cache.invalidate(('driver', order['driver_id']))
+            released = to_state == 'completed' or driver_status == 'available'
+            self.driver_index.set_available(order['driver_id'], released)
+        if order and to_state == 'cancelled':
+            self.declines.forget_order(order_id)
+            self.order_book.remove(order_id)
+        if order and to_state == 'completed':
+            sample = ride_sample(order)
+            if sample is not None:
+                self.speed_model.add(*sample)
+        return order
+
+    async def get_order_history(self, user_id, role='passenger', limit=10, before=None, after=None):
+        """
+        Get a page of order history for a user, newest first
+
+        Pages are keyset-based: `before` / `after` are (created_at, order_id)
+        cursors taken from the last / first row of the neighbouring page.
+        """
         field = 'passenger_id' if role == 'passenger' else 'driver_id'
-        async with aiosqlite.connect(self.db_name) as db:
-            db.row_factory = aiosqlite.Row
-            query = f"SELECT * FROM orders WHERE {field} = ? ORDER BY created_at DESC LIMIT ?"
-            async with db.execute(query, (user_id, limit)) as cursor:
-                return await cursor.fetchall()
+        params = [user_id]
+
+        if after is not None:
+            # Newer page: walk the index upwards, then restore newest-first order
+            query = f"""
+                SELECT * FROM orders WHERE {field} = ? AND (created_at, order_id) > (?, ?)
+                ORDER BY created_at, order_id LIMIT ?
+            """
+            params.extend(after)
+        elif before is not None:
+            query = f"""
+                SELECT * FROM orders WHERE {field} = ? AND (created_at, order_id) < (?, ?)
+                ORDER BY created_at DESC, order_id DESC LIMIT ?
+            """
+            params.extend(before)
+        else:
+            query = f"SELECT * FROM orders WHERE {field} = ? ORDER BY created_at DESC, order_id DESC LIMIT ?"
+        params.append(limit)
+
+        async with self.pool.acquire() as conn:
+            async with conn.execute(query, params) as cursor:
+                orders = await cursor.fetchall()
+
+        return orders[::-1] if after is not None else orders
 
     # Rating management
     async def add_rating(self, order_id, from_user_id, to_user_id, rating, comment=None):
-        """Add a rating for a user"""
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute(
+        """Add a rating for a user and update their running averages"""
+        weight = rating_weight()
+        # users.rating shows either the plain or the time-decayed running average
+        if RATING_USE_DECAY:
+            new_rating = "(rating_decay_sum + :weighted) / (rating_decay_weight + :weight)"
+        else:
+            new_rating = "(rating_sum + :rating) / (rating_count + 1)"
+
+        async def write(conn):
+            await conn.execute(
                 "INSERT INTO ratings (order_id, from_user_id, to_user_id, rating, comment) VALUES (?, ?, ?, ?, ?)",
                 (order_id, from_user_id, to_user_id, rating, comment)
             )
 
-            # Update the order with rating
-            field = 'passenger_rating' if to_user_id == (await self.get_order(order_id))[
-                'passenger_id'] else 'driver_rating'
-            await db.execute(f"UPDATE orders SET {field} = ? WHERE order_id = ?", (rating, order_id))
+            # Update the order with rating on the side that was rated
+            await conn.execute(
+                """
+                UPDATE orders SET
+                    passenger_rating = CASE WHEN passenger_id = :to_user_id THEN :rating ELSE passenger_rating END,
+                    driver_rating = CASE WHEN passenger_id = :to_user_id THEN driver_rating ELSE :rating END
+                WHERE order_id = :order_id
+                """,
+                {'to_user_id': to_user_id, 'rating': rating, 'order_id': order_id}
+            )
 
-            # Update user's average rating
-            db.row_factory = aiosqlite.Row
-            async with db.execute(
-                    "SELECT AVG(rating) as avg_rating FROM ratings WHERE to_user_id = ?",
-                    (to_user_id,)
+            # Update user's running aggregates, all SET expressions see the old values
+            async with conn.execute(
+                f"""
+                UPDATE users SET
+                    rating = {new_rating},
+                    rating_sum = rating_sum + :rating,
+                    rating_count = rating_count + 1,
+                    rating_decay_sum = rating_decay_sum + :weighted,
+                    rating_decay_weight = rating_decay_weight + :weight
+                WHERE user_id = :to_user_id
+                RETURNING full_name, phone, rating
+                """,
+                {'rating': rating, 'weighted': rating * weight, 'weight': weight, 'to_user_id': to_user_id}
             ) as cursor:
-                result = await cursor.fetchone()
-                avg_rating = result['avg_rating']
-
-            await db.execute(
-                "UPDATE users SET rating = ? WHERE user_id = ?",
-                (avg_rating, to_user_id)
-            )
+                return await cursor.fetchone()
 
-            await db.commit()
+        user = await self.writer.submit(write)
+        self.profile_cache.invalidate(('user', to_user_id))
+        # A rated passenger may be waiting on another order
+        if user:
+            self.order_book.update_passenger(to_user_id, user['full_name'], user['phone'], user['rating'])
 
     # Statistics
     async def get_driver_earnings(self, driver_id, period=None):
-        """Get driver earnings"""
-        async with aiosqlite.connect(self.db_name) as db:
-            query = """
-                SELECT SUM(actual_cost) as total_earnings 
-                FROM orders 
-                WHERE driver_id = ? AND status = 'completed'
-            """
-            params = [driver_id]
-
-            if period == 'today':
-                query += " AND date(completed_at) = date('now')"
-            elif period == 'week':
-                query += " AND date(completed_at) >= date('now', '-7 days')"
-            elif period == 'month':
-                query += " AND date(completed_at) >= date('now', '-30 days')"
-
-            db.row_factory = aiosqlite.Row
-            async with db.execute(query, params) as cursor:
+        """Get driver earnings from the daily rollups (at most ~30 rows per period)"""
+        query = "SELECT SUM(amount) as total_earnings FROM driver_daily_earnings WHERE driver_id = ?"
+        params = [driver_id]
+
+        # Days are local dates, same as completed_at
+        start_day = earnings_period_start(period)
+        if period == 'today':
+            query += " AND day = ?"
+            params.append(start_day)
+        elif start_day:
+            query += " AND day >= ?"
+            params.append(start_day)
+
+        async with self.pool.acquire() as conn:
+            async with conn.execute(query, params) as cursor:
                 result = await cursor.fetchone()
                 return result['total_earnings'] if result['total_earnings'] else 0
 
+    async def backfill_earnings(self):
+        """Rebuild driver_daily_earnings from existing completed orders"""
+        async def write(conn):
+            await backfill_driver_earnings(conn)
+
+        await self.writer.submit(write)
+
     async def get_completed_orders_count(self, user_id, role='driver'):
         """Get count of completed orders"""
         field = 'driver_id' if role == 'driver' else 'passenger_id'
-        async with aiosqlite.connect(self.db_name) as db:
-            async with db.execute(
+        async with self.pool.acquire() as conn:
+            async with conn.execute(
                     f"SELECT COUNT(*) as count FROM orders WHERE {field} = ? AND status = 'completed'",
                     (user_id,)
             ) as cursor:
                 result = await cursor.fetchone()
-                return result[0]
\ No newline at end of file
+                return result[0]
+
+    # Diagnostics
+    def cache_stats(self):
+        """Get profile cache hit/miss counters"""
+        return self.profile_cache.stats()
+
+    def write_stats(self):
+        """Get write queue metrics: queue depth, group sizes and commit latency"""
+        return self.writer.stats()
+
+    @contextlib.asynccontextmanager
+    async def capture_queries(self):
+        """Record every SQL statement run on the pool and the writer, with parameters inlined"""
+        statements = []
+        connections = self.pool._connections + [self.writer.conn]
+        for conn in connections:
+            await conn.set_trace_callback(statements.append)
+        try:
+            yield statements
+        finally:
+            for conn in connections:
+                await conn.set_trace_callback(None)
+
+    async def explain(self, query, params=()):
+        """Get EXPLAIN QUERY PLAN details for a query"""
+        async with self.pool.acquire() as conn:
+            async with conn.execute(f"EXPLAIN QUERY PLAN {query}", params) as cursor:
+                return [row['detail'] for row in await cursor.fetchall()]
+
+    async def find_slow_plans(self, statements):
+        """
+        Get query plan steps that scan a whole table or sort in a temp b-tree
+
+        Typical use in tests: run the code under capture_queries() and assert
+        that find_slow_plans() on the captured statements returns nothing.
+        """
+        slow = []
+        for statement in dict.fromkeys(statements):
+            if not statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE", "INSERT")):
+                continue
+            for detail in await self.explain(statement):
+                full_scan = detail.startswith("SCAN ") and " INDEX " not in detail
+                if full_scan or "USE TEMP B-TREE" in detail:
+                    slow.append((statement, detail))
+        return slow
+
+
+def create_database(engine=DB_ENGINE):
+    """Create a storage engine by name: 'sqlite' or 'memory'"""
+    if engine == 'sqlite':
+        return Database()
+    if engine == 'memory':
+        return MemoryDatabase()
+    raise ValueError(f"Unknown database engine: {engine}")
+
+
+# Shared instance: opened once in main.main() and used by every router
+db = create_database()
+
+
+async def _run_command(command):
+    """Run a maintenance command against the configured database"""
+    await db.init()
+    try:
+        if command == 'backfill-earnings':
+            await db.backfill_earnings()
+            print("Driver earnings rollups rebuilt")
+    finally:
+        await db.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Database maintenance commands")
+    parser.add_argument("command", choices=['backfill-earnings'])
+    asyncio.run(_run_command(parser.parse_args().command))
@@ -0,0 +1,110 @@
+import bisect
+import time
+from collections import deque
+
+from config import DECLINE_MEMORY_TTL, DECLINE_RATE_PRIOR, DECLINE_RATE_PRIOR_WEIGHT
+
+
+class DeclineMemory:
+    """
+    Drivers who declined each pending order, plus decline rates per driver
+
+    Declines are kept per order as {driver_id: expires_at} and forgotten
+    after `ttl` seconds, or as soon as the order is accepted or cancelled.
+    Every entry lives for the same TTL, so expiring them in insertion order
+    from one deque is enough; lookups are two dict probes.
+
+    Decline rates count declines against accepted orders, shrunk towards
+    DECLINE_RATE_PRIOR for drivers with few responses.
+    """
+
+    def __init__(self, ttl=DECLINE_MEMORY_TTL, prior=DECLINE_RATE_PRIOR, prior_weight=DECLINE_RATE_PRIOR_WEIGHT):
+        self.ttl = ttl
+        self.prior = prior
+        self.prior_weight = prior_weight
+        self._orders = {}  # order_id -> {driver_id: expires_at}
+        self._expiry = deque()  # (expires_at, order_id, driver_id), oldest first
+        self._declines = {}  # driver_id -> declined orders
+        self._accepts = {}  # driver_id -> accepted orders
+
+    def __len__(self):
+        return sum(len(drivers) for drivers in self._orders.values())
+
+    def clear(self):
+        self._orders.clear()
+        self._expiry.clear()
+        self._declines.clear()
+        self._accepts.clear()
+
+    def _purge(self, now):
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, order_id, driver_id = self._expiry.popleft()
+            drivers = self._orders.get(order_id)
+            if drivers is not None and drivers.get(driver_id) == expires_at:
+                del drivers[driver_id]
+                if not drivers:
+                    del self._orders[order_id]
+
+    def remember(self, order_id, driver_id, age=0.0):
+        """Keep a decline made `age` seconds ago out of the order's offers until it expires"""
+        now = time.time()
+        self._purge(now)
+        expires_at = now - age + self.ttl
+        if expires_at <= now:
+            return
+        self._orders.setdefault(order_id, {})[driver_id] = expires_at
+        # Only declines loaded out of order need a search to stay sorted
+        if self._expiry and self._expiry[-1][0] > expires_at:
+            bisect.insort(self._expiry, (expires_at, order_id, driver_id))
+        else:
+            self._expiry.append((expires_at, order_id, driver_id))
+
+    def record(self, order_id, driver_id):
+        """A driver declined an order just now"""
+        self.remember(order_id, driver_id)
+        self._declines[driver_id] = self._declines.get(driver_id, 0) + 1
+
+    def record_accept(self, driver_id):
+        """A driver accepted an order"""
+        self._accepts[driver_id] = self._accepts.get(driver_id, 0) + 1
+
+    def load_counts(self, driver_id, declines, accepts):
+        """Set a driver's counters from storage"""
+        self._declines[driver_id] = declines
+        self._accepts[driver_id] = accepts
+
+    def forget_order(self, order_id):
+        """An order left 'pending'; nobody will be offered it again"""
+        self._orders.pop(order_id, None)
+
+    def declined(self, order_id, driver_id):
+        """Whether the driver declined the order and the decline hasn't expired"""
+        drivers = self._orders.get(order_id)
+        if not drivers:
+            return False
+        expires_at = drivers.get(driver_id)
+        return expires_at is not None and expires_at > time.time()
+
+    def decliners(self, order_id):
+        """Drivers with an unexpired decline of the order"""
+        now = time.time()
+        return {driver_id for driver_id, expires_at in self._orders.get(order_id, {}).items() if expires_at > now}
+
+    def decline_rate(self, driver_id):
+        """Share of a driver's answered orders that were declined"""
+        declines = self._declines.get(driver_id, 0)
+        responses = declines + self._accepts.get(driver_id, 0)
+        return (declines + self.prior * self.prior_weight) / (responses + self.prior_weight)
+
+    def stats(self):
+        """Get remembered declines and overall counters"""
+        self._purge(time.time())
+        declines = sum(self._declines.values())
+        accepts = sum(self._accepts.values())
+        return {
+            'orders': len(self._orders),
+            'remembered': len(self),
+            'declines': declines,
+            'accepts': accepts,
+            'decline_rate': declines / (declines + accepts) if declines + accepts else None
+        }
@@ -0,0 +1,333 @@
+import asyncio
+import heapq
+import logging
+import time
+from collections import deque
+
+import numpy as np
+
+from db import db
+from assignment import solve
+from geomatrix import equirectangular_matrix
+from config import (
+    ORDER_ACCEPTANCE_TIMEOUT, DISPATCH_FANOUT, DISPATCH_MAX_ROUNDS, DISPATCH_BATCH_INTERVAL, DISPATCH_BATCH_BUDGET,
+    NEAREST_DRIVERS_RADIUS_KM
+)
+
+
+class OrderDispatch:
+    """Offer state of one pending order"""
+
+    __slots__ = ('order_id', 'submitted', 'round', 'offered', 'outstanding')
+
+    def __init__(self, order_id, submitted):
+        self.order_id = order_id
+        self.submitted = submitted
+        self.round = 0
+        self.offered = set()  # Drivers offered the order so far
+        self.outstanding = set()  # Drivers whose current offer is unanswered
+
+
+class OrderDispatcher:
+    """
+    Pushes pending orders to the nearest available drivers
+
+    Each round offers the order to up to `fanout` drivers who haven't seen
+    it and have no other offer open, then waits `timeout` seconds. When the
+    round times out, or all its drivers decline, the next round cascades to
+    the next candidates; after `max_rounds` the order is left to drivers
+    browsing pending orders.
+
+    With a `batch_interval`, orders due for a round wait for the next
+    batch instead: every interval, all waiting orders and all available
+    drivers without an open offer are matched one to one, minimizing the
+    total pickup distance. A batch solving longer than `batch_budget`
+    matches its remaining orders greedily.
+
+    All deadlines live in one heap served by a single scheduler task, which
+    also runs the batches. Handlers only report events (accepted, declined,
+    cancelled), which update the state and, when a round is over, schedule
+    its end for now. A timer whose round has moved on is skipped when it
+    comes up.
+    """
+
+    def __init__(self, storage, timeout=ORDER_ACCEPTANCE_TIMEOUT, fanout=DISPATCH_FANOUT,
+                 max_rounds=DISPATCH_MAX_ROUNDS, radius_km=NEAREST_DRIVERS_RADIUS_KM,
+                 batch_interval=DISPATCH_BATCH_INTERVAL, batch_budget=DISPATCH_BATCH_BUDGET):
+        self.storage = storage
+        self.timeout = timeout
+        self.fanout = fanout
+        self.max_rounds = max_rounds
+        self.radius_km = radius_km
+        self.batch_interval = batch_interval
+        self.batch_budget = batch_budget
+
+        self._send_offer = None  # async (driver_id, order), set by start()
+        self._dispatches = {}  # order_id -> OrderDispatch
+        self._driver_offers = {}  # driver_id -> order_id of their open offer
+        self._timers = []  # Heap of (deadline, order_id, round)
+        self._waiting = {}  # order_id -> order row, due for a round in the next batch
+        self._next_batch = None
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._sends = set()
+
+        # Metrics
+        self.submitted = 0
+        self.offers = 0
+        self.declines = 0
+        self.timeouts = 0
+        self.accepts = 0
+        self.unassigned = 0
+        self.accept_times = deque(maxlen=1000)  # Seconds from submission to acceptance
+        self.offers_per_order = deque(maxlen=1000)  # Offers sent before acceptance
+        self.batches = 0
+        self.batch_fallbacks = 0
+        self.batch_times = deque(maxlen=100)  # Seconds spent matching each batch
+
+    def _loop_time(self):
+        return asyncio.get_running_loop().time()
+
+    def _schedule(self, dispatch, delay):
+        """End the dispatch's current round after `delay` seconds"""
+        heapq.heappush(self._timers, (self._loop_time() + delay, dispatch.order_id, dispatch.round))
+        self._wakeup.set()
+
+    def submit(self, order_id):
+        """Start offering a new pending order to drivers"""
+        if order_id in self._dispatches:
+            return
+        dispatch = self._dispatches[order_id] = OrderDispatch(order_id, self._loop_time())
+        self.submitted += 1
+        self._schedule(dispatch, 0)
+
+    def _release(self, driver_id):
+        """Close a driver's open offer; returns its dispatch, if still active"""
+        order_id = self._driver_offers.pop(driver_id, None)
+        dispatch = self._dispatches.get(order_id)
+        if dispatch is not None:
+            dispatch.outstanding.discard(driver_id)
+        return dispatch
+
+    def _forget(self, order_id):
+        self._waiting.pop(order_id, None)
+        dispatch = self._dispatches.pop(order_id, None)
+        if dispatch is not None:
+            for driver_id in dispatch.outstanding:
+                self._driver_offers.pop(driver_id, None)
+        return dispatch
+
+    def accepted(self, order_id, driver_id):
+        """An order was accepted, through an offer or from the pending list"""
+        # The driver is busy now, so any other offer they had is off
+        self.declined(self._driver_offers.get(driver_id), driver_id, counted=False)
+
+        dispatch = self._forget(order_id)
+        if dispatch is not None:
+            self.accepts += 1
+            self.accept_times.append(self._loop_time() - dispatch.submitted)
+            self.offers_per_order.append(len(dispatch.offered))
+
+    def declined(self, order_id, driver_id, counted=True):
+        """A driver turned an offer down"""
+        if order_id is None or self._driver_offers.get(driver_id) != order_id:
+            return
+        if counted:
+            self.declines += 1
+        dispatch = self._release(driver_id)
+        if dispatch is not None and not dispatch.outstanding:
+            # Nobody left to answer this round, cascade right away
+            self._schedule(dispatch, 0)
+
+    def driver_unavailable(self, driver_id):
+        """A driver went busy or offline; their open offer moves on"""
+        self.declined(self._driver_offers.get(driver_id), driver_id, counted=False)
+
+    def cancelled(self, order_id):
+        """An order was cancelled or expired"""
+        self._forget(order_id)
+
+    async def _candidates(self, order, dispatch):
+        """Next drivers to offer the order to, nearest to the pickup first"""
+        # Drivers who declined the order while browsing pending orders count as offered
+        declined = self.storage.declines.decliners(order['order_id'])
+
+        def eligible(driver_id):
+            return (driver_id not in dispatch.offered and driver_id not in declined
+                    and driver_id not in self._driver_offers)
+
+        if order['pickup_latitude'] is None:
+            # Orders without a geocoded pickup go to any available driver
+            drivers = [driver['user_id'] for driver in await self.storage.get_available_drivers()]
+            return [driver_id for driver_id in drivers if eligible(driver_id)][:self.fanout]
+
+        # Ask for enough neighbours to skip the ones already offered or busy with an offer
+        k = self.fanout + len(dispatch.offered) + len(declined) + len(self._driver_offers)
+        nearest = self.storage.find_nearest_drivers(
+            order['pickup_latitude'], order['pickup_longitude'], k=k, radius_km=self.radius_km
+        )
+        return [driver_id for driver_id, _ in nearest if eligible(driver_id)][:self.fanout]
+
+    async def _next_round(self, dispatch):
+        """Close the current round and offer the order to the next drivers, now or in the next batch"""
+        if dispatch.outstanding:
+            self.timeouts += len(dispatch.outstanding)
+            for driver_id in list(dispatch.outstanding):
+                self._release(driver_id)
+
+        order = await self.storage.get_order(dispatch.order_id)
+        if order is None or order['status'] != 'pending':
+            # Accepted or cancelled without us hearing about it
+            self._forget(dispatch.order_id)
+            return
+        if dispatch.round >= self.max_rounds:
+            self._forget(dispatch.order_id)
+            self.unassigned += 1
+            return
+
+        if self.batch_interval and order['pickup_latitude'] is not None:
+            self._waiting[dispatch.order_id] = order
+        else:
+            self._start_round(dispatch, order, await self._candidates(order, dispatch))
+
+    def _start_round(self, dispatch, order, driver_ids):
+        """Offer an order to drivers and time the round"""
+        dispatch.round += 1
+        for driver_id in driver_ids:
+            dispatch.offered.add(driver_id)
+            dispatch.outstanding.add(driver_id)
+            self._driver_offers[driver_id] = dispatch.order_id
+            self.offers += 1
+            task = asyncio.create_task(self._offer(driver_id, order))
+            self._sends.add(task)
+            task.add_done_callback(self._sends.discard)
+
+        # With no candidates this is just a pause before looking again
+        self._schedule(dispatch, self.timeout)
+
+    async def _run_batch(self):
+        """Match all waiting orders to available drivers at the least total pickup distance"""
+        waiting, self._waiting = self._waiting, {}
+        driver_ids, positions = self.storage.driver_index.available()
+        columns = [column for column, driver_id in enumerate(driver_ids) if driver_id not in self._driver_offers]
+        driver_ids = [driver_ids[column] for column in columns]
+        positions = [positions[column] for column in columns]
+        dispatches = [self._dispatches[order_id] for order_id in waiting]
+        orders = list(waiting.values())
+
+        started = time.monotonic()
+        try:
+            cost = equirectangular_matrix(
+                [(order['pickup_latitude'], order['pickup_longitude']) for order in orders], positions
+            )
+            cost[cost > self.radius_km] = np.inf
+            column_of = {driver_id: column for column, driver_id in enumerate(driver_ids)}
+            for row, dispatch in enumerate(dispatches):
+                excluded = dispatch.offered | self.storage.declines.decliners(dispatch.order_id)
+                offered = [column_of[driver_id] for driver_id in excluded if driver_id in column_of]
+                cost[row, offered] = np.inf
+
+            # The solver is CPU-bound, so it runs off the event loop
+            loop = asyncio.get_running_loop()
+            pairs, optimal = await loop.run_in_executor(None, solve, cost, started + self.batch_budget)
+        except Exception:
+            # Nobody gets an offer this time; the orders wait a round and come back
+            logging.exception("Failed to match a dispatch batch")
+            pairs, optimal = [], False
+        self.batches += 1
+        self.batch_fallbacks += not optimal
+        self.batch_times.append(time.monotonic() - started)
+
+        matched = dict(pairs)
+        for row, (dispatch, order) in enumerate(zip(dispatches, orders)):
+            if self._dispatches.get(dispatch.order_id) is not dispatch:
+                continue  # Accepted or cancelled while solving
+            driver_id = driver_ids[matched[row]] if row in matched else None
+            if driver_id in self._driver_offers:
+                driver_id = None  # Took another order while solving
+            self._start_round(dispatch, order, [driver_id] if driver_id is not None else [])
+
+    async def _offer(self, driver_id, order):
+        """Send one offer; a driver who can't be reached counts as declining"""
+        try:
+            await self._send_offer(driver_id, order)
+        except Exception:
+            logging.exception(f"Failed to offer order {order['order_id']} to driver {driver_id}")
+            self.declined(order['order_id'], driver_id, counted=False)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        if self.batch_interval:
+            self._next_batch = loop.time() + self.batch_interval
+        while True:
+            if self._next_batch is not None and self._next_batch <= loop.time():
+                if self._waiting:
+                    await self._run_batch()
+                self._next_batch = max(self._next_batch + self.batch_interval, loop.time())
+
+            while self._timers and self._timers[0][0] <= loop.time():
+                _, order_id, round_ = heapq.heappop(self._timers)
+                dispatch = self._dispatches.get(order_id)
+                if dispatch is None or dispatch.round != round_:
+                    continue  # Superseded timer
+                try:
+                    await self._next_round(dispatch)
+                except Exception:
+                    logging.exception(f"Failed to dispatch order {order_id}")
+                    self._forget(order_id)
+
+            self._wakeup.clear()
+            deadlines = [self._timers[0][0]] if self._timers else []
+            if self._next_batch is not None:
+                deadlines.append(self._next_batch)
+            delay = max(0, min(deadlines) - loop.time()) if deadlines else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self, send_offer):
+        """Start the scheduler and resume dispatching orders left pending by the last run"""
+        self._send_offer = send_offer
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        for order in await self.storage.get_pending_orders():
+            self.submit(order['order_id'])
+
+    async def close(self):
+        """Stop the scheduler and wait for offers being sent"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._sends:
+            await asyncio.gather(*self._sends, return_exceptions=True)
+
+    def stats(self):
+        """Get offer counters, time to accept and offers per accepted order"""
+        times = sorted(self.accept_times)
+        return {
+            'active': len(self._dispatches),
+            'open_offers': len(self._driver_offers),
+            'timers': len(self._timers),
+            'submitted': self.submitted,
+            'offers': self.offers,
+            'declines': self.declines,
+            'timeouts': self.timeouts,
+            'accepted': self.accepts,
+            'unassigned': self.unassigned,
+            'accept_time_p50': times[len(times) // 2] if times else None,
+            'accept_time_p95': times[int(len(times) * 0.95)] if times else None,
+            'offers_per_order': sum(self.offers_per_order) / len(self.offers_per_order) if self.offers_per_order else None,
+            'waiting': len(self._waiting),
+            'batches': self.batches,
+            'batch_fallbacks': self.batch_fallbacks,
+            'batch_time_max': max(self.batch_times) if self.batch_times else None
+        }
+
+
+# Shared instance fed by the passenger and driver routers
+order_dispatcher = OrderDispatcher(db)
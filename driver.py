@@ -5,18 +5,43 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 
 import keyboards as kb
-from db import Database
+from db import db
+from locations import location_buffer
+from dispatch import order_dispatcher
 from config import MESSAGES
-from common import format_order_info
+from common import format_order_info, send_order_history
 
-# Initialize router and database
+# Initialize router
 router = Router()
-db = Database()
 
 # States for driver actions
 class DriverStates(StatesGroup):
     waiting_for_rating = State()
 
+def format_pending_order(order, full_name, rating):
+    """Format a pending order as drivers see it"""
+    human_class = "Комфорт" if order['ride_class'] == 'comfort' else "Эконом"
+    return (
+        f"<b>Заказ #{order['order_id']}</b>\n\n"
+        f"<b>От:</b> {order['from_address']}\n"
+        f"<b>До:</b> {order['to_address']}\n"
+        f"<b>Класс:</b> {human_class}\n"
+        f"<b>Расстояние:</b> {order['distance']} км\n"
+        f"<b>Стоимость:</b> {order['estimated_cost']} руб.\n"
+        f"<b>Пассажир:</b> {full_name}\n"
+        f"<b>Рейтинг пассажира:</b> {'⭐' * int(rating)}\n"
+    )
+
+async def send_order_offer(bot, driver_id, order):
+    """Offer a pending order to a driver, called by the dispatcher"""
+    passenger = await db.get_user(order['passenger_id'])
+    await bot.send_message(
+        driver_id,
+        format_pending_order(order, passenger['full_name'], passenger['rating']),
+        reply_markup=kb.get_driver_order_actions(order['order_id']),
+        parse_mode="HTML"
+    )
+
 @router.callback_query(F.data == "view_orders")
 async def view_orders(callback: CallbackQuery):
     """Handler for viewing available orders"""
@@ -32,8 +57,10 @@ async def view_orders(callback: CallbackQuery):
         )
         return
     
-    # Get pending orders
-    orders = await db.get_pending_orders()
+    # Get pending orders, only nearby ones once the driver has shared a location
+    orders = await db.get_pending_orders(
+        driver_id=callback.from_user.id, near=db.driver_index.position(callback.from_user.id)
+    )
     
     if not orders:
         await callback.message.answer(
@@ -45,18 +72,7 @@ async def view_orders(callback: CallbackQuery):
     # Show orders one by one
     for order in orders:
         # Format order message
-        human_class = "Комфорт" if order['ride_class'] == 'comfort' else "Эконом"
-        
-        order_text = (
-            f"<b>Заказ #{order['order_id']}</b>\n\n"
-            f"<b>От:</b> {order['from_address']}\n"
-            f"<b>До:</b> {order['to_address']}\n"
-            f"<b>Класс:</b> {human_class}\n"
-            f"<b>Расстояние:</b> {order['distance']} км\n"
-            f"<b>Стоимость:</b> {order['estimated_cost']} руб.\n"
-            f"<b>Пассажир:</b> {order['full_name']}\n"
-            f"<b>Рейтинг пассажира:</b> {'⭐' * int(order['rating'])}\n"
-        )
+        order_text = format_pending_order(order, order['full_name'], order['rating'])
         
         # Create keyboard for this specific order
         markup = kb.get_driver_order_actions(order['order_id'])
@@ -81,31 +97,22 @@ async def accept_order(callback: CallbackQuery):
     # Extract order_id from callback data
     order_id = int(callback.data.split("_")[2])
     
-    # Get order details
-    order = await db.get_order(order_id)
+    # Accept the order, losing the race means someone else got it first
+    order = await db.accept_order(order_id, callback.from_user.id)
     
     if not order:
-        await callback.message.answer(
-            "Заказ не найден или устарел.",
-            reply_markup=kb.get_back_to_menu()
-        )
-        return
-    
-    # Check if order is still pending
-    if order['status'] != 'pending':
         await callback.message.answer(
             MESSAGES["order_already_accepted"],
             reply_markup=kb.get_back_to_menu()
         )
         return
     
-    # Accept the order
-    await db.accept_order(order_id, callback.from_user.id)
+    order_dispatcher.accepted(order_id, callback.from_user.id)
     
     # Notify driver
     await callback.message.answer(
         f"Вы приняли заказ #{order_id}! Пожалуйста, направляйтесь к точке посадки:\n{order['from_address']}",
-        reply_markup=kb.get_active_order_keyboard('driver', 'accepted')
+        reply_markup=kb.get_active_order_keyboard('driver', 'accepted', order_id)
     )
 
 @router.callback_query(F.data.startswith("decline_order_"))
@@ -113,8 +120,12 @@ async def decline_order(callback: CallbackQuery):
     """Handler for declining an order"""
     await callback.answer()
     
-    # Here we just ignore the order, not actually declining it in the database
-    # In a real app, you might want to mark it as declined by this driver
+    # Extract order_id from callback data
+    order_id = int(callback.data.split("_")[2])
+    
+    # Keep it out of the driver's list and let the dispatcher offer it to the next driver
+    await db.record_decline(order_id, callback.from_user.id)
+    order_dispatcher.declined(order_id, callback.from_user.id)
     await callback.message.answer(
         "Вы отклонили заказ.",
         reply_markup=kb.get_back_to_menu()
@@ -164,6 +175,8 @@ async def update_status(callback: CallbackQuery):
     
     # Update status
     await db.update_driver_status(callback.from_user.id, new_status)
+    if new_status == 'busy':
+        order_dispatcher.driver_unavailable(callback.from_user.id)
     
     # Notify driver
     status_text = "Свободен" if new_status == 'available' else "Занят"
@@ -172,86 +185,101 @@ async def update_status(callback: CallbackQuery):
         reply_markup=kb.get_back_to_menu()
     )
 
-@router.callback_query(F.data == "driver_started")
+@router.callback_query(F.data.startswith("driver_started_"))
 async def driver_started(callback: CallbackQuery):
     """Handler for when driver starts moving to pickup point"""
     await callback.answer()
     
-    # Get active order
-    active_order = await db.get_active_order(callback.from_user.id, 'driver')
+    # Extract order_id from callback data
+    order_id = int(callback.data.split("_")[-1])
     
-    if not active_order or active_order['status'] != 'accepted':
+    # Update order status, rejected unless it's this driver's accepted order
+    order = await db.transition_order(order_id, callback.from_user.id, 'accepted', 'driver_started')
+    
+    if not order:
         await callback.message.answer(
             "Нет активного заказа в подходящем статусе.",
             reply_markup=kb.get_back_to_menu()
         )
         return
     
-    # Update order status
-    await db.execute(
-        "UPDATE orders SET status = 'driver_started' WHERE order_id = ?",
-        (active_order['order_id'],)
-    )
-    
     await callback.message.answer(
         "Статус обновлен: Вы выехали к клиенту.",
-        reply_markup=kb.get_active_order_keyboard('driver', 'driver_started')
+        reply_markup=kb.get_active_order_keyboard('driver', 'driver_started', order_id)
     )
 
-@router.callback_query(F.data == "driver_arrived")
+@router.callback_query(F.data.startswith("driver_arrived_"))
 async def driver_arrived(callback: CallbackQuery):
     """Handler for when driver arrives at pickup point"""
     await callback.answer()
     
-    # Get active order
-    active_order = await db.get_active_order(callback.from_user.id, 'driver')
+    # Extract order_id from callback data
+    order_id = int(callback.data.split("_")[-1])
     
-    if not active_order or active_order['status'] not in ['accepted', 'driver_started']:
+    # Update order status
+    order = await db.transition_order(
+        order_id, callback.from_user.id, ('accepted', 'driver_started'), 'driver_arrived'
+    )
+    
+    if not order:
         await callback.message.answer(
             "Нет активного заказа в подходящем статусе.",
             reply_markup=kb.get_back_to_menu()
         )
         return
     
-    # Update order status
-    await db.execute(
-        "UPDATE orders SET status = 'driver_arrived' WHERE order_id = ?",
-        (active_order['order_id'],)
-    )
-    
     await callback.message.answer(
         "Статус обновлен: Вы прибыли на место посадки.",
-        reply_markup=kb.get_active_order_keyboard('driver', 'driver_arrived')
+        reply_markup=kb.get_active_order_keyboard('driver', 'driver_arrived', order_id)
     )
 
-@router.callback_query(F.data == "complete_order")
-async def complete_ride(callback: CallbackQuery):
-    """Handler for completing a ride"""
+@router.callback_query(F.data.startswith("start_ride_"))
+async def start_ride(callback: CallbackQuery):
+    """Handler for when the passenger is on board"""
     await callback.answer()
     
-    # Get active order
-    active_order = await db.get_active_order(callback.from_user.id, 'driver')
+    # Extract order_id from callback data
+    order_id = int(callback.data.split("_")[-1])
+    
+    # Update order status
+    order = await db.transition_order(order_id, callback.from_user.id, 'driver_arrived', 'in_progress')
     
-    if not active_order or active_order['status'] != 'driver_arrived':
+    if not order:
         await callback.message.answer(
             "Нет активного заказа в подходящем статусе.",
             reply_markup=kb.get_back_to_menu()
         )
         return
     
+    await callback.message.answer(
+        "Статус обновлен: Поездка началась.",
+        reply_markup=kb.get_active_order_keyboard('driver', 'in_progress', order_id)
+    )
+
+@router.callback_query(F.data.startswith("complete_order_"))
+async def complete_ride(callback: CallbackQuery):
+    """Handler for completing a ride"""
+    await callback.answer()
+    
+    # Extract order_id from callback data
+    order_id = int(callback.data.split("_")[-1])
+    
     # Complete the order
-    success = await db.complete_order(active_order['order_id'])
+    order = await db.transition_order(
+        order_id, callback.from_user.id, ('driver_arrived', 'in_progress'), 'completed'
+    )
     
-    if success:
-        await callback.message.answer(
-            "Поездка успешно завершена! Теперь вы можете оценить пассажира.",
-            reply_markup=kb.get_active_order_keyboard('driver', 'completed')
-        )
-    else:
+    if not order:
         await callback.message.answer(
-            "Произошла ошибка при завершении поездки. Попробуйте снова.",
+            "Нет активного заказа в подходящем статусе.",
             reply_markup=kb.get_back_to_menu()
         )
+        return
+    
+    await callback.message.answer(
+        "Поездка успешно завершена! Теперь вы можете оценить пассажира.",
+        reply_markup=kb.get_active_order_keyboard('driver', 'completed', order_id)
+    )
 
 @router.callback_query(F.data == "rate_passenger")
 async def show_passenger_rating(callback: CallbackQuery, state: FSMContext):
@@ -391,38 +419,25 @@ async def show_order_history(callback: CallbackQuery):
     """Show order history for driver"""
     await callback.answer()
     
-    # Get order history
-    orders = await db.get_order_history(callback.from_user.id, 'driver')
-    
-    if not orders:
-        await callback.message.answer(
-            MESSAGES["no_history"],
-            reply_markup=kb.get_back_to_menu()
-        )
+    # Show the newest page, older pages are reached with the keyset buttons
+    await send_order_history(callback.message, callback.from_user.id, 'driver')
+
+@router.message(F.location)
+async def receive_location(message: Message):
+    """Take a driver's location or the first message of a live location"""
+    # Checked in memory, as every fix would otherwise read the driver's profile
+    if not db.is_driver(message.from_user.id):
         return
     
-    # Format and show orders
-    response = "<b>История ваших поездок:</b>\n\n"
-    
-    for i, order in enumerate(orders, 1):
-        status_emoji = {
-            'completed': '✅',
-            'cancelled': '❌',
-            'pending': '⏳',
-            'accepted': '🚗',
-            'in_progress': '🚕'
-        }.get(order['status'], '')
-        
-        response += (
-            f"{i}. {status_emoji} <b>Заказ #{order['order_id']}</b>\n"
-            f"   {order['from_address']} → {order['to_address']}\n"
-            f"   Класс: {'Комфорт' if order['ride_class'] == 'comfort' else 'Эконом'}\n"
-            f"   Стоимость: {order['actual_cost'] or order['estimated_cost']} руб.\n"
-            f"   Дата: {order['created_at'][:10]}\n\n"
-        )
+    location_buffer.record(message.from_user.id, message.location.latitude, message.location.longitude, message.date.timestamp())
+    await message.answer(MESSAGES["location_received"])
+
+@router.edited_message(F.location)
+async def receive_live_location(message: Message):
+    """Take a live location update, Telegram sends them as edits of the original message"""
+    if not db.is_driver(message.from_user.id):
+        return
     
-    await callback.message.answer(
-        response,
-        reply_markup=kb.get_history_keyboard(),
-        parse_mode="HTML"
-    )
\ No newline at end of file
+    # Updates are frequent, so no reply; edit_date orders them
+    timestamp = message.edit_date or message.date.timestamp()
+    location_buffer.record(message.from_user.id, message.location.latitude, message.location.longitude, timestamp)
\ No newline at end of file
@@ -0,0 +1,197 @@
+import asyncio
+import datetime
+import heapq
+import logging
+import time
+
+from db import db
+from dispatch import order_dispatcher
+from storage import ORDER_TRANSITIONS
+from config import ORDER_EXPIRY_DEADLINES, ORDER_REDISPATCH_AFTER
+
+
+def _timestamp(value):
+    """Unix time of a UTC timestamp in SQLite's CURRENT_TIMESTAMP format"""
+    return datetime.datetime.fromisoformat(value).replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+class OrderExpiry:
+    """
+    Cancels orders that stay too long in one status
+
+    Each open order has one timer, set for the deadline of the status it
+    was in at the time. Timers are not moved when orders change status:
+    when one comes up, the order is read back and, if it has moved on, the
+    timer is set again for the new status, or dropped once the status has
+    no deadline. As long as deadlines don't shrink along the ride, no
+    order is caught late. Pending orders are also handed back to the
+    dispatcher every `redispatch_after` seconds until they expire, in case
+    it has given up on them.
+
+    Timers live in one heap served by a single task, like the dispatcher's.
+    A replaced timer stays in the heap and is skipped when it comes up; the
+    heap is rebuilt once skipped entries outnumber the live ones.
+    """
+
+    # Orders checked at once when many timers come up together
+    BATCH_SIZE = 256
+
+    def __init__(self, storage, dispatcher, deadlines=ORDER_EXPIRY_DEADLINES, redispatch_after=ORDER_REDISPATCH_AFTER):
+        for status in deadlines:
+            if 'cancelled' not in ORDER_TRANSITIONS.get(status, ()):
+                raise ValueError(f"Orders can't expire from status {status!r}")
+        self.storage = storage
+        self.dispatcher = dispatcher
+        self.deadlines = deadlines
+        self.redispatch_after = redispatch_after
+
+        self._notify = None  # async (order, status), set by start()
+        self._timers = {}  # order_id -> time of its live timer
+        self._heap = []  # Heap of (time, order_id), including replaced timers
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._sends = set()
+
+        # Metrics
+        self.checks = 0
+        self.expired = {status: 0 for status in deadlines}
+        self.redispatched = 0
+        self.lag = 0.0  # Worst delay of a timer past its time, seconds
+
+    def _next_check(self, status, changed_at, now):
+        """When to look at an order that entered `status` at `changed_at`, or None"""
+        deadline = self.deadlines.get(status)
+        if deadline is None:
+            return None
+        expires_at = changed_at + deadline
+        if status == 'pending' and self.redispatch_after:
+            periods = max(0, now - changed_at) // self.redispatch_after + 1
+            redispatch_at = changed_at + periods * self.redispatch_after
+            if redispatch_at < expires_at:
+                return redispatch_at
+        return expires_at
+
+    def track(self, order_id, status='pending', changed_at=None):
+        """Set the timer of an order that entered `status` at `changed_at` (Unix time, now by default)"""
+        now = time.time()
+        when = self._next_check(status, now if changed_at is None else changed_at, now)
+        if when is None:
+            self._timers.pop(order_id, None)
+            return
+        # Orders that expired while the bot was down are due right away
+        when = max(when, now)
+        self._timers[order_id] = when
+        heapq.heappush(self._heap, (when, order_id))
+        if len(self._heap) > 2 * len(self._timers) + self.BATCH_SIZE:
+            self._heap = [(when, order_id) for order_id, when in self._timers.items()]
+            heapq.heapify(self._heap)
+        self._wakeup.set()
+
+    def forget(self, order_id):
+        """Drop an order's timer"""
+        self._timers.pop(order_id, None)
+
+    async def _check(self, order_id):
+        """Expire, re-dispatch or re-arm an order whose timer came up"""
+        self.checks += 1
+        order = await self.storage.get_order(order_id)
+        if order is None or order['status'] not in self.deadlines:
+            return
+
+        status = order['status']
+        changed_at = _timestamp(order['status_changed_at'] or order['created_at'])
+        now = time.time()
+        if now < changed_at + self.deadlines[status]:
+            if status == 'pending' and self.redispatch_after:
+                self.redispatched += 1
+                self.dispatcher.submit(order_id)
+            self.track(order_id, status, changed_at)
+            return
+
+        # Conditional on the status, so a ride that moved on meanwhile is left alone.
+        # A driver who let the ride stall has gone silent, so they get no more
+        # orders until they set themselves available again
+        order = await self.storage.transition_order(order_id, None, status, 'cancelled', driver_status='busy')
+        if order is None:
+            order = await self.storage.get_order(order_id)
+            if order is not None and order['status'] in self.deadlines:
+                self.track(order_id, order['status'], _timestamp(order['status_changed_at']))
+            return
+
+        self.expired[status] += 1
+        self.dispatcher.cancelled(order_id)
+        if self._notify is not None:
+            send = asyncio.create_task(self._send(order, status))
+            self._sends.add(send)
+            send.add_done_callback(self._sends.discard)
+
+    async def _send(self, order, status):
+        try:
+            await self._notify(order, status)
+        except Exception:
+            logging.exception(f"Failed to notify about expired order {order['order_id']}")
+
+    async def _checked(self, order_id):
+        try:
+            await self._check(order_id)
+        except Exception:
+            logging.exception(f"Failed to expire order {order_id}")
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            due = []
+            while self._heap and self._heap[0][0] <= now and len(due) < self.BATCH_SIZE:
+                when, order_id = heapq.heappop(self._heap)
+                if self._timers.get(order_id) != when:
+                    continue  # Replaced or dropped timer
+                del self._timers[order_id]
+                self.lag = max(self.lag, now - when)
+                due.append(order_id)
+            if due:
+                # Reads overlap across pool connections; writes queue up behind the writer
+                await asyncio.gather(*(self._checked(order_id) for order_id in due))
+                continue
+
+            self._wakeup.clear()
+            delay = max(0, self._heap[0][0] - time.time()) if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self, notify=None):
+        """Set timers for all open orders and start the sweeper"""
+        self._notify = notify
+        for order in await self.storage.get_open_orders():
+            changed_at = order['status_changed_at'] or order['created_at']
+            self.track(order['order_id'], order['status'], _timestamp(changed_at))
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stop the sweeper and wait for notifications being sent"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._sends:
+            await asyncio.gather(*self._sends, return_exceptions=True)
+
+    def stats(self):
+        """Get live timers and expiry counters"""
+        return {
+            'timers': len(self._timers),
+            'heap': len(self._heap),
+            'checks': self.checks,
+            'expired': dict(self.expired),
+            'redispatched': self.redispatched,
+            'lag_max': self.lag
+        }
+
+
+# Shared instance, started with the bot
+order_expiry = OrderExpiry(db, order_dispatcher)
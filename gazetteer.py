@@ -0,0 +1,288 @@
+"""
+Offline gazetteer geocoder
+
+Addresses from a local CSV extract are compiled into one binary index file
+that is memory-mapped at startup, so opening it costs nothing regardless
+of its size and lookups only touch the pages they need.
+
+Build the index:
+    python gazetteer.py build addresses.csv gazetteer.idx
+
+The CSV needs a header with `street`, `house` (may be empty for stations,
+malls and other places without a house number), `lat` and `lon` columns;
+OSM-style `addr:street` and `addr:housenumber` names work too.
+
+Index layout (little-endian):
+    header           magic, version, address count N, street count M, variant count V
+    addr_offsets     (N + 1) x uint32, offsets of address keys in addr_blob
+    coords           N x 2 x float32, latitude and longitude
+    street_offsets   (M + 1) x uint32, offsets of street names in street_blob
+    variant_offsets  (V + 1) x uint32, offsets of spelling variants in variant_blob
+    variant_streets  V x uint32, street index of each variant
+    addr_blob        UTF-8 keys "street<TAB>house", sorted bytewise
+    street_blob      UTF-8 unique street names, sorted bytewise
+    variant_blob     UTF-8 street names with one letter deleted, sorted bytewise
+
+Misspelled streets are found with symmetric deletion: a name one edit away
+from an indexed street shares a one-deletion variant with it, so typos cost
+a few binary searches instead of a scan over all streets.
+"""
+import csv
+import mmap
+import struct
+import sys
+
+from geocache import normalize_address
+
+MAGIC = b'FDGZ'
+VERSION = 1
+HEADER = struct.Struct('<4sIIII')
+
+# Words that don't help to tell addresses apart: street types (users write
+# "Тверская улица" as often as "ул. Тверская"), "дом" and the city itself
+IGNORED_WORDS = {
+    'улица', 'проспект', 'переулок', 'площадь', 'шоссе', 'бульвар', 'набережная',
+    'проезд', 'тупик', 'аллея', 'дом', 'город', 'москва', 'россия'
+}
+
+# Short forms used inside house numbers: "1 корпус 2" -> "1к2"
+HOUSE_ABBREVIATIONS = {'корпус': 'к', 'строение': 'с', 'владение': 'вл'}
+
+
+def street_key(street):
+    """Normalize a street name the way it is stored in the index"""
+    return ' '.join(word for word in normalize_address(street).split() if word not in IGNORED_WORDS)
+
+
+def house_key(house):
+    """Normalize a house number: "д. 1, корп. 2" -> "1к2" """
+    words = normalize_address(house).split()
+    return ''.join(HOUSE_ABBREVIATIONS.get(word, word) for word in words if word not in IGNORED_WORDS)
+
+
+def split_address(address):
+    """Split free-form user input into (street, house) index keys"""
+    words = [word for word in normalize_address(address).split() if word not in IGNORED_WORDS]
+    # The house number starts at the first word with a digit, except for
+    # streets that start with one ("1-я тверская-ямская")
+    for i in range(1, len(words)):
+        if any(char.isdigit() for char in words[i]):
+            return ' '.join(words[:i]), house_key(' '.join(words[i:]))
+    return ' '.join(words), ''
+
+
+def _house_number(house):
+    """Leading number of a house key, for picking the nearest house"""
+    digits = ''
+    for char in house:
+        if not char.isdigit():
+            break
+        digits += char
+    return int(digits) if digits else 0
+
+
+def _edit_distance(a, b, limit):
+    """Levenshtein distance between a and b, or limit + 1 once it is certainly larger"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def _deletion_variants(name):
+    """The name itself and every way to delete one letter from it"""
+    return {name} | {name[:i] + name[i + 1:] for i in range(len(name))}
+
+
+def _pack_offsets(blobs):
+    """Pack the start offsets of concatenated byte strings, plus the total length"""
+    offsets = [0]
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+    return struct.pack(f'<{len(offsets)}I', *offsets)
+
+
+def build(csv_path, index_path):
+    """Compile a CSV address extract into an index file, returning the address count"""
+    entries = {}
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            street = street_key(row.get('street') or row.get('addr:street') or '')
+            if not street:
+                continue
+            house = house_key(row.get('house') or row.get('addr:housenumber') or '')
+            entries[f"{street}\t{house}".encode()] = (float(row['lat']), float(row['lon']))
+
+    keys = sorted(entries)
+    streets = sorted({key.split(b'\t', 1)[0] for key in keys})
+    variants = sorted(
+        (variant.encode(), street_id)
+        for street_id, street in enumerate(streets)
+        for variant in _deletion_variants(street.decode())
+    )
+
+    with open(index_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(keys), len(streets), len(variants)))
+        f.write(_pack_offsets(keys))
+        f.write(struct.pack(f'<{2 * len(keys)}f', *(value for key in keys for value in entries[key])))
+        f.write(_pack_offsets(streets))
+        f.write(_pack_offsets(variant for variant, _ in variants))
+        f.write(struct.pack(f'<{len(variants)}I', *(street_id for _, street_id in variants)))
+        f.write(b''.join(keys))
+        f.write(b''.join(streets))
+        f.write(b''.join(variant for variant, _ in variants))
+
+    return len(keys)
+
+
+class Gazetteer:
+    """Read-only view of a memory-mapped gazetteer index"""
+
+    def __init__(self, path):
+        if sys.byteorder != 'little':
+            raise RuntimeError("Gazetteer indexes are little-endian")
+
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.size, self.streets, self.variants = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            self._mmap.close()
+            raise ValueError(f"Not a gazetteer index (version {VERSION}): {path}")
+
+        # Typed views straight into the mapping, nothing is parsed or copied
+        view = memoryview(self._mmap)
+        pos = HEADER.size
+        self._addr_offsets = view[pos:pos + 4 * (self.size + 1)].cast('I')
+        pos += 4 * (self.size + 1)
+        self._coords = view[pos:pos + 8 * self.size].cast('f')
+        pos += 8 * self.size
+        self._street_offsets = view[pos:pos + 4 * (self.streets + 1)].cast('I')
+        pos += 4 * (self.streets + 1)
+        self._variant_offsets = view[pos:pos + 4 * (self.variants + 1)].cast('I')
+        pos += 4 * (self.variants + 1)
+        self._variant_streets = view[pos:pos + 4 * self.variants].cast('I')
+        pos += 4 * self.variants
+        self._addr_blob = view[pos:pos + self._addr_offsets[self.size]]
+        pos += self._addr_offsets[self.size]
+        self._street_blob = view[pos:pos + self._street_offsets[self.streets]]
+        pos += self._street_offsets[self.streets]
+        self._variant_blob = view[pos:pos + self._variant_offsets[self.variants]]
+        self._views = [
+            view, self._addr_offsets, self._coords, self._street_offsets, self._variant_offsets,
+            self._variant_streets, self._addr_blob, self._street_blob, self._variant_blob
+        ]
+
+    def close(self):
+        """Unmap the index"""
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        self._mmap.close()
+
+    def _address(self, i):
+        return bytes(self._addr_blob[self._addr_offsets[i]:self._addr_offsets[i + 1]])
+
+    def _street(self, i):
+        return bytes(self._street_blob[self._street_offsets[i]:self._street_offsets[i + 1]])
+
+    def _variant(self, i):
+        return bytes(self._variant_blob[self._variant_offsets[i]:self._variant_offsets[i + 1]])
+
+    @staticmethod
+    def _lower_bound(count, key_at, target):
+        """First index whose key is >= target"""
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key_at(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _coords_at(self, i):
+        # float32 keeps ~0.5 m, round away the noise of widening it
+        return (round(self._coords[2 * i], 6), round(self._coords[2 * i + 1], 6))
+
+    def _find_street(self, street):
+        """Resolve a possibly partial or misspelled street name to an indexed one"""
+        target = street.encode()
+        i = self._lower_bound(self.streets, self._street, target)
+        # Exact name, or the first street it is a prefix of ("тверск" -> "тверская")
+        if i < self.streets and self._street(i).startswith(target):
+            return self._street(i)
+
+        # Typos: streets sharing a one-deletion variant with the input
+        candidates = set()
+        for variant in _deletion_variants(street):
+            target = variant.encode()
+            j = self._lower_bound(self.variants, self._variant, target)
+            while j < self.variants and self._variant(j) == target:
+                candidates.add(self._variant_streets[j])
+                j += 1
+
+        best, best_distance = None, 3
+        for street_id in sorted(candidates):
+            candidate = self._street(street_id)
+            distance = _edit_distance(street, candidate.decode(), best_distance - 1)
+            if distance < best_distance:
+                best, best_distance = candidate, distance
+        return best
+
+    def lookup(self, address):
+        """
+        Get (latitude, longitude) for a free-form address, or None
+
+        Tries the exact street and house first, then a street prefix or the
+        closest spelling, then the nearest house number on that street.
+        """
+        street, house = split_address(address)
+        if not street:
+            return None
+
+        exact = f"{street}\t{house}".encode()
+        i = self._lower_bound(self.size, self._address, exact)
+        if i < self.size and self._address(i) == exact:
+            return self._coords_at(i)
+
+        matched = self._find_street(street)
+        if matched is None:
+            return None
+
+        # Houses of a street are contiguous: TAB sorts before any name character
+        prefix = matched + b'\t'
+        start = i = self._lower_bound(self.size, self._address, prefix)
+        if house:
+            exact = prefix + house.encode()
+            i = self._lower_bound(self.size, self._address, exact)
+            if i < self.size and self._address(i) == exact:
+                return self._coords_at(i)
+
+        # Nearest house number on the street
+        target = _house_number(house)
+        best, best_distance = None, None
+        i = start
+        while i < self.size:
+            key = self._address(i)
+            if not key.startswith(prefix):
+                break
+            distance = abs(_house_number(key[len(prefix):].decode()) - target)
+            if best is None or distance < best_distance:
+                best, best_distance = i, distance
+            i += 1
+        return self._coords_at(best) if best is not None else None
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4 or sys.argv[1] != "build":
+        raise SystemExit("Usage: python gazetteer.py build addresses.csv gazetteer.idx")
+    print(f"Indexed {build(sys.argv[2], sys.argv[3])} addresses")
@@ -1,56 +1,351 @@
+import asyncio
+import logging
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
 from geopy.distance import geodesic
 from geopy.geocoders import Nominatim
-import random  # For demo purposes
+
+from geocache import GeocodeCache, normalize_address
+from gazetteer import Gazetteer
+from routing import Router
+from travel_time import SpeedModel, CITY
+from db import db
+from config import (
+    GEOCODER_CONCURRENCY, GEOCODER_TIMEOUT, GEOCODER_DEADLINE, GEOCODE_PREFETCH_TTL, GAZETTEER_PATH, GAZETTEER_PRIMARY,
+    ROUTING_GRAPH_PATH
+)
+
+
+class RequestAbandoned(Exception):
+    """Raised to a handler whose geocoding was cancelled because the user left the flow"""
+
 
 class GeoService:
-    def __init__(self):
-        self.geolocator = Nominatim(user_agent="fifty_drive_bot")
-        
-    async def get_coordinates(self, address):
+    def __init__(self, geocoder=None, concurrency=GEOCODER_CONCURRENCY, timeout=GEOCODER_TIMEOUT, cache=None,
+                 gazetteer=None, gazetteer_primary=GAZETTEER_PRIMARY, speed_model=None, router=None,
+                 prefetch_ttl=GEOCODE_PREFETCH_TTL):
+        self.geolocator = geocoder or Nominatim(user_agent="fifty_drive_bot")
+        self.timeout = timeout
+        self.cache = cache or GeocodeCache()
+
+        # Offline index, either asked first or used when the geocoder fails
+        self.gazetteer = gazetteer
+        self.gazetteer_primary = gazetteer_primary
+
+        # Offline road graph for route distances; queries are CPU-bound and
+        # the router isn't thread-safe, so they run one at a time on their
+        # own thread, off the event loop
+        self.router = router
+        self._route_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="router")
+        self.route_timeouts = 0
+
+        # Ride speeds per hour of the week, learned by the storage engine
+        self.speed_model = speed_model or SpeedModel()
+
+        # The geocoder client is blocking, so it runs on its own threads and
+        # never stalls the event loop; the semaphore keeps requests queued in
+        # asyncio (where they can be cancelled) rather than in the executor
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="geocoder")
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+        # In-flight requests per user, cancelled when the user abandons the flow
+        self._user_tasks = defaultdict(set)
+        self._abandoned = set()
+
+        # Background lookups started as the user types addresses:
+        # user_id -> {slot: (address, task)}. Dropped once a quote used them,
+        # or `prefetch_ttl` seconds after they finished if it never came
+        self._prefetches = {}
+        self.prefetch_ttl = prefetch_ttl
+
+        # Normalized address -> [lookup task, number of waiters]
+        self._inflight = {}
+        self.shared_lookups = 0
+
+    async def init(self):
+        """Open the persistent geocode cache and map the offline gazetteer and road graph, if they were built"""
+        await self.cache.open()
+        if self.gazetteer is None and os.path.exists(GAZETTEER_PATH):
+            self.gazetteer = Gazetteer(GAZETTEER_PATH)
+            logging.info(f"Gazetteer mapped: {self.gazetteer.size} addresses")
+        if self.router is None and os.path.exists(ROUTING_GRAPH_PATH):
+            self.router = Router(ROUTING_GRAPH_PATH)
+            logging.info(f"Road graph mapped: {self.router.nodes} nodes, {self.router.edges} edges")
+
+    async def _geocode(self, address):
+        """Run one blocking geocoder request on the executor, bounded by concurrency and timeout"""
+        loop = asyncio.get_running_loop()
+        await self._semaphore.acquire()
+        try:
+            request = self._executor.submit(self.geolocator.geocode, address, timeout=self.timeout)
+        except BaseException:
+            self._semaphore.release()
+            raise
+        # The slot is freed when the thread is, not when the caller gives up:
+        # a timed out request keeps its thread busy, and later requests must
+        # wait here rather than in the executor's queue
+        request.add_done_callback(lambda _: self._release_slot(loop))
+        return await asyncio.wait_for(asyncio.wrap_future(request), self.timeout)
+
+    def _release_slot(self, loop):
+        """Free a geocoder slot from the thread that finished a request"""
+        try:
+            loop.call_soon_threadsafe(self._semaphore.release)
+        except RuntimeError:
+            pass  # The event loop is closed, nobody is waiting for the slot
+
+    async def get_coordinates(self, address, deadline=None):
         """
-        Get coordinates for an address
-        
-        Note: In a real implementation, this would use a proper geocoding service.
-        For demo purposes, we're using a simple geocoder or returning random coordinates.
+        Get coordinates for an address, or None if it can't be found
+
+        Concurrent callers asking for the same address share one lookup. A
+        caller that reaches `deadline` (event loop time) gets the fallback
+        while the shared lookup carries on for the others.
         """
+        if self.gazetteer_primary:
+            coords = self._lookup_offline(address)
+            if coords is not None:
+                return coords
+
+        key = normalize_address(address)
+        coords = await self.cache.get(key)
+        if coords is not None:
+            return coords
+
+        entry = self._inflight.get(key)
+        if entry is None:
+            entry = self._inflight[key] = [asyncio.ensure_future(self._resolve(address, key)), 0]
+            entry[0].add_done_callback(lambda _: self._forget_lookup(key, entry))
+        else:
+            self.shared_lookups += 1
+        task = entry[0]
+
+        entry[1] += 1
         try:
-            location = self.geolocator.geocode(address)
+            timeout = None if deadline is None else max(0, deadline - asyncio.get_running_loop().time())
+            # Shielded, so a caller giving up never cancels a lookup others wait for
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Geocoding missed the quote deadline: {address}")
+            return self._fallback(address)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not task.done():
+                # The last waiter left (e.g. the user abandoned the flow)
+                self._forget_lookup(key, entry)
+                task.cancel()
+
+    def _forget_lookup(self, key, entry):
+        """Drop a finished or abandoned lookup from the in-flight map"""
+        if self._inflight.get(key) is entry:
+            del self._inflight[key]
+
+    async def _resolve(self, address, key):
+        """Geocode an address that missed the cache"""
+        try:
+            location = await self._geocode(address)
             if location:
-                return (location.latitude, location.longitude)
+                coords = (location.latitude, location.longitude)
+                await self.cache.set(key, coords)
+                return coords
+        except asyncio.TimeoutError:
+            logging.warning(f"Geocoding timed out after {self.timeout}s: {address}")
         except Exception:
             pass
-            
-        # Fallback to random coordinates (for demo purposes only)
-        # In a real app, you would handle this differently
-        return (
-            55.755826 + random.uniform(-0.1, 0.1),  # Moscow center + random offset
-            37.617300 + random.uniform(-0.1, 0.1)
+
+        return self._fallback(address)
+
+    def _lookup_offline(self, address):
+        """Look an address up in the offline gazetteer, if one is mapped"""
+        return self.gazetteer.lookup(address) if self.gazetteer is not None else None
+
+    def _fallback(self, address):
+        """Coordinates to use when the geocoder fails: the offline gazetteer's, or None"""
+        if self.gazetteer_primary:
+            # Already missed the gazetteer before asking the geocoder
+            return None
+        return self._lookup_offline(address)
+
+    async def get_coordinates_batch(self, addresses, timeout=GEOCODER_DEADLINE, user_id=None):
+        """
+        Resolve several addresses concurrently under one shared deadline, in input order
+
+        Addresses the user's prefetches are already resolving are awaited
+        instead of being looked up again.
+        """
+        deadline = asyncio.get_running_loop().time() + timeout
+        lookups = []
+        used = []
+        for address in addresses:
+            prefetch = self._find_prefetch(user_id, address)
+            if prefetch is not None:
+                used.append(prefetch)
+                lookups.append(self._await_prefetch(prefetch, address, deadline))
+            else:
+                lookups.append(self.get_coordinates(address, deadline))
+        try:
+            return await asyncio.gather(*lookups)
+        finally:
+            # A quote asked again finds the addresses in the geocode cache
+            for task in used:
+                self._drop_prefetch(user_id, task)
+
+    async def calculate_distance(self, from_address, to_address, user_id=None):
+        """Calculate distance between two addresses in kilometers, or None if one can't be found"""
+        distance, _, _ = await self.calculate_route(from_address, to_address, user_id=user_id)
+        return distance
+
+    async def calculate_route(self, from_address, to_address, user_id=None, timeout=GEOCODER_DEADLINE):
+        """
+        Resolve two addresses and the distance between them in kilometers
+
+        Returns (distance, from_coords, to_coords); the distance is None
+        when either address can't be found. It is along roads when a road
+        graph is mapped, both points are on it and the route is found
+        within `timeout` seconds of the call, and a straight line otherwise.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        from_coords, to_coords = await self.get_coordinates_batch(
+            [from_address, to_address], timeout=timeout, user_id=user_id
         )
-        
-    async def calculate_distance(self, from_address, to_address):
-        """Calculate distance between two addresses in kilometers"""
-        from_coords = await self.get_coordinates(from_address)
-        to_coords = await self.get_coordinates(to_address)
-        
+        if from_coords is None or to_coords is None:
+            return None, from_coords, to_coords
+
+        if self.router is not None:
+            # Queries run one at a time, so a burst of quotes queues up here;
+            # waiting is bounded by what is left of the quote's deadline
+            query = loop.run_in_executor(self._route_executor, self.router.route, from_coords, to_coords)
+            try:
+                route = await asyncio.wait_for(query, max(0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                logging.warning(f"Routing missed the quote deadline: {from_address} -> {to_address}")
+                self.route_timeouts += 1
+                route = None
+            if route is not None:
+                return round(route[0], 2), from_coords, to_coords
+
         distance = geodesic(from_coords, to_coords).kilometers
-        return round(distance, 2)
-        
-    async def estimate_travel_time(self, distance, traffic_factor=1.2):
+        return round(distance, 2), from_coords, to_coords
+
+    def stats(self):
+        """Get geocode cache, in-flight lookup, prefetch and routing counters"""
+        stats = {
+            **self.cache.stats(),
+            'inflight': len(self._inflight),
+            'shared_lookups': self.shared_lookups,
+            'prefetches': sum(len(prefetches) for prefetches in self._prefetches.values())
+        }
+        if self.router is not None:
+            stats['routing'] = {**self.router.stats(), 'timeouts': self.route_timeouts}
+        return stats
+
+    async def run_for_user(self, user_id, coro):
+        """
+        Run a geocoding coroutine on behalf of a user
+
+        If cancel_user_requests() is called for the user meanwhile, the work
+        is cancelled and RequestAbandoned is raised to the caller.
+        """
+        task = asyncio.ensure_future(coro)
+        self._user_tasks[user_id].add(task)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if task in self._abandoned:
+                raise RequestAbandoned() from None
+            raise
+        finally:
+            self._abandoned.discard(task)
+            tasks = self._user_tasks.get(user_id)
+            if tasks is not None:
+                tasks.discard(task)
+                if not tasks:
+                    del self._user_tasks[user_id]
+
+    def prefetch(self, user_id, slot, address):
+        """
+        Start geocoding an address the user has just entered, in the background
+
+        `slot` names the field ('from', 'to'); a new address in the same slot
+        replaces and cancels the previous prefetch.
+        """
+        prefetches = self._prefetches.setdefault(user_id, {})
+        previous = prefetches.get(slot)
+        if previous is not None:
+            if previous[0] == address:
+                return
+            previous[1].cancel()
+        task = asyncio.ensure_future(self.get_coordinates(address))
+        prefetches[slot] = (address, task)
+        loop = asyncio.get_running_loop()
+        task.add_done_callback(lambda _: loop.call_later(self.prefetch_ttl, self._drop_prefetch, user_id, task))
+
+    def _drop_prefetch(self, user_id, task):
+        """Forget a prefetch, unless it was already replaced or dropped"""
+        prefetches = self._prefetches.get(user_id)
+        if prefetches is None:
+            return
+        for slot, (_, prefetched) in list(prefetches.items()):
+            if prefetched is task:
+                del prefetches[slot]
+        if not prefetches:
+            del self._prefetches[user_id]
+
+    def _find_prefetch(self, user_id, address):
+        """Get the user's prefetch task for an address, if there is a usable one"""
+        for prefetched_address, task in self._prefetches.get(user_id, {}).values():
+            if prefetched_address == address and not task.cancelled():
+                return task
+        return None
+
+    async def _await_prefetch(self, task, address, deadline):
+        """Wait for a prefetch until the deadline, falling back like a missed lookup"""
+        timeout = max(0, deadline - asyncio.get_running_loop().time())
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            return self._fallback(address)
+
+    def cancel_user_requests(self, user_id):
+        """Cancel all in-flight geocoding and prefetches of a user whose order flow ended"""
+        for task in self._user_tasks.pop(user_id, ()):
+            if not task.done():
+                self._abandoned.add(task)
+                task.cancel()
+        for _, task in self._prefetches.pop(user_id, {}).values():
+            task.cancel()
+
+    async def close(self):
+        """Stop the geocoder threads, close the cache and unmap the gazetteer and road graph"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        await self.cache.close()
+        if self.gazetteer is not None:
+            self.gazetteer.close()
+            self.gazetteer = None
+        if self.router is not None:
+            # A query still running reads the mapping, so let it finish
+            self._route_executor.shutdown(wait=True, cancel_futures=True)
+            self.router.close()
+            self.router = None
+
+    async def estimate_travel_time(self, distance, when=None, zone=CITY):
         """
         Estimate travel time in minutes based on distance
-        
+
         Args:
             distance: Distance in kilometers
-            traffic_factor: Traffic congestion factor (1.0 = no traffic)
-            
+            when: Local start time of the ride (default now)
+            zone: Zone of the ride, for models that have per-zone statistics
+
         Returns:
-            Estimated travel time in minutes
-        """
-        # Assume average speed of 40 km/h in city
-        avg_speed = 40
-        
-        # Calculate hours, then convert to minutes and apply traffic factor
-        hours = distance / avg_speed
-        minutes = hours * 60 * traffic_factor
-        
-        return round(minutes)
\ No newline at end of file
+            Estimated travel time in minutes, at least 1
+        """
+        # Average speed of completed rides at this hour of the week
+        return max(1, round(self.speed_model.estimate_minutes(distance, when, zone)))
+
+
+# Shared instance used by all routers, learning speeds from the shared database
+geo_service = GeoService(speed_model=db.speed_model)
@@ -0,0 +1,181 @@
+import re
+import time
+
+from cache import TTLCache, MISSING
+from db import connect
+from config import GEOCODE_CACHE_DB, GEOCODE_CACHE_SIZE, GEOCODE_CACHE_MEMORY_SIZE, GEOCODE_CACHE_TTL
+
+# Abbreviation (without the trailing dot) -> full word used in cache keys
+ADDRESS_ABBREVIATIONS = {
+    'ул': 'улица',
+    'пр': 'проспект',
+    'пр-т': 'проспект',
+    'просп': 'проспект',
+    'пер': 'переулок',
+    'пл': 'площадь',
+    'ш': 'шоссе',
+    'б-р': 'бульвар',
+    'бул': 'бульвар',
+    'наб': 'набережная',
+    'пр-д': 'проезд',
+    'г': 'город',
+    'д': 'дом',
+    'к': 'корпус',
+    'корп': 'корпус',
+    'стр': 'строение',
+    'м': 'метро',
+    'ст': 'станция',
+    'пос': 'поселок',
+}
+
+_SEPARATORS = re.compile(r'[\s,;"«»()]+')
+
+
+def normalize_address(address):
+    """
+    Reduce an address to the form used as a cache key
+
+    "Ул. Тверская,  д.1" and "улица тверская дом 1" give the same key.
+    """
+    address = address.lower().replace('ё', 'е')
+    # Split "ул.тверская" into "ул." and "тверская"
+    address = address.replace('.', '. ')
+
+    words = []
+    for word in _SEPARATORS.split(address):
+        word = word.rstrip('.')
+        if word:
+            words.append(ADDRESS_ABBREVIATIONS.get(word, word))
+    return ' '.join(words)
+
+
+class GeocodeCache:
+    """
+    Two-tier geocode cache: an in-memory LRU in front of a SQLite table
+
+    Keys are normalized addresses. Entries expire `ttl` seconds after they
+    were geocoded; beyond `maxsize` rows the least recently used ones are
+    evicted. Until open() is called only the memory tier is used.
+    """
+
+    def __init__(self, db_name=GEOCODE_CACHE_DB, maxsize=GEOCODE_CACHE_SIZE,
+                 memory_size=GEOCODE_CACHE_MEMORY_SIZE, ttl=GEOCODE_CACHE_TTL):
+        self.db_name = db_name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.memory = TTLCache(memory_size, ttl)
+        self._conn = None
+        self._rows = 0
+
+        # Metrics
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def open(self):
+        """Open the persistent tier and drop expired rows"""
+        if self._conn is not None:
+            return
+
+        self._conn = await connect(self.db_name, isolation_level=None)
+        await self._conn.execute("""
+        CREATE TABLE IF NOT EXISTS geocode_cache (
+            address TEXT PRIMARY KEY,
+            latitude REAL NOT NULL,
+            longitude REAL NOT NULL,
+            created_at REAL NOT NULL,
+            used_at REAL NOT NULL
+        ) WITHOUT ROWID
+        """)
+        await self._conn.execute("CREATE INDEX IF NOT EXISTS idx_geocode_cache_used ON geocode_cache(used_at)")
+        await self._conn.execute("DELETE FROM geocode_cache WHERE created_at < ?", (time.time() - self.ttl,))
+
+        async with self._conn.execute("SELECT COUNT(*) FROM geocode_cache") as cursor:
+            self._rows = (await cursor.fetchone())[0]
+
+    async def close(self):
+        """Close the persistent tier"""
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+    async def get(self, key):
+        """Get cached (latitude, longitude) for a normalized address, or None"""
+        coords = self.memory.get(key)
+        if coords is not MISSING:
+            return coords
+        if self._conn is None:
+            self.misses += 1
+            return None
+
+        now = time.time()
+        async with self._conn.execute(
+            "SELECT latitude, longitude, created_at FROM geocode_cache WHERE address = ?", (key,)
+        ) as cursor:
+            row = await cursor.fetchone()
+
+        if row is None or row['created_at'] < now - self.ttl:
+            self.misses += 1
+            return None
+
+        # Recency is only tracked on disk hits, memory hits never touch the table
+        await self._conn.execute("UPDATE geocode_cache SET used_at = ? WHERE address = ?", (now, key))
+        self.disk_hits += 1
+
+        # The memory tier keeps it only for what is left of the row's lifetime
+        coords = (row['latitude'], row['longitude'])
+        self.memory.set(key, coords, ttl=row['created_at'] + self.ttl - now)
+        return coords
+
+    async def set(self, key, coords):
+        """Cache coordinates for a normalized address"""
+        self.memory.set(key, coords)
+        if self._conn is None:
+            return
+
+        now = time.time()
+        await self._conn.execute("""
+        INSERT INTO geocode_cache (address, latitude, longitude, created_at, used_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(address) DO UPDATE SET
+            latitude = excluded.latitude,
+            longitude = excluded.longitude,
+            created_at = excluded.created_at,
+            used_at = excluded.used_at
+        """, (key, coords[0], coords[1], now, now))
+        # Overcounts refreshed keys, _evict() recounts before deleting anything
+        self._rows += 1
+
+        if self._rows > self.maxsize:
+            await self._evict()
+
+    async def _evict(self):
+        """Drop the least recently used rows, with some headroom so this runs rarely"""
+        async with self._conn.execute("SELECT COUNT(*) FROM geocode_cache") as cursor:
+            self._rows = (await cursor.fetchone())[0]
+        if self._rows <= self.maxsize:
+            return
+
+        excess = self._rows - int(self.maxsize * 0.9)
+        cursor = await self._conn.execute("""
+        DELETE FROM geocode_cache WHERE address IN (
+            SELECT address FROM geocode_cache ORDER BY used_at LIMIT ?
+        )
+        """, (excess,))
+        self.evictions += cursor.rowcount
+        self._rows -= cursor.rowcount
+        await cursor.close()
+
+    def stats(self):
+        """Get hit/miss counters of both tiers"""
+        memory = self.memory.stats()
+        lookups = memory['hits'] + self.disk_hits + self.misses
+        return {
+            'memory_size': memory['size'],
+            'disk_size': self._rows,
+            'memory_hits': memory['hits'],
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (memory['hits'] + self.disk_hits) / lookups if lookups else 0,
+            'evictions': memory['evictions'] + self.evictions
+        }
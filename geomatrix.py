@@ -0,0 +1,82 @@
+"""
+Vectorized distance kernels for ranking many points against many points
+
+Coordinates are (latitude, longitude) pairs in degrees, passed as any
+array-like of shape (n, 2). Distances are in kilometers. Within a city both
+kernels stay within a fraction of a percent of geopy's geodesic distance
+(see benchmarks/distance_kernels.py), which is plenty for ranking drivers,
+while fares keep using GeoService.calculate_distance.
+"""
+import numpy as np
+
+# Mean Earth radius (IUGG)
+EARTH_RADIUS_KM = 6371.0088
+
+
+def _radians(coords):
+    """Convert (n, 2) degrees to latitude and longitude columns in radians"""
+    coords = np.radians(np.asarray(coords, dtype=np.float64).reshape(-1, 2))
+    return coords[:, 0], coords[:, 1]
+
+
+def haversine_matrix(origins, destinations):
+    """Great-circle distance from every origin (rows) to every destination (columns)"""
+    lat1, lon1 = _radians(origins)
+    lat2, lon2 = _radians(destinations)
+
+    dlat = lat2[np.newaxis, :] - lat1[:, np.newaxis]
+    dlon = lon2[np.newaxis, :] - lon1[:, np.newaxis]
+    a = np.sin(dlat / 2) ** 2 + np.outer(np.cos(lat1), np.cos(lat2)) * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def equirectangular_matrix(origins, destinations):
+    """
+    Flat-Earth approximation of haversine_matrix
+
+    Cheaper because there is no trigonometry per pair: longitudes are
+    scaled by the cosine of the origin's latitude. The error grows with
+    distance but stays negligible across a city.
+    """
+    lat1, lon1 = _radians(origins)
+    lat2, lon2 = _radians(destinations)
+
+    x = (lon2[np.newaxis, :] - lon1[:, np.newaxis]) * np.cos(lat1)[:, np.newaxis]
+    y = lat2[np.newaxis, :] - lat1[:, np.newaxis]
+    return EARTH_RADIUS_KM * np.sqrt(x * x + y * y)
+
+
+def top_k(distances, k, max_km=None):
+    """
+    Nearest `k` columns of each row of a distance matrix
+
+    Returns (indices, distances), both of shape (rows, k) and sorted by
+    distance. Columns beyond `max_km`, or missing when a row has fewer than
+    k columns, get index -1 and distance inf.
+    """
+    distances = np.asarray(distances, dtype=np.float64)
+    rows, columns = distances.shape
+    if max_km is not None:
+        distances = np.where(distances <= max_km, distances, np.inf)
+
+    take = min(k, columns)
+    if take < columns:
+        # O(columns) partial selection per row, then sort only the k winners
+        indices = np.argpartition(distances, take - 1, axis=1)[:, :take]
+    else:
+        indices = np.broadcast_to(np.arange(columns), (rows, columns))
+    nearest = np.take_along_axis(distances, indices, axis=1)
+    order = np.argsort(nearest, axis=1, kind='stable')
+    indices = np.take_along_axis(indices, order, axis=1)
+    nearest = np.take_along_axis(nearest, order, axis=1)
+
+    result_indices = np.full((rows, k), -1, dtype=np.int64)
+    result_distances = np.full((rows, k), np.inf)
+    result_indices[:, :take] = np.where(np.isinf(nearest), -1, indices)
+    result_distances[:, :take] = nearest
+    return result_indices, result_distances
+
+
+def nearest(origins, destinations, k, max_km=None, kernel=haversine_matrix):
+    """Top-k nearest destinations for every origin, see top_k()"""
+    return top_k(kernel(origins, destinations), k, max_km)
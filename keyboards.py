@@ -74,23 +74,26 @@ def get_driver_order_actions(order_id):
     ))
     return builder.as_markup()
 
-def get_active_order_keyboard(role, status):
+def get_active_order_keyboard(role, status, order_id):
     """Keyboard for active order actions"""
     builder = InlineKeyboardBuilder()
     
     if role == 'passenger':
-        builder.row(InlineKeyboardButton(text="❌ Отменить заказ", callback_data="cancel_active_order"))
+        builder.row(InlineKeyboardButton(text="❌ Отменить заказ", callback_data=f"cancel_active_order_{order_id}"))
         if status == 'completed':
             builder.row(InlineKeyboardButton(text="⭐ Оценить поездку", callback_data="rate_driver"))
     
     elif role == 'driver':
         if status == 'accepted':
-            builder.row(InlineKeyboardButton(text="🚗 Выехал", callback_data="driver_started"))
-            builder.row(InlineKeyboardButton(text="🏁 Прибыл", callback_data="driver_arrived"))
+            builder.row(InlineKeyboardButton(text="🚗 Выехал", callback_data=f"driver_started_{order_id}"))
+            builder.row(InlineKeyboardButton(text="🏁 Прибыл", callback_data=f"driver_arrived_{order_id}"))
         elif status == 'driver_started':
-            builder.row(InlineKeyboardButton(text="🏁 Прибыл", callback_data="driver_arrived"))
+            builder.row(InlineKeyboardButton(text="🏁 Прибыл", callback_data=f"driver_arrived_{order_id}"))
         elif status == 'driver_arrived':
-            builder.row(InlineKeyboardButton(text="🏁 Завершить поездку", callback_data="complete_order"))
+            builder.row(InlineKeyboardButton(text="🚕 Начать поездку", callback_data=f"start_ride_{order_id}"))
+            builder.row(InlineKeyboardButton(text="🏁 Завершить поездку", callback_data=f"complete_order_{order_id}"))
+        elif status == 'in_progress':
+            builder.row(InlineKeyboardButton(text="🏁 Завершить поездку", callback_data=f"complete_order_{order_id}"))
         elif status == 'completed':
             builder.row(InlineKeyboardButton(text="⭐ Оценить пассажира", callback_data="rate_passenger"))
     
@@ -126,8 +129,24 @@ def get_earnings_period_keyboard():
     builder.row(InlineKeyboardButton(text="◀️ Назад в меню", callback_data="back_to_menu"))
     return builder.as_markup()
 
-def get_history_keyboard():
-    """Keyboard for order history"""
+def get_history_keyboard(role, newer_cursor=None, older_cursor=None):
+    """Keyboard for order history with keyset page navigation"""
     builder = InlineKeyboardBuilder()
+    
+    # Cursors are (created_at, order_id) of the first / last order on the page
+    buttons = []
+    if newer_cursor:
+        buttons.append(InlineKeyboardButton(
+            text="⬅️ Новее",
+            callback_data=f"history_{role}_newer_{newer_cursor[0]}_{newer_cursor[1]}"
+        ))
+    if older_cursor:
+        buttons.append(InlineKeyboardButton(
+            text="Раньше ➡️",
+            callback_data=f"history_{role}_older_{older_cursor[0]}_{older_cursor[1]}"
+        ))
+    if buttons:
+        builder.row(*buttons)
+    
     builder.row(InlineKeyboardButton(text="◀️ Назад в меню", callback_data="back_to_menu"))
-    return builder.as_markup()
\ No newline at end of file
+    return builder.as_markup()
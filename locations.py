@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import time
+from array import array
+
+from db import db
+from config import LOCATION_FLUSH_INTERVAL, LOCATION_HISTORY_SIZE
+
+
+class FixRing:
+    """Last few location fixes of one driver, packed as (timestamp, lat, lon) doubles"""
+
+    __slots__ = ('_values', '_next', 'count')
+
+    def __init__(self, size):
+        self._values = array('d', bytes(3 * 8 * size))
+        self._next = 0
+        self.count = 0
+
+    def append(self, timestamp, lat, lon):
+        """Add a fix, overwriting the oldest one when full"""
+        i = 3 * self._next
+        self._values[i:i + 3] = array('d', (timestamp, lat, lon))
+        self._next = (self._next + 1) % (len(self._values) // 3)
+        self.count = min(self.count + 1, len(self._values) // 3)
+
+    def latest(self):
+        """Newest (timestamp, lat, lon), or None"""
+        if not self.count:
+            return None
+        i = 3 * ((self._next - 1) % (len(self._values) // 3))
+        return tuple(self._values[i:i + 3])
+
+    def fixes(self):
+        """All stored fixes, oldest first"""
+        size = len(self._values) // 3
+        start = (self._next - self.count) % size
+        return [tuple(self._values[3 * ((start + n) % size):3 * ((start + n) % size) + 3]) for n in range(self.count)]
+
+
+class LocationBuffer:
+    """
+    Driver locations from Telegram, kept in memory and persisted in batches
+
+    Every fix updates the storage's driver index immediately, so nearest
+    driver queries see it at once. The database only gets the latest fix of
+    each driver that moved, in one write every `flush_interval` seconds, so
+    the number of commits doesn't grow with the update rate.
+    """
+
+    def __init__(self, storage, flush_interval=LOCATION_FLUSH_INTERVAL, history_size=LOCATION_HISTORY_SIZE):
+        self.storage = storage
+        self.flush_interval = flush_interval
+        self.history_size = history_size
+        self._rings = {}  # driver_id -> FixRing
+        self._dirty = set()  # Drivers with fixes not yet persisted
+        self._task = None
+
+        # Metrics
+        self.received = 0
+        self.stale = 0
+        self.flushes = 0
+        self.persisted = 0
+
+    def record(self, driver_id, lat, lon, timestamp=None):
+        """Take a fix; returns False if it is older than the newest one already seen"""
+        if timestamp is None:
+            timestamp = time.time()
+        self.received += 1
+
+        ring = self._rings.get(driver_id)
+        if ring is None:
+            ring = self._rings[driver_id] = FixRing(self.history_size)
+        else:
+            # Edited live locations can arrive out of order
+            latest = ring.latest()
+            if latest is not None and timestamp < latest[0]:
+                self.stale += 1
+                return False
+
+        ring.append(timestamp, lat, lon)
+        self._dirty.add(driver_id)
+        self.storage.driver_index.move(driver_id, lat, lon)
+        return True
+
+    def latest(self, driver_id):
+        """Newest (timestamp, lat, lon) of a driver, or None"""
+        ring = self._rings.get(driver_id)
+        return ring.latest() if ring is not None else None
+
+    def track(self, driver_id):
+        """Recent (timestamp, lat, lon) fixes of a driver, oldest first"""
+        ring = self._rings.get(driver_id)
+        return ring.fixes() if ring is not None else []
+
+    async def flush(self):
+        """Persist the latest fix of every driver that moved since the last flush"""
+        if not self._dirty:
+            return 0
+
+        dirty, self._dirty = self._dirty, set()
+        locations = [(driver_id, *self._rings[driver_id].latest()[1:]) for driver_id in dirty]
+        try:
+            await self.storage.update_driver_locations(locations)
+        except Exception:
+            logging.exception("Failed to persist driver locations, will retry")
+            self._dirty |= dirty
+            return 0
+
+        self.flushes += 1
+        self.persisted += len(locations)
+        return len(locations)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        """Start the periodic flush"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stop the periodic flush and persist what is left"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self):
+        """Get ingestion and persistence counters"""
+        return {
+            'drivers': len(self._rings),
+            'received': self.received,
+            'stale': self.stale,
+            'pending': len(self._dirty),
+            'flushes': self.flushes,
+            'persisted': self.persisted
+        }
+
+
+# Shared instance fed by the driver router
+location_buffer = LocationBuffer(db)
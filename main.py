@@ -1,4 +1,5 @@
 import asyncio
+import functools
 import logging
 from aiogram import Bot, Dispatcher
 from aiogram.fsm.storage.memory import MemoryStorage
@@ -6,11 +7,15 @@ from aiogram.types import BotCommand
 
 # Import local modules
 from config import BOT_TOKEN
-from db import Database
+from db import db
+from geo import geo_service
+from locations import location_buffer
+from dispatch import order_dispatcher
+from expiry import order_expiry
 from registration import router as reg_router
 from passenger import router as passenger_router
-from driver import router as driver_router
-from common import router as common_router
+from driver import router as driver_router, send_order_offer
+from common import router as common_router, send_order_expired
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -31,9 +36,12 @@ async def main():
     storage = MemoryStorage()
     dp = Dispatcher(storage=storage)
 
-    # Initialize database
-    db = Database()
+    # Open the shared database connection pool once for all routers
     await db.init()
+    await geo_service.init()
+    location_buffer.start()
+    await order_dispatcher.start(functools.partial(send_order_offer, bot))
+    await order_expiry.start(functools.partial(send_order_expired, bot))
 
     # Register routers
     dp.include_router(common_router)
@@ -45,8 +53,15 @@ async def main():
     await set_commands(bot)
 
     # Start polling
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    try:
+        await bot.delete_webhook(drop_pending_updates=True)
+        await dp.start_polling(bot)
+    finally:
+        await order_expiry.close()
+        await order_dispatcher.close()
+        await location_buffer.close()
+        await geo_service.close()
+        await db.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,346 @@
+import bisect
+import datetime
+from collections import defaultdict
+
+from storage import StorageEngine, rating_weight, validate_transition, earnings_period_start
+from travel_time import ride_sample
+from config import RATING_USE_DECAY
+
+FINAL_STATUSES = ('completed', 'cancelled')
+
+
+def _utc_timestamp():
+    """Current UTC time in the format of SQLite's CURRENT_TIMESTAMP"""
+    return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class MemoryDatabase(StorageEngine):
+    """
+    Pure in-memory storage engine for load tests, benchmarks and ephemeral bots
+
+    Tables are dicts keyed by primary key, with hand-maintained indexes for
+    the hot queries. Every method completes without awaiting, so each one is
+    atomic with respect to other coroutines on the event loop.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.users = {}
+        self.drivers = {}
+        self.orders = {}
+        self.ratings = []
+        self.order_declines = {}  # (order_id, driver_id) -> declined_at
+        self._next_order_id = 1
+
+        # Indexes
+        self._available_drivers = {}  # Insertion-ordered set of driver IDs
+        self._history = {'passenger_id': defaultdict(list), 'driver_id': defaultdict(list)}  # Sorted (created_at, order_id)
+        self._active = {'passenger_id': defaultdict(set), 'driver_id': defaultdict(set)}
+        self._completed_counts = defaultdict(int)  # (field, user_id) -> count
+        self._daily_earnings = defaultdict(dict)  # driver_id -> {day: [amount, rides]}
+
+    async def init(self):
+        """Nothing to open, the engine lives in process memory"""
+
+    async def close(self):
+        """Nothing to flush"""
+
+    # User management
+    async def register_user(self, user_id, role, full_name, phone):
+        """Register a new user, replacing an existing one like INSERT OR REPLACE"""
+        if full_name is None or phone is None or role is None:
+            raise ValueError("role, full_name and phone are required")
+        self.users[user_id] = {
+            'user_id': user_id,
+            'role': role,
+            'full_name': full_name,
+            'phone': phone,
+            'rating': 5.0,
+            'registered_at': _utc_timestamp(),
+            'rating_sum': 0.0,
+            'rating_count': 0,
+            'rating_decay_sum': 0.0,
+            'rating_decay_weight': 0.0
+        }
+        self.order_book.update_passenger(user_id, full_name, phone, self.users[user_id]['rating'])
+
+    async def register_driver(self, user_id, car_model, car_number):
+        """Register driver details, replacing existing ones like INSERT OR REPLACE"""
+        if car_model is None or car_number is None:
+            raise ValueError("car_model and car_number are required")
+        self.drivers[user_id] = {
+            'user_id': user_id,
+            'car_model': car_model,
+            'car_number': car_number,
+            'status': 'available',
+            'total_earnings': 0,
+            'latitude': None,
+            'longitude': None,
+            'location_updated_at': None
+        }
+        self._available_drivers[user_id] = None
+        self.driver_index.remove(user_id)
+        self.driver_index.set_available(user_id, True)
+
+    async def get_user(self, user_id):
+        """Get user data by ID"""
+        user = self.users.get(user_id)
+        return dict(user) if user else None
+
+    async def get_driver(self, user_id):
+        """Get driver data by ID"""
+        driver = self.drivers.get(user_id)
+        return dict(driver) if driver else None
+
+    async def get_available_drivers(self):
+        """Get all available drivers"""
+        return [
+            {**self.users[user_id], **self.drivers[user_id]}
+            for user_id in self._available_drivers
+            if user_id in self.users
+        ]
+
+    def _set_driver_status(self, user_id, status):
+        """Update a driver's status and the available drivers index"""
+        driver = self.drivers.get(user_id)
+        if not driver:
+            return
+        driver['status'] = status
+        if status == 'available':
+            self._available_drivers[user_id] = None
+        else:
+            self._available_drivers.pop(user_id, None)
+        self.driver_index.set_available(user_id, status == 'available')
+
+    async def update_driver_status(self, user_id, status):
+        """Update driver status"""
+        self._set_driver_status(user_id, status)
+
+    async def update_driver_locations(self, locations):
+        """Store current locations of many drivers"""
+        now = _utc_timestamp()
+        for user_id, latitude, longitude in locations:
+            driver = self.drivers.get(user_id)
+            if not driver:
+                continue
+            driver['latitude'] = latitude
+            driver['longitude'] = longitude
+            driver['location_updated_at'] = now
+            self.driver_index.move(user_id, latitude, longitude)
+
+    async def update_user_rating(self, user_id, new_rating):
+        """Update user rating"""
+        user = self.users.get(user_id)
+        if user:
+            user['rating'] = new_rating
+            self.order_book.update_passenger(user_id, user['full_name'], user['phone'], new_rating)
+
+    # Order management
+    async def create_order(self, passenger_id, from_address, to_address, ride_class, distance, estimated_cost,
+                           pickup=None):
+        """Create a new order"""
+        order_id = self._next_order_id
+        self._next_order_id += 1
+        pickup_latitude, pickup_longitude = pickup or (None, None)
+        created_at = _utc_timestamp()
+
+        order = {
+            'order_id': order_id,
+            'passenger_id': passenger_id,
+            'driver_id': None,
+            'from_address': from_address,
+            'to_address': to_address,
+            'ride_class': ride_class,
+            'distance': distance,
+            'estimated_cost': estimated_cost,
+            'actual_cost': None,
+            'status': 'pending',
+            'created_at': created_at,
+            'started_at': None,
+            'completed_at': None,
+            'passenger_rating': None,
+            'driver_rating': None,
+            'pickup_latitude': pickup_latitude,
+            'pickup_longitude': pickup_longitude,
+            'status_changed_at': created_at
+        }
+        self.orders[order_id] = order
+
+        passenger = self.users.get(passenger_id)
+        if passenger:
+            self.order_book.add(order, passenger)
+        self._index_order_user(order, 'passenger_id')
+        return order_id
+
+    def _index_order_user(self, order, field):
+        """Add an order to the history and active indexes of its passenger or driver"""
+        history = self._history[field][order[field]]
+        bisect.insort(history, (order['created_at'], order['order_id']))
+        if order['status'] not in FINAL_STATUSES:
+            self._active[field][order[field]].add(order['order_id'])
+
+    async def get_order(self, order_id):
+        """Get order by ID"""
+        order = self.orders.get(order_id)
+        return dict(order) if order else None
+
+    async def get_active_order(self, user_id, role='passenger'):
+        """Get active order for a user"""
+        field = 'passenger_id' if role == 'passenger' else 'driver_id'
+        active = self._active[field].get(user_id)
+        if not active:
+            return None
+        newest = max(active, key=lambda order_id: (self.orders[order_id]['created_at'], order_id))
+        return dict(self.orders[newest])
+
+    async def get_open_orders(self):
+        """Get all orders that are not completed or cancelled"""
+        return [
+            dict(self.orders[order_id])
+            for active in self._active['passenger_id'].values()
+            for order_id in active
+        ]
+
+    async def record_decline(self, order_id, driver_id):
+        """Record a driver's decline of a pending order, once per order"""
+        if (order_id, driver_id) in self.order_declines:
+            return
+        self.order_declines[(order_id, driver_id)] = _utc_timestamp()
+        self.declines.record(order_id, driver_id)
+
+    async def accept_order(self, order_id, driver_id):
+        """Driver accepts an order, returning it or None if it is no longer pending"""
+        order = self.orders.get(order_id)
+        if not order or order['status'] != 'pending':
+            return None
+
+        order['driver_id'] = driver_id
+        order['status'] = 'accepted'
+        order['status_changed_at'] = _utc_timestamp()
+        self.order_book.remove(order_id)
+        self._index_order_user(order, 'driver_id')
+
+        self._set_driver_status(driver_id, 'busy')
+        self.declines.forget_order(order_id)
+        self.declines.record_accept(driver_id)
+        return dict(order)
+
+    async def transition_order(self, order_id, actor_id, from_states, to_state, actual_cost=None,
+                               driver_status='available'):
+        """Move an order from one of `from_states` to `to_state`, returning the new row or None"""
+        from_states = validate_transition(from_states, to_state)
+
+        order = self.orders.get(order_id)
+        if not order or order['status'] not in from_states:
+            return None
+        if actor_id is not None and actor_id not in (order['passenger_id'], order['driver_id']):
+            return None
+
+        now = datetime.datetime.now().isoformat()
+        order['status'] = to_state
+        order['status_changed_at'] = _utc_timestamp()
+        if to_state == 'in_progress':
+            order['started_at'] = now
+        elif to_state == 'completed':
+            order['completed_at'] = now
+            # Use estimated cost if actual cost is not provided
+            order['actual_cost'] = actual_cost if actual_cost is not None else order['estimated_cost']
+
+        if to_state in FINAL_STATUSES:
+            self.order_book.remove(order_id)
+            for field in ('passenger_id', 'driver_id'):
+                active = self._active[field].get(order[field])
+                if active:
+                    active.discard(order_id)
+
+        # Release the driver
+        driver = self.drivers.get(order['driver_id'])
+        if to_state == 'completed':
+            for field in ('passenger_id', 'driver_id'):
+                self._completed_counts[(field, order[field])] += 1
+            if driver:
+                driver['total_earnings'] += order['actual_cost']
+            self._add_earnings(order['driver_id'], order['completed_at'][:10], order['actual_cost'])
+            self._set_driver_status(order['driver_id'], 'available')
+            sample = ride_sample(order)
+            if sample is not None:
+                self.speed_model.add(*sample)
+        elif to_state == 'cancelled':
+            self.declines.forget_order(order_id)
+            if order['driver_id']:
+                self._set_driver_status(order['driver_id'], driver_status)
+
+        return dict(order)
+
+    async def get_order_history(self, user_id, role='passenger', limit=10, before=None, after=None):
+        """Get a keyset page of order history for a user, newest first"""
+        field = 'passenger_id' if role == 'passenger' else 'driver_id'
+        keys = self._history[field].get(user_id, [])
+
+        if after is not None:
+            start = bisect.bisect_right(keys, tuple(after))
+            page = keys[start:start + limit]
+        else:
+            end = bisect.bisect_left(keys, tuple(before)) if before is not None else len(keys)
+            page = keys[max(0, end - limit):end]
+
+        return [dict(self.orders[order_id]) for _, order_id in reversed(page)]
+
+    # Rating management
+    async def add_rating(self, order_id, from_user_id, to_user_id, rating, comment=None):
+        """Add a rating for a user and update their running averages"""
+        weight = rating_weight()
+        self.ratings.append({
+            'rating_id': len(self.ratings) + 1,
+            'order_id': order_id,
+            'from_user_id': from_user_id,
+            'to_user_id': to_user_id,
+            'rating': rating,
+            'comment': comment,
+            'created_at': _utc_timestamp()
+        })
+
+        order = self.orders.get(order_id)
+        if order:
+            field = 'passenger_rating' if order['passenger_id'] == to_user_id else 'driver_rating'
+            order[field] = rating
+
+        user = self.users.get(to_user_id)
+        if user:
+            user['rating_sum'] += rating
+            user['rating_count'] += 1
+            user['rating_decay_sum'] += rating * weight
+            user['rating_decay_weight'] += weight
+            if RATING_USE_DECAY:
+                user['rating'] = user['rating_decay_sum'] / user['rating_decay_weight']
+            else:
+                user['rating'] = user['rating_sum'] / user['rating_count']
+            self.order_book.update_passenger(to_user_id, user['full_name'], user['phone'], user['rating'])
+
+    # Statistics
+    def _add_earnings(self, driver_id, day, amount):
+        """Add a completed ride to the driver's daily rollup"""
+        rollup = self._daily_earnings[driver_id].setdefault(day, [0, 0])
+        rollup[0] += amount or 0
+        rollup[1] += 1
+
+    async def get_driver_earnings(self, driver_id, period=None):
+        """Get driver earnings from the daily rollups"""
+        start_day = earnings_period_start(period)
+        total = 0
+        for day, (amount, _) in self._daily_earnings.get(driver_id, {}).items():
+            if start_day is None or day >= start_day:
+                total += amount
+        return total
+
+    async def backfill_earnings(self):
+        """Rebuild the daily earnings rollups from completed orders"""
+        self._daily_earnings.clear()
+        for order in self.orders.values():
+            if order['status'] == 'completed' and order['driver_id'] is not None and order['completed_at']:
+                self._add_earnings(order['driver_id'], order['completed_at'][:10], order['actual_cost'])
+
+    async def get_completed_orders_count(self, user_id, role='driver'):
+        """Get count of completed orders"""
+        field = 'driver_id' if role == 'driver' else 'passenger_id'
+        return self._completed_counts[(field, user_id)]
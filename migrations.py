@@ -0,0 +1,247 @@
+import datetime
+import logging
+
+from storage import rating_weight
+from travel_time import ride_sample, sample_keys
+
+
+async def _backfill_rating_aggregates(conn):
+    """Fill rating aggregates from the existing ratings table"""
+    totals = {}
+    async with conn.execute("SELECT to_user_id, rating, created_at FROM ratings") as cursor:
+        async for row in cursor:
+            created_at = datetime.datetime.fromisoformat(row[2]).replace(tzinfo=datetime.timezone.utc)
+            weight = rating_weight(created_at.timestamp())
+            total = totals.setdefault(row[0], [0, 0, 0, 0])
+            total[0] += row[1]
+            total[1] += 1
+            total[2] += row[1] * weight
+            total[3] += weight
+
+    await conn.executemany(
+        "UPDATE users SET rating_sum = ?, rating_count = ?, rating_decay_sum = ?, rating_decay_weight = ? WHERE user_id = ?",
+        [(*total, user_id) for user_id, total in totals.items()]
+    )
+
+
+async def backfill_driver_earnings(conn):
+    """Rebuild the daily earnings rollups from completed orders"""
+    # Summed here rather than with GROUP BY over a date expression, which
+    # no index covers and would sort every completed order in a temp b-tree
+    totals = {}
+    async with conn.execute(
+        "SELECT driver_id, completed_at, actual_cost FROM orders "
+        "WHERE status = 'completed' AND driver_id IS NOT NULL AND completed_at IS NOT NULL"
+    ) as cursor:
+        async for row in cursor:
+            # completed_at is stored in local time, so its date prefix is the local day
+            total = totals.setdefault((row[0], row[1][:10]), [0, 0])
+            total[0] += row[2] or 0
+            total[1] += 1
+
+    await conn.execute("DELETE FROM driver_daily_earnings")
+    await conn.executemany(
+        "INSERT INTO driver_daily_earnings (driver_id, day, amount, rides) VALUES (?, ?, ?, ?)",
+        [(*key, *total) for key, total in totals.items()]
+    )
+
+
+async def _backfill_travel_speeds(conn):
+    """Fill the travel speed statistics from completed rides"""
+    totals = {}
+    async with conn.execute(
+        "SELECT started_at, completed_at, distance FROM orders WHERE status = 'completed' AND started_at IS NOT NULL"
+    ) as cursor:
+        async for row in cursor:
+            sample = ride_sample({'started_at': row[0], 'completed_at': row[1], 'distance': row[2]})
+            if sample is None:
+                continue
+            hour, zone, distance, hours = sample
+            for key in sample_keys(hour, zone):
+                total = totals.setdefault(key, [0, 0, 0])
+                total[0] += distance
+                total[1] += hours
+                total[2] += 1
+
+    await conn.executemany(
+        "INSERT INTO travel_speed_stats (hour_of_week, zone, distance_km, hours, rides) VALUES (?, ?, ?, ?, ?)",
+        [(*key, *total) for key, total in totals.items()]
+    )
+
+
+# Schema migrations, applied in order. The current version is stored in
+# PRAGMA user_version, so every migration runs exactly once per database.
+# Never edit a released migration: append a new one instead.
+MIGRATIONS = [
+    (1, "Base schema", [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            role TEXT NOT NULL,
+            full_name TEXT NOT NULL,
+            phone TEXT NOT NULL,
+            rating REAL DEFAULT 5.0,
+            registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS drivers (
+            user_id INTEGER PRIMARY KEY,
+            car_model TEXT NOT NULL,
+            car_number TEXT NOT NULL,
+            status TEXT DEFAULT 'available',
+            total_earnings REAL DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS orders (
+            order_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            passenger_id INTEGER NOT NULL,
+            driver_id INTEGER,
+            from_address TEXT NOT NULL,
+            to_address TEXT NOT NULL,
+            ride_class TEXT NOT NULL,
+            distance REAL,
+            estimated_cost REAL,
+            actual_cost REAL,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            completed_at TIMESTAMP,
+            passenger_rating INTEGER,
+            driver_rating INTEGER,
+            FOREIGN KEY (passenger_id) REFERENCES users (user_id),
+            FOREIGN KEY (driver_id) REFERENCES users (user_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS ratings (
+            rating_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            from_user_id INTEGER NOT NULL,
+            to_user_id INTEGER NOT NULL,
+            rating INTEGER NOT NULL,
+            comment TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (order_id) REFERENCES orders (order_id),
+            FOREIGN KEY (from_user_id) REFERENCES users (user_id),
+            FOREIGN KEY (to_user_id) REFERENCES users (user_id)
+        )
+        '''
+    ]),
+    (2, "Hot-path indexes for orders, ratings and drivers", [
+        # Order history per user, newest first (also serves keyset paging)
+        "CREATE INDEX IF NOT EXISTS idx_orders_passenger_history ON orders (passenger_id, created_at, order_id)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_driver_history ON orders (driver_id, created_at, order_id)",
+        # Active orders only: the WHERE clause must match get_active_order() verbatim
+        '''
+        CREATE INDEX IF NOT EXISTS idx_orders_passenger_active ON orders (passenger_id, created_at)
+        WHERE status != 'completed' AND status != 'cancelled'
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_orders_driver_active ON orders (driver_id, created_at)
+        WHERE status != 'completed' AND status != 'cancelled'
+        ''',
+        # Pending order queue in creation order
+        "CREATE INDEX IF NOT EXISTS idx_orders_pending ON orders (created_at, order_id) WHERE status = 'pending'",
+        # Completed rides per driver for earnings and statistics
+        '''
+        CREATE INDEX IF NOT EXISTS idx_orders_driver_completed ON orders (driver_id, completed_at)
+        WHERE status = 'completed'
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_ratings_to_user ON ratings (to_user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_drivers_available ON drivers (user_id) WHERE status = 'available'"
+    ]),
+    (3, "Running rating aggregates on users", [
+        "ALTER TABLE users ADD COLUMN rating_sum REAL NOT NULL DEFAULT 0",
+        "ALTER TABLE users ADD COLUMN rating_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE users ADD COLUMN rating_decay_sum REAL NOT NULL DEFAULT 0",
+        "ALTER TABLE users ADD COLUMN rating_decay_weight REAL NOT NULL DEFAULT 0",
+        _backfill_rating_aggregates
+    ]),
+    (4, "Daily earnings rollups per driver", [
+        '''
+        CREATE TABLE IF NOT EXISTS driver_daily_earnings (
+            driver_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            amount REAL NOT NULL DEFAULT 0,
+            rides INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (driver_id, day)
+        ) WITHOUT ROWID
+        ''',
+        backfill_driver_earnings
+    ]),
+    (5, "Driver locations", [
+        "ALTER TABLE drivers ADD COLUMN latitude REAL",
+        "ALTER TABLE drivers ADD COLUMN longitude REAL",
+        "ALTER TABLE drivers ADD COLUMN location_updated_at TIMESTAMP"
+    ]),
+    (6, "Travel speed statistics per hour of week", [
+        '''
+        CREATE TABLE IF NOT EXISTS travel_speed_stats (
+            hour_of_week INTEGER NOT NULL,
+            zone TEXT NOT NULL DEFAULT '',
+            distance_km REAL NOT NULL DEFAULT 0,
+            hours REAL NOT NULL DEFAULT 0,
+            rides INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (hour_of_week, zone)
+        ) WITHOUT ROWID
+        ''',
+        _backfill_travel_speeds
+    ]),
+    (7, "Order pickup coordinates", [
+        "ALTER TABLE orders ADD COLUMN pickup_latitude REAL",
+        "ALTER TABLE orders ADD COLUMN pickup_longitude REAL"
+    ]),
+    (8, "Order declines", [
+        '''
+        CREATE TABLE IF NOT EXISTS order_declines (
+            order_id INTEGER NOT NULL,
+            driver_id INTEGER NOT NULL,
+            declined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (order_id, driver_id)
+        ) WITHOUT ROWID
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_order_declines_driver ON order_declines(driver_id)"
+    ]),
+    (9, "Order status change time", [
+        # SQLite can't add a column defaulting to CURRENT_TIMESTAMP, writers set it
+        "ALTER TABLE orders ADD COLUMN status_changed_at TIMESTAMP",
+        # The real time is unknown for existing orders; creation is the earliest it can be
+        "UPDATE orders SET status_changed_at = created_at"
+    ])
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+async def get_schema_version(conn):
+    """Get the schema version stored in the database"""
+    async with conn.execute("PRAGMA user_version") as cursor:
+        return (await cursor.fetchone())[0]
+
+
+async def apply_migrations(conn):
+    """Apply all pending migrations, each one in its own transaction"""
+    for version, description, statements in MIGRATIONS:
+        if version <= await get_schema_version(conn):
+            continue
+
+        # Take the write lock first and re-check, another process may have migrated
+        await conn.execute("BEGIN IMMEDIATE")
+        if version <= await get_schema_version(conn):
+            await conn.rollback()
+            continue
+
+        logging.info(f"Applying database migration {version}: {description}")
+        for statement in statements:
+            # Steps are SQL strings or async callables for data backfills
+            if callable(statement):
+                await statement(conn)
+            else:
+                await conn.execute(statement)
+        await conn.execute(f"PRAGMA user_version = {version}")
+        await conn.commit()
+
+    return await get_schema_version(conn)
@@ -0,0 +1,204 @@
+import operator
+import random
+
+from spatial import KM_PER_DEGREE, distance_km
+from config import NEAREST_DRIVERS_RADIUS_KM
+
+
+class PendingOrder:
+    """Compact record of a pending order with its passenger's name, phone and rating"""
+
+    __slots__ = (
+        'order_id', 'created_at', 'passenger_id', 'from_address', 'to_address', 'ride_class', 'distance',
+        'estimated_cost', 'pickup_latitude', 'pickup_longitude', 'full_name', 'phone', 'rating'
+    )
+    PASSENGER_FIELDS = ('full_name', 'phone', 'rating')
+    _values = operator.attrgetter(*__slots__)
+
+    def __init__(self, order, passenger):
+        for field in self.__slots__:
+            source = passenger if field in self.PASSENGER_FIELDS else order
+            setattr(self, field, source[field])
+
+    @property
+    def key(self):
+        """Position in creation order"""
+        return self.created_at, self.order_id
+
+    def as_dict(self):
+        """The record as a pending order row joined with its passenger"""
+        order = dict(zip(self.__slots__, self._values(self)))
+        order['status'] = 'pending'
+        order['driver_id'] = None
+        return order
+
+
+class _SkipList:
+    """
+    Sorted set of keys with O(log n) expected insertion and removal
+
+    Each key sits in a node [key, next on level 1, next on level 2, ...];
+    a node reaches one level higher with probability P, and searches walk
+    each level from the top down, so about log(n, 1 / P) levels are
+    crossed whatever the position. Unlike a sorted list, nothing is moved
+    when a key is inserted or removed in the middle.
+    """
+
+    P = 0.25
+    MAX_LEVEL = 16  # Plenty for 4 ** 16 keys
+
+    def __init__(self):
+        self._head = [None] * (self.MAX_LEVEL + 1)
+        self._level = 1
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        node = self._head[1]
+        while node is not None:
+            yield node[0]
+            node = node[1]
+
+    def clear(self):
+        self._head = [None] * (self.MAX_LEVEL + 1)
+        self._level = 1
+        self._size = 0
+
+    def _predecessors(self, key):
+        """The last node before `key` on each level, indexed by level"""
+        update = [self._head] * (self.MAX_LEVEL + 1)
+        node = self._head
+        for level in range(self._level, 0, -1):
+            following = node[level]
+            while following is not None and following[0] < key:
+                node = following
+                following = node[level]
+            update[level] = node
+        return update
+
+    def add(self, key):
+        """Insert `key` unless present"""
+        update = self._predecessors(key)
+        following = update[1][1]
+        if following is not None and following[0] == key:
+            return
+
+        level = 1
+        while level < self.MAX_LEVEL and random.random() < self.P:
+            level += 1
+        self._level = max(self._level, level)
+        node = [key] + [None] * level
+        for i in range(1, level + 1):
+            node[i] = update[i][i]
+            update[i][i] = node
+        self._size += 1
+
+    def discard(self, key):
+        """Remove `key` if present"""
+        update = self._predecessors(key)
+        node = update[1][1]
+        if node is None or node[0] != key:
+            return
+
+        for i in range(1, len(node)):
+            update[i][i] = node[i]
+        while self._level > 1 and self._head[self._level] is None:
+            self._level -= 1
+        self._size -= 1
+
+
+class PendingOrderBook:
+    """
+    In-memory book of pending orders, in creation order
+
+    Engines add orders as they are created and remove them when accepted
+    or cancelled, so listing pending orders never touches storage. Records
+    are ordered by (created_at, order_id) keys in skip lists, one for all
+    orders and one per ride class, so adding and removing an order takes
+    O(log n) whatever its position.
+    Passenger details are copied into the records and refreshed when the
+    passenger's profile or rating changes.
+    """
+
+    def __init__(self):
+        self._records = {}  # order_id -> PendingOrder
+        self._keys = _SkipList()  # (created_at, order_id)
+        self._by_class = {}  # ride_class -> _SkipList of (created_at, order_id)
+        self._by_passenger = {}  # passenger_id -> {order_id}
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, order_id):
+        return order_id in self._records
+
+    def clear(self):
+        self._records.clear()
+        self._keys.clear()
+        self._by_class.clear()
+        self._by_passenger.clear()
+
+    def add(self, order, passenger):
+        """Add a pending order row, with the passenger's user row"""
+        if order['order_id'] in self._records:
+            return
+        record = PendingOrder(order, passenger)
+        self._records[record.order_id] = record
+        self._keys.add(record.key)
+        keys = self._by_class.get(record.ride_class)
+        if keys is None:
+            keys = self._by_class[record.ride_class] = _SkipList()
+        keys.add(record.key)
+        self._by_passenger.setdefault(record.passenger_id, set()).add(record.order_id)
+
+    def remove(self, order_id):
+        """Drop an order that left 'pending'; returns its record, or None"""
+        record = self._records.pop(order_id, None)
+        if record is None:
+            return None
+        self._keys.discard(record.key)
+        self._by_class[record.ride_class].discard(record.key)
+        orders = self._by_passenger[record.passenger_id]
+        orders.discard(order_id)
+        if not orders:
+            del self._by_passenger[record.passenger_id]
+        return record
+
+    def update_passenger(self, passenger_id, full_name, phone, rating):
+        """Refresh the passenger details of their pending orders"""
+        for order_id in self._by_passenger.get(passenger_id, ()):
+            record = self._records[order_id]
+            record.full_name, record.phone, record.rating = full_name, phone, rating
+
+    def orders(self, ride_class=None, near=None, radius_km=NEAREST_DRIVERS_RADIUS_KM):
+        """
+        Pending orders in creation order, of `ride_class` and with a pickup
+        within `radius_km` of `near` (lat, lon) when given
+
+        Orders without a geocoded pickup match any position, as the
+        dispatcher offers them to any driver.
+        """
+        keys = self._keys if ride_class is None else self._by_class.get(ride_class, ())
+        records = [self._records[order_id] for _, order_id in keys]
+        if near is None:
+            return records
+
+        lat, lon = near
+        lat_span = radius_km / KM_PER_DEGREE
+        return [
+            record for record in records
+            if record.pickup_latitude is None or (
+                abs(record.pickup_latitude - lat) <= lat_span
+                and distance_km(lat, lon, record.pickup_latitude, record.pickup_longitude) <= radius_km
+            )
+        ]
+
+    def stats(self):
+        """Get pending orders per ride class"""
+        return {
+            'orders': len(self._records),
+            'classes': {ride_class: len(keys) for ride_class, keys in self._by_class.items() if keys},
+            'passengers': len(self._by_passenger)
+        }
@@ -5,15 +5,15 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 
 import keyboards as kb
-from db import Database
-from geo import GeoService
+from db import db
+from geo import geo_service, RequestAbandoned
+from dispatch import order_dispatcher
+from expiry import order_expiry
 from config import MESSAGES, RIDE_CLASSES
-from common import format_order_info
+from common import format_order_info, send_order_history
 
-# Initialize router, database, and geo service
+# Initialize router
 router = Router()
-db = Database()
-geo_service = GeoService()
 
 # States for passenger actions
 class PassengerStates(StatesGroup):
@@ -46,8 +46,9 @@ async def order_taxi(callback: CallbackQuery, state: FSMContext):
 @router.message(StateFilter(PassengerStates.waiting_for_from_address))
 async def process_from_address(message: Message, state: FSMContext):
     """Process 'from' address"""
-    # Save from address
+    # Save from address and start geocoding it while the user types the next one
     await state.update_data(from_address=message.text)
+    geo_service.prefetch(message.from_user.id, 'from', message.text)
     
     # Ask for destination address
     await message.answer(MESSAGES["order_to"])
@@ -56,8 +57,9 @@ async def process_from_address(message: Message, state: FSMContext):
 @router.message(StateFilter(PassengerStates.waiting_for_to_address))
 async def process_to_address(message: Message, state: FSMContext):
     """Process 'to' address"""
-    # Save to address
+    # Save to address and start geocoding it while the user picks a class
     await state.update_data(to_address=message.text)
+    geo_service.prefetch(message.from_user.id, 'to', message.text)
     
     # Ask for ride class
     await message.answer(MESSAGES["select_class"], reply_markup=kb.get_ride_class_keyboard())
@@ -77,20 +79,44 @@ async def process_ride_class(callback: CallbackQuery, state: FSMContext):
     from_address = data["from_address"]
     to_address = data["to_address"]
     
-    # Calculate distance and estimated cost
-    distance = await geo_service.calculate_distance(from_address, to_address)
+    # Calculate distance and estimated cost from the prefetched coordinates,
+    # unless the user leaves the flow meanwhile
+    try:
+        distance, from_coords, _ = await geo_service.run_for_user(
+            callback.from_user.id,
+            geo_service.calculate_route(from_address, to_address, user_id=callback.from_user.id)
+        )
+    except RequestAbandoned:
+        return
+    
+    if distance is None:
+        # An address couldn't be found, so ask for both again
+        geo_service.cancel_user_requests(callback.from_user.id)
+        await callback.message.answer(MESSAGES["address_not_found"])
+        await callback.message.answer(MESSAGES["order_from"])
+        await state.set_state(PassengerStates.waiting_for_from_address)
+        return
+    
     class_info = RIDE_CLASSES[ride_class]
     estimated_cost = class_info["base_fare"] + (distance * class_info["per_km"])
     estimated_cost = round(estimated_cost)
     
-    # Calculate estimated arrival time
-    estimated_arrival = class_info["wait_time"]
+    # Calculate estimated arrival time from the nearest available driver,
+    # or the class's typical wait if nobody is close
+    nearest = db.find_nearest_drivers(*from_coords, k=1) if from_coords else []
+    if nearest:
+        estimated_arrival = await geo_service.estimate_travel_time(nearest[0][1])
+    else:
+        estimated_arrival = class_info["wait_time"]
+    travel_time = await geo_service.estimate_travel_time(distance)
     
     # Save to state
     await state.update_data(
         distance=distance,
         estimated_cost=estimated_cost,
-        estimated_arrival=estimated_arrival
+        estimated_arrival=estimated_arrival,
+        travel_time=travel_time,
+        pickup=from_coords
     )
     
     # Show order confirmation
@@ -103,7 +129,8 @@ async def process_ride_class(callback: CallbackQuery, state: FSMContext):
         f"<b>Класс:</b> {human_class}\n"
         f"<b>Расстояние:</b> {distance} км\n"
         f"<b>Примерная стоимость:</b> {estimated_cost} руб.\n"
-        f"<b>Примерное время прибытия:</b> {estimated_arrival} мин."
+        f"<b>Примерное время прибытия:</b> {estimated_arrival} мин.\n"
+        f"<b>Время в пути:</b> {travel_time} мин."
     )
     
     await callback.message.answer(
@@ -129,16 +156,22 @@ async def confirm_order(callback: CallbackQuery, state: FSMContext):
         to_address=data["to_address"],
         ride_class=data["ride_class"],
         distance=data["distance"],
-        estimated_cost=data["estimated_cost"]
+        estimated_cost=data["estimated_cost"],
+        pickup=data.get("pickup")
     )
     
+    # Offer it to the nearest drivers, and cancel it if nobody takes it in time
+    order_dispatcher.submit(order_id)
+    order_expiry.track(order_id)
+    
     # Inform user
     await callback.message.answer(
         f"Заказ #{order_id} создан! Ожидайте подтверждения от водителя.",
         reply_markup=kb.get_back_to_menu()
     )
     
-    # Clear state
+    # Clear state and drop the finished prefetches
+    geo_service.cancel_user_requests(callback.from_user.id)
     await state.clear()
 
 @router.callback_query(StateFilter(PassengerStates.waiting_for_order_confirmation), F.data == "cancel_order")
@@ -149,6 +182,7 @@ async def cancel_order_creation(callback: CallbackQuery, state: FSMContext):
         "Заказ отменен.",
         reply_markup=kb.get_passenger_menu()
     )
+    geo_service.cancel_user_requests(callback.from_user.id)
     await state.clear()
 
 @router.callback_query(F.data == "active_order")
@@ -170,29 +204,26 @@ async def show_active_order(callback: CallbackQuery):
     order_info = await format_order_info(active_order)
     await callback.message.answer(
         order_info,
-        reply_markup=kb.get_active_order_keyboard('passenger', active_order['status']),
+        reply_markup=kb.get_active_order_keyboard('passenger', active_order['status'], active_order['order_id']),
         parse_mode="HTML"
     )
 
-@router.callback_query(F.data == "cancel_active_order")
+@router.callback_query(F.data.startswith("cancel_active_order_"))
 async def cancel_active_order(callback: CallbackQuery):
     """Cancel active order"""
     await callback.answer()
     
-    # Get active order
-    active_order = await db.get_active_order(callback.from_user.id, 'passenger')
-    
-    if not active_order:
-        await callback.message.answer(
-            MESSAGES["no_active_orders"],
-            reply_markup=kb.get_back_to_menu()
-        )
-        return
+    # Extract order_id from callback data
+    order_id = int(callback.data.split("_")[-1])
     
     # Only allow cancellation for pending or accepted orders
-    if active_order['status'] in ['pending', 'accepted', 'driver_started']:
-        # Cancel order
-        await db.cancel_order(active_order['order_id'])
+    order = await db.transition_order(
+        order_id, callback.from_user.id, ('pending', 'accepted', 'driver_started'), 'cancelled'
+    )
+    
+    if order:
+        order_dispatcher.cancelled(order_id)
+        order_expiry.forget(order_id)
         await callback.message.answer(
             "Заказ успешно отменен.",
             reply_markup=kb.get_back_to_menu()
@@ -264,38 +295,5 @@ async def show_order_history(callback: CallbackQuery):
     """Show order history for passenger"""
     await callback.answer()
     
-    # Get order history
-    orders = await db.get_order_history(callback.from_user.id, 'passenger')
-    
-    if not orders:
-        await callback.message.answer(
-            MESSAGES["no_history"],
-            reply_markup=kb.get_back_to_menu()
-        )
-        return
-    
-    # Format and show orders
-    response = "<b>История ваших поездок:</b>\n\n"
-    
-    for i, order in enumerate(orders, 1):
-        status_emoji = {
-            'completed': '✅',
-            'cancelled': '❌',
-            'pending': '⏳',
-            'accepted': '🚗',
-            'in_progress': '🚕'
-        }.get(order['status'], '')
-        
-        response += (
-            f"{i}. {status_emoji} <b>Заказ #{order['order_id']}</b>\n"
-            f"   {order['from_address']} → {order['to_address']}\n"
-            f"   Класс: {'Комфорт' if order['ride_class'] == 'comfort' else 'Эконом'}\n"
-            f"   Стоимость: {order['actual_cost'] or order['estimated_cost']} руб.\n"
-            f"   Дата: {order['created_at'][:10]}\n\n"
-        )
-    
-    await callback.message.answer(
-        response,
-        reply_markup=kb.get_history_keyboard(),
-        parse_mode="HTML"
-    )
\ No newline at end of file
+    # Show the newest page, older pages are reached with the keyset buttons
+    await send_order_history(callback.message, callback.from_user.id, 'passenger')
\ No newline at end of file
@@ -6,12 +6,11 @@ from aiogram.fsm.state import StatesGroup, State
 
 import re
 import keyboards as kb
-from db import Database
+from db import db
 from config import MESSAGES
 
-# Initialize router and database
+# Initialize router
 router = Router()
-db = Database()
 
 # States for registration
 class RegistrationStates(StatesGroup):
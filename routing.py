@@ -0,0 +1,338 @@
+"""
+Offline road-network router
+
+A road graph from a local extract is compiled into one binary file that is
+memory-mapped at startup, like the gazetteer. Adjacency is stored in
+compressed sparse row form (one offsets array, then flat per-edge arrays),
+so a city of a few hundred thousand edges is a few megabytes and opening it
+costs nothing.
+
+Build the graph:
+    python routing.py build nodes.csv edges.csv roads.graph
+
+`nodes.csv` needs `id`, `lat` and `lon` columns. `edges.csv` needs `from`
+and `to` node IDs and may have `length_m` (computed from the coordinates
+when missing), `speed_kmh` (DEFAULT_SPEED_KMH when missing) and `oneway`
+(1 for one-way streets; other edges are added in both directions).
+
+Graph layout (little-endian):
+    header          magic, version, node count N, edge count E, landmark count L
+    coords          N x 2 x float32, latitude and longitude
+    offsets         (N + 1) x uint32, first edge of each node
+    targets         E x uint32, head node of each edge
+    lengths         E x float32, kilometers
+    times           E x float32, seconds
+    landmark_from   L x N x float32, seconds from each landmark to every node
+    landmark_to     L x N x float32, seconds from every node to each landmark
+
+Queries run A* on travel time with ALT lower bounds: by the triangle
+inequality, a route from v to t takes at least d(L, t) - d(L, v) and
+d(v, L) - d(t, L) for every landmark L. Landmarks are spread out by
+farthest-point selection at build time, and each query uses the few that
+bound its endpoints best. Unreachable nodes have infinite landmark times.
+"""
+import csv
+import heapq
+import math
+import mmap
+import struct
+import sys
+from array import array
+
+import numpy as np
+
+from cache import TTLCache, MISSING
+from geomatrix import EARTH_RADIUS_KM, equirectangular_matrix
+from config import ROUTE_CACHE_SIZE, ROUTE_CACHE_TTL, ROUTING_SNAP_KM
+
+MAGIC = b'FDRG'
+VERSION = 1
+HEADER = struct.Struct('<4sIIII')
+
+DEFAULT_SPEED_KMH = 30
+LANDMARKS = 8
+
+# Landmarks consulted per query: more give tighter bounds but cost more per node
+ACTIVE_LANDMARKS = 3
+
+
+def _segment_km(lat1, lon1, lat2, lon2):
+    """Great-circle length of an edge without a length in the extract"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _csr(node_count, edges):
+    """Sort (tail, head, km, seconds) edges into offsets and per-edge columns"""
+    edges.sort(key=lambda edge: edge[0])
+    offsets = [0] * (node_count + 1)
+    for tail, *_ in edges:
+        offsets[tail + 1] += 1
+    for node in range(node_count):
+        offsets[node + 1] += offsets[node]
+    return offsets, [edge[1] for edge in edges], [edge[2] for edge in edges], [edge[3] for edge in edges]
+
+
+def _dijkstra(offsets, targets, weights, source):
+    """Weights of the shortest paths from source to every node (inf if unreachable)"""
+    best = [math.inf] * (len(offsets) - 1)
+    best[source] = 0.0
+    heap = [(0.0, source)]
+    while heap:
+        g, node = heapq.heappop(heap)
+        if g > best[node]:
+            continue
+        for edge in range(offsets[node], offsets[node + 1]):
+            head = targets[edge]
+            candidate = g + weights[edge]
+            if candidate < best[head]:
+                best[head] = candidate
+                heapq.heappush(heap, (candidate, head))
+    return best
+
+
+def _select_landmarks(offsets, targets, times, count):
+    """
+    Farthest-point landmarks: each one is the node farthest from those
+    already chosen, which puts them around the edge of the city
+
+    Returns the landmarks and their times to every node.
+    """
+    node_count = len(offsets) - 1
+    if not node_count:
+        return [], []
+
+    # The first landmark is the node farthest from an arbitrary one
+    nearest = _dijkstra(offsets, targets, times, 0)
+    landmarks, tables = [], []
+    while len(landmarks) < count:
+        candidate = max(range(node_count), key=lambda node: nearest[node] if nearest[node] != math.inf else -1.0)
+        if nearest[candidate] <= 0:
+            # Every reachable node is a landmark already
+            break
+        distances = _dijkstra(offsets, targets, times, candidate)
+        nearest = distances if not landmarks else [min(a, b) for a, b in zip(nearest, distances)]
+        landmarks.append(candidate)
+        tables.append(distances)
+    return landmarks, tables
+
+
+def build(nodes_path, edges_path, graph_path, landmarks=LANDMARKS):
+    """Compile CSV node and edge extracts into a graph file, returning (nodes, edges)"""
+    ids, coords = {}, []
+    with open(nodes_path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            ids[row['id']] = len(coords)
+            coords.append((float(row['lat']), float(row['lon'])))
+
+    edges = []
+    with open(edges_path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            tail, head = ids.get(row['from']), ids.get(row['to'])
+            if tail is None or head is None or tail == head:
+                continue
+            km = float(row['length_m']) / 1000 if row.get('length_m') else _segment_km(*coords[tail], *coords[head])
+            speed = float(row.get('speed_kmh') or DEFAULT_SPEED_KMH)
+            # Rounded to the stored precision, so landmark times agree with
+            # the edge times queries add up
+            seconds = array('f', (km / speed * 3600,))[0]
+            edges.append((tail, head, km, seconds))
+            if row.get('oneway', '0') not in ('1', 'yes', 'true'):
+                edges.append((head, tail, km, seconds))
+
+    offsets, targets, lengths, times = _csr(len(coords), edges)
+
+    # Landmark times in both directions; the reverse graph gives times *to* a landmark
+    chosen, landmark_from = _select_landmarks(offsets, targets, times, landmarks)
+    reverse_offsets, reverse_targets, _, reverse_times = _csr(
+        len(coords), [(head, tail, km, seconds) for tail, head, km, seconds in edges]
+    )
+    landmark_to = [_dijkstra(reverse_offsets, reverse_targets, reverse_times, landmark) for landmark in chosen]
+
+    with open(graph_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(coords), len(targets), len(chosen)))
+        f.write(struct.pack(f'<{2 * len(coords)}f', *(value for point in coords for value in point)))
+        f.write(struct.pack(f'<{len(offsets)}I', *offsets))
+        f.write(struct.pack(f'<{len(targets)}I', *targets))
+        f.write(struct.pack(f'<{len(lengths)}f', *lengths))
+        f.write(struct.pack(f'<{len(times)}f', *times))
+        for table in landmark_from + landmark_to:
+            f.write(struct.pack(f'<{len(table)}f', *table))
+
+    return len(coords), len(targets)
+
+
+class Router:
+    """
+    Shortest routes over a memory-mapped road graph
+
+    Not thread-safe: GeoService runs all queries on one worker thread.
+    """
+
+    def __init__(self, path, cache_size=ROUTE_CACHE_SIZE, cache_ttl=ROUTE_CACHE_TTL,
+                 active_landmarks=ACTIVE_LANDMARKS):
+        if sys.byteorder != 'little':
+            raise RuntimeError("Road graphs are little-endian")
+
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.nodes, self.edges, self.landmarks = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            self._mmap.close()
+            raise ValueError(f"Not a road graph (version {VERSION}): {path}")
+
+        # Typed views straight into the mapping: indexing them yields plain
+        # Python numbers, which is what the search loop wants
+        view = memoryview(self._mmap)
+        pos = HEADER.size
+        coords = view[pos:pos + 8 * self.nodes]
+        pos += 8 * self.nodes
+        self._offsets = view[pos:pos + 4 * (self.nodes + 1)].cast('I')
+        pos += 4 * (self.nodes + 1)
+        self._targets = view[pos:pos + 4 * self.edges].cast('I')
+        pos += 4 * self.edges
+        self._lengths = view[pos:pos + 4 * self.edges].cast('f')
+        pos += 4 * self.edges
+        self._times = view[pos:pos + 4 * self.edges].cast('f')
+        pos += 4 * self.edges
+        self._landmark_from, self._landmark_to = [], []
+        for tables in (self._landmark_from, self._landmark_to):
+            for _ in range(self.landmarks):
+                tables.append(view[pos:pos + 4 * self.nodes].cast('f'))
+                pos += 4 * self.nodes
+        self._views = [view, coords, self._offsets, self._targets, self._lengths, self._times,
+                       *self._landmark_from, *self._landmark_to]
+
+        # NumPy view of the coordinates, for snapping points to nodes in one pass
+        self._coords = np.frombuffer(coords, dtype='<f4').reshape(-1, 2)
+
+        self.active_landmarks = min(active_landmarks, self.landmarks)
+        self.cache = TTLCache(cache_size, cache_ttl)
+        # Geocoded points repeat exactly, so their nodes are worth keeping too
+        self._snaps = TTLCache(cache_size, cache_ttl)
+
+        # Metrics
+        self.queries = 0
+        self.unreachable = 0
+        self.settled = 0
+
+    def close(self):
+        """Unmap the graph"""
+        self._coords = None
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        self._mmap.close()
+
+    def nearest_node(self, lat, lon):
+        """Graph node closest to a point, as (node, distance_km)"""
+        snap = self._snaps.get((lat, lon))
+        if snap is MISSING:
+            distances = equirectangular_matrix([(lat, lon)], self._coords)[0]
+            node = int(np.argmin(distances))
+            snap = (node, float(distances[node]))
+            self._snaps.set((lat, lon), snap)
+        return snap
+
+    def _landmarks_for(self, source, target):
+        """The landmark tables giving the best lower bounds from source to target"""
+        bounds = []
+        for landmark_from, landmark_to in zip(self._landmark_from, self._landmark_to):
+            bound = max(landmark_from[target] - landmark_from[source], landmark_to[source] - landmark_to[target])
+            if math.isfinite(bound):
+                bounds.append((bound, landmark_from, landmark_to))
+        bounds.sort(key=lambda entry: entry[0], reverse=True)
+        return [(landmark_from, landmark_to) for _, landmark_from, landmark_to in bounds[:self.active_landmarks]]
+
+    def shortest_path(self, source, target):
+        """Fastest route between two nodes, as (distance_km, minutes), or None if there is none"""
+        self.queries += 1
+        if source == target:
+            return (0.0, 0.0)
+
+        offsets, targets, lengths, times = self._offsets, self._targets, self._lengths, self._times
+        landmarks = [
+            (landmark_from, landmark_from[target], landmark_to, landmark_to[target])
+            for landmark_from, landmark_to in self._landmarks_for(source, target)
+        ]
+        inf = math.inf
+
+        def lower_bound(node):
+            bound = 0.0
+            for landmark_from, from_target, landmark_to, to_target in landmarks:
+                ahead = from_target - landmark_from[node]
+                behind = landmark_to[node] - to_target
+                # A landmark that can't reach (or be reached from) a node says nothing about it
+                if ahead > bound and ahead != inf:
+                    bound = ahead
+                if behind > bound and behind != inf:
+                    bound = behind
+            return bound
+
+        # Bounds are admissible but, with unreachable landmarks skipped,
+        # not always consistent, so nodes may be settled again when a
+        # cheaper path turns up
+        best = {source: 0.0}
+        km = {source: 0.0}
+        heap = [(lower_bound(source), 0.0, source)]
+        settled = 0
+        while heap:
+            _, g, node = heapq.heappop(heap)
+            if node == target:
+                self.settled += settled
+                return (km[node], g / 60)
+            if g > best[node]:
+                continue
+            settled += 1
+            node_km = km[node]
+            for edge in range(offsets[node], offsets[node + 1]):
+                head = targets[edge]
+                candidate = g + times[edge]
+                known = best.get(head)
+                if known is None or candidate < known:
+                    best[head] = candidate
+                    km[head] = node_km + lengths[edge]
+                    heapq.heappush(heap, (candidate + lower_bound(head), candidate, head))
+
+        self.settled += settled
+        self.unreachable += 1
+        return None
+
+    def route(self, from_coords, to_coords):
+        """
+        Fastest route between two points, as (distance_km, minutes)
+
+        Points are snapped to the nearest node. Returns None when a point
+        is more than ROUTING_SNAP_KM from the road graph or there is no
+        route, so callers can fall back to straight-line distance.
+        """
+        source, source_km = self.nearest_node(*from_coords)
+        target, target_km = self.nearest_node(*to_coords)
+        if source_km > ROUTING_SNAP_KM or target_km > ROUTING_SNAP_KM:
+            return None
+
+        route = self.cache.get((source, target))
+        if route is MISSING:
+            route = self.shortest_path(source, target)
+            self.cache.set((source, target), route)
+        return route
+
+    def stats(self):
+        """Get graph size, query and route cache counters"""
+        return {
+            'nodes': self.nodes,
+            'edges': self.edges,
+            'queries': self.queries,
+            'unreachable': self.unreachable,
+            'settled_per_query': self.settled / self.queries if self.queries else 0,
+            'cache': self.cache.stats()
+        }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 5 or sys.argv[1] != "build":
+        raise SystemExit("Usage: python routing.py build nodes.csv edges.csv roads.graph")
+    nodes, edges = build(sys.argv[2], sys.argv[3], sys.argv[4])
+    print(f"Built a graph of {nodes} nodes and {edges} edges")
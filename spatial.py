@@ -0,0 +1,148 @@
+import math
+
+from geomatrix import EARTH_RADIUS_KM
+from config import DRIVER_GRID_CELL_KM, DRIVER_GRID_LATITUDE, NEAREST_DRIVERS_RADIUS_KM
+
+KM_PER_DEGREE = 111.195
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Equirectangular distance from point 1, the same formula as geomatrix.equirectangular_matrix"""
+    x = math.radians(lon2 - lon1) * math.cos(math.radians(lat1))
+    y = math.radians(lat2 - lat1)
+    return EARTH_RADIUS_KM * math.sqrt(x * x + y * y)
+
+
+class DriverIndex:
+    """
+    In-memory grid index of available drivers with a known location
+
+    The plane is cut into cells of about `cell_km` (longitude steps are
+    sized at `latitude`, the city's). Drivers live in the cell of their last
+    position while they are available; a nearest query walks rings of
+    cells outward from the pickup until the k best are certain.
+
+    Positions and availability are tracked separately, so a driver who goes
+    busy and comes back reappears at the last known position. Every driver
+    with a recorded status is known, which spares a profile read when
+    checking that a user is a driver.
+    """
+
+    def __init__(self, cell_km=DRIVER_GRID_CELL_KM, latitude=DRIVER_GRID_LATITUDE):
+        self.cell_km = cell_km
+        self._lat_step = cell_km / KM_PER_DEGREE
+        self._lon_step = cell_km / (KM_PER_DEGREE * math.cos(math.radians(latitude)))
+
+        self._positions = {}  # driver_id -> (lat, lon)
+        self._drivers = set()  # Every driver with a recorded status
+        self._available = set()
+        self._cells = {}  # (row, column) -> set of available driver IDs
+
+    def __len__(self):
+        """Number of drivers that nearest() can return"""
+        return sum(len(drivers) for drivers in self._cells.values())
+
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self._lat_step), math.floor(lon / self._lon_step))
+
+    def _add_to_cell(self, driver_id):
+        position = self._positions.get(driver_id)
+        if position is not None and driver_id in self._available:
+            self._cells.setdefault(self._cell(*position), set()).add(driver_id)
+
+    def _remove_from_cell(self, driver_id):
+        position = self._positions.get(driver_id)
+        if position is None:
+            return
+        cell = self._cell(*position)
+        drivers = self._cells.get(cell)
+        if drivers is not None:
+            drivers.discard(driver_id)
+            if not drivers:
+                del self._cells[cell]
+
+    def move(self, driver_id, lat, lon):
+        """Record a driver's new position"""
+        old = self._positions.get(driver_id)
+        if old is not None and self._cell(*old) == self._cell(lat, lon):
+            # Same cell, nothing to re-index
+            self._positions[driver_id] = (lat, lon)
+            return
+
+        self._remove_from_cell(driver_id)
+        self._positions[driver_id] = (lat, lon)
+        self._add_to_cell(driver_id)
+
+    def set_available(self, driver_id, available):
+        """Record a driver's status change"""
+        self._drivers.add(driver_id)
+        if available:
+            self._available.add(driver_id)
+            self._add_to_cell(driver_id)
+        else:
+            self._remove_from_cell(driver_id)
+            self._available.discard(driver_id)
+
+    def remove(self, driver_id):
+        """Forget a driver's position and status"""
+        self._remove_from_cell(driver_id)
+        self._positions.pop(driver_id, None)
+        self._drivers.discard(driver_id)
+        self._available.discard(driver_id)
+
+    def clear(self):
+        self._positions.clear()
+        self._drivers.clear()
+        self._available.clear()
+        self._cells.clear()
+
+    def available(self):
+        """All drivers nearest() can return, as (driver IDs, [(lat, lon), ...])"""
+        driver_ids = [driver_id for drivers in self._cells.values() for driver_id in drivers]
+        return driver_ids, [self._positions[driver_id] for driver_id in driver_ids]
+
+    def known(self, driver_id):
+        """Whether a driver's status was recorded, available or not"""
+        return driver_id in self._drivers
+
+    def position(self, driver_id):
+        """Last known (lat, lon) of a driver, or None"""
+        return self._positions.get(driver_id)
+
+    def nearest(self, lat, lon, k=5, radius_km=NEAREST_DRIVERS_RADIUS_KM):
+        """Up to k available drivers within radius_km, nearest first, as (driver_id, distance_km)"""
+        row, column = self._cell(lat, lon)
+        # Smallest cell side at this latitude: each ring is guaranteed to
+        # cover at least this much more distance
+        ring_km = min(self._lat_step, self._lon_step * math.cos(math.radians(lat))) * KM_PER_DEGREE
+        max_ring = math.ceil(radius_km / ring_km) + 1
+
+        found = []
+        for ring in range(max_ring + 1):
+            for cell in self._ring_cells(row, column, ring):
+                for driver_id in self._cells.get(cell, ()):
+                    distance = distance_km(lat, lon, *self._positions[driver_id])
+                    if distance <= radius_km:
+                        found.append((distance, driver_id))
+
+            # Anything not seen yet is at least `ring * ring_km` away
+            if len(found) >= k:
+                found.sort()
+                if found[k - 1][0] <= ring * ring_km:
+                    break
+
+        found.sort()
+        return [(driver_id, distance) for distance, driver_id in found[:k]]
+
+    @staticmethod
+    def _ring_cells(row, column, ring):
+        """Cells at Chebyshev distance `ring` from (row, column)"""
+        if ring == 0:
+            yield (row, column)
+            return
+        for offset in range(-ring, ring + 1):
+            yield (row - ring, column + offset)
+            yield (row + ring, column + offset)
+        for offset in range(-ring + 1, ring):
+            yield (row + offset, column - ring)
+            yield (row + offset, column + ring)
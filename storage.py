@@ -0,0 +1,231 @@
+import datetime
+import time
+from abc import ABC, abstractmethod
+
+from spatial import DriverIndex
+from travel_time import SpeedModel
+from declines import DeclineMemory
+from orderbook import PendingOrderBook
+from config import RATING_DECAY_HALF_LIFE_DAYS, NEAREST_DRIVERS_RADIUS_KM
+
+# Reference point for forward-decayed rating weights
+RATING_DECAY_EPOCH = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc).timestamp()
+
+# Order lifecycle: status -> statuses it may move to
+ORDER_TRANSITIONS = {
+    'pending': ('accepted', 'cancelled'),
+    'accepted': ('driver_started', 'driver_arrived', 'cancelled'),
+    'driver_started': ('driver_arrived', 'cancelled'),
+    'driver_arrived': ('in_progress', 'completed', 'cancelled'),
+    'in_progress': ('completed',)
+}
+
+
+def rating_weight(timestamp=None):
+    """
+    Forward-decay weight of a rating given at `timestamp` (Unix seconds)
+
+    Weights grow by 2x every half-life, so sum(w * r) / sum(w) is the
+    exponentially decayed average and can be updated with plain additions.
+    """
+    if timestamp is None:
+        timestamp = time.time()
+    half_life = RATING_DECAY_HALF_LIFE_DAYS * 24 * 3600
+    return 2 ** ((timestamp - RATING_DECAY_EPOCH) / half_life)
+
+
+def validate_transition(from_states, to_state):
+    """Normalize `from_states` to a tuple, raising ValueError for illegal transitions"""
+    if isinstance(from_states, str):
+        from_states = (from_states,)
+    for from_state in from_states:
+        if to_state not in ORDER_TRANSITIONS.get(from_state, ()):
+            raise ValueError(f"Invalid order transition: {from_state} -> {to_state}")
+    return tuple(from_states)
+
+
+def earnings_period_start(period):
+    """Get the first local day (YYYY-MM-DD) of an earnings period, None for all time"""
+    today = datetime.date.today()
+    if period == 'today':
+        return today.isoformat()
+    if period == 'week':
+        return (today - datetime.timedelta(days=7)).isoformat()
+    if period == 'month':
+        return (today - datetime.timedelta(days=30)).isoformat()
+    return None
+
+
+class StorageEngine(ABC):
+    """
+    Storage interface used by the bot
+
+    Rows are returned as mappings with the same keys as the SQLite tables,
+    so handlers don't depend on which engine is behind them.
+
+    Every engine keeps `driver_index` in step with driver locations and
+    statuses, so nearest-driver queries never touch storage, and feeds
+    completed rides into `speed_model` for travel time estimates. Declines
+    of pending orders are remembered in `declines`, so drivers are not
+    offered an order they turned down, and pending orders themselves are
+    kept in `order_book`, so listing them never touches storage.
+    """
+
+    def __init__(self):
+        self.driver_index = DriverIndex()
+        self.speed_model = SpeedModel()
+        self.declines = DeclineMemory()
+        self.order_book = PendingOrderBook()
+
+    @abstractmethod
+    async def init(self):
+        """Prepare the engine for use"""
+
+    @abstractmethod
+    async def close(self):
+        """Flush pending writes and release resources"""
+
+    # User management
+    @abstractmethod
+    async def register_user(self, user_id, role, full_name, phone):
+        """Register a new user"""
+
+    @abstractmethod
+    async def register_driver(self, user_id, car_model, car_number):
+        """Register driver details"""
+
+    @abstractmethod
+    async def get_user(self, user_id):
+        """Get user data by ID"""
+
+    @abstractmethod
+    async def get_driver(self, user_id):
+        """Get driver data by ID"""
+
+    @abstractmethod
+    async def get_available_drivers(self):
+        """Get all available drivers, joined with their user data"""
+
+    @abstractmethod
+    async def update_driver_status(self, user_id, status):
+        """Update driver status"""
+
+    @abstractmethod
+    async def update_driver_locations(self, locations):
+        """Store current locations of many drivers, given as (user_id, latitude, longitude)"""
+
+    @abstractmethod
+    async def update_user_rating(self, user_id, new_rating):
+        """Update user rating"""
+
+    # Order management
+    @abstractmethod
+    async def create_order(self, passenger_id, from_address, to_address, ride_class, distance, estimated_cost,
+                           pickup=None):
+        """Create a new order and return its ID; `pickup` is the (lat, lon) of from_address, if known"""
+
+    @abstractmethod
+    async def get_order(self, order_id):
+        """Get order by ID"""
+
+    @abstractmethod
+    async def get_active_order(self, user_id, role='passenger'):
+        """Get the newest order of a user that is not completed or cancelled"""
+
+    @abstractmethod
+    async def get_open_orders(self):
+        """Get all orders that are not completed or cancelled, with their status and status_changed_at"""
+
+    @abstractmethod
+    async def record_decline(self, order_id, driver_id):
+        """Record that a driver declined a pending order"""
+
+    @abstractmethod
+    async def accept_order(self, order_id, driver_id):
+        """Atomically accept a pending order, returning it or None if the driver lost"""
+
+    @abstractmethod
+    async def transition_order(self, order_id, actor_id, from_states, to_state, actual_cost=None,
+                               driver_status='available'):
+        """
+        Atomically move an order between statuses, returning the new row or None
+
+        A cancellation puts the order's driver, if any, into `driver_status`.
+        """
+
+    @abstractmethod
+    async def get_order_history(self, user_id, role='passenger', limit=10, before=None, after=None):
+        """Get a keyset page of a user's orders, newest first"""
+
+    # Rating management
+    @abstractmethod
+    async def add_rating(self, order_id, from_user_id, to_user_id, rating, comment=None):
+        """Add a rating for a user and update their running averages"""
+
+    # Statistics
+    @abstractmethod
+    async def get_driver_earnings(self, driver_id, period=None):
+        """Get driver earnings for 'today', 'week', 'month' or all time"""
+
+    @abstractmethod
+    async def backfill_earnings(self):
+        """Rebuild the daily earnings rollups from completed orders"""
+
+    @abstractmethod
+    async def get_completed_orders_count(self, user_id, role='driver'):
+        """Get count of completed orders"""
+
+    # Operations built on the primitives above
+    async def update_driver_location(self, user_id, latitude, longitude):
+        """Store a driver's current location"""
+        await self.update_driver_locations([(user_id, latitude, longitude)])
+
+    async def get_pending_orders(self, driver_id=None, ride_class=None, near=None,
+                                 radius_km=NEAREST_DRIVERS_RADIUS_KM):
+        """
+        Get pending orders in creation order, with passenger name, phone and rating
+
+        Only orders of `ride_class`, or picking up within `radius_km` of
+        `near` (lat, lon), when given; orders `driver_id` recently declined
+        are left out.
+        """
+        records = self.order_book.orders(ride_class, near, radius_km)
+        if driver_id is not None:
+            records = [record for record in records if not self.declines.declined(record.order_id, driver_id)]
+        return [record.as_dict() for record in records]
+
+    def is_driver(self, user_id):
+        """Whether a user is a registered driver, answered from the driver index"""
+        return self.driver_index.known(user_id)
+
+    def find_nearest_drivers(self, latitude, longitude, k=5, radius_km=NEAREST_DRIVERS_RADIUS_KM):
+        """Get up to k available drivers within radius_km, nearest first, as (driver_id, distance_km)"""
+        return self.driver_index.nearest(latitude, longitude, k, radius_km)
+
+    async def start_ride(self, order_id):
+        """Start a ride"""
+        return await self.transition_order(order_id, None, 'driver_arrived', 'in_progress') is not None
+
+    async def complete_order(self, order_id, actual_cost=None):
+        """Complete an order"""
+        order = await self.transition_order(
+            order_id, None, ('driver_arrived', 'in_progress'), 'completed', actual_cost=actual_cost
+        )
+        return order is not None
+
+    async def cancel_order(self, order_id):
+        """Cancel an order"""
+        cancellable = [status for status, targets in ORDER_TRANSITIONS.items() if 'cancelled' in targets]
+        order = await self.transition_order(order_id, None, cancellable, 'cancelled')
+        return order is not None
+
+    async def iter_order_history(self, user_id, role='passenger', batch_size=200):
+        """Stream a user's full order history, newest first, one page in memory at a time"""
+        before = None
+        while True:
+            orders = await self.get_order_history(user_id, role, limit=batch_size, before=before)
+            for order in orders:
+                yield order
+            if len(orders) < batch_size:
+                return
+            before = (orders[-1]['created_at'], orders[-1]['order_id'])
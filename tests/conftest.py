@@ -0,0 +1,44 @@
+import asyncio
+import contextlib
+import inspect
+
+import pytest
+
+from db import Database
+from memory_db import MemoryDatabase
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_pyfunc_call(pyfuncitem):
+    """Run coroutine tests in a fresh event loop each"""
+    if not inspect.iscoroutinefunction(pyfuncitem.obj):
+        return None
+    arguments = {name: pyfuncitem.funcargs[name] for name in pyfuncitem._fixtureinfo.argnames}
+    asyncio.run(pyfuncitem.obj(**arguments))
+    return True
+
+
+@pytest.fixture
+def database_path(tmp_path):
+    """Path of a fresh SQLite database file"""
+    return str(tmp_path / "fifty_drive.db")
+
+
+@pytest.fixture(params=['sqlite', 'memory'])
+def open_storage(request, database_path):
+    """
+    Open a storage engine of each kind: `async with open_storage() as db:`
+
+    Opening twice in one test reopens the same SQLite file, as a restart
+    would; the memory engine starts empty every time.
+    """
+    @contextlib.asynccontextmanager
+    async def open_storage():
+        storage = Database(database_path) if request.param == 'sqlite' else MemoryDatabase()
+        await storage.init()
+        try:
+            yield storage
+        finally:
+            await storage.close()
+
+    return open_storage
@@ -0,0 +1,56 @@
+"""
+Driver location handlers fed with Telegram messages as aiogram parses them
+"""
+import pytest
+from aiogram.types import Message
+
+import driver
+from locations import LocationBuffer
+from memory_db import MemoryDatabase
+
+DRIVER = 10
+SENT_AT = 1700000000
+
+
+def location_message(latitude, longitude, edit_date=None, user_id=DRIVER):
+    return Message.model_validate({
+        'message_id': 1,
+        'date': SENT_AT,
+        'edit_date': edit_date,
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': "Driver"},
+        'location': {'latitude': latitude, 'longitude': longitude, 'live_period': 900}
+    })
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    storage = MemoryDatabase()
+    buffer = LocationBuffer(storage)
+    monkeypatch.setattr(driver, 'db', storage)
+    monkeypatch.setattr(driver, 'location_buffer', buffer)
+    return storage
+
+
+async def test_live_location_update(storage):
+    await storage.init()
+    await storage.register_user(DRIVER, 'driver', "Driver", "+79000000002")
+    await storage.register_driver(DRIVER, "Lada Vesta", "A001AA77")
+
+    await driver.receive_live_location(location_message(55.75, 37.61, edit_date=SENT_AT + 60))
+    await driver.receive_live_location(location_message(55.76, 37.62, edit_date=SENT_AT + 120))
+    # An update delivered late is ordered by its edit date and dropped
+    await driver.receive_live_location(location_message(55.70, 37.50, edit_date=SENT_AT + 90))
+
+    assert driver.location_buffer.track(DRIVER) == [(SENT_AT + 60, 55.75, 37.61), (SENT_AT + 120, 55.76, 37.62)]
+    assert storage.driver_index.position(DRIVER) == (55.76, 37.62)
+    assert storage.find_nearest_drivers(55.76, 37.62, k=1)[0][0] == DRIVER
+
+
+async def test_live_location_of_non_driver_is_ignored(storage):
+    await storage.init()
+    await storage.register_user(1, 'passenger', "Passenger", "+79000000001")
+
+    await driver.receive_live_location(location_message(55.75, 37.61, edit_date=SENT_AT + 60, user_id=1))
+
+    assert driver.location_buffer.track(1) == []
@@ -0,0 +1,71 @@
+"""
+Order expiry sweeper on the in-memory storage engine
+"""
+import asyncio
+
+from expiry import OrderExpiry
+from memory_db import MemoryDatabase
+
+PASSENGER = 1
+DRIVER = 10
+
+
+class Dispatcher:
+    """Dispatcher stand-in recording what the sweeper hands it"""
+
+    def __init__(self):
+        self.submitted = []
+        self.cancelled_orders = []
+
+    def submit(self, order_id):
+        self.submitted.append(order_id)
+
+    def cancelled(self, order_id):
+        self.cancelled_orders.append(order_id)
+
+
+async def run_sweeper(storage, deadlines):
+    """Start a sweeper with `deadlines`, let due timers come up and collect notifications"""
+    notified = []
+
+    async def notify(order, status):
+        notified.append((order['order_id'], status))
+
+    expiry = OrderExpiry(storage, Dispatcher(), deadlines=deadlines, redispatch_after=0)
+    await expiry.start(notify)
+    await asyncio.sleep(0.05)
+    await expiry.close()
+    return expiry, notified
+
+
+async def test_stalled_order_takes_driver_out_of_the_pool():
+    storage = MemoryDatabase()
+    await storage.init()
+    await storage.register_user(PASSENGER, 'passenger', "Passenger", "+79000000001")
+    await storage.register_user(DRIVER, 'driver', "Driver", "+79000000002")
+    await storage.register_driver(DRIVER, "Lada Vesta", "A001AA77")
+    await storage.update_driver_location(DRIVER, 55.75, 37.61)
+    order_id = await storage.create_order(PASSENGER, "A", "B", 'economy', 5.0, 400, pickup=(55.75, 37.61))
+    assert await storage.accept_order(order_id, DRIVER)
+
+    expiry, notified = await run_sweeper(storage, {'accepted': 0})
+
+    assert (await storage.get_order(order_id))['status'] == 'cancelled'
+    assert notified == [(order_id, 'accepted')]
+    assert expiry.dispatcher.cancelled_orders == [order_id]
+    # The silent driver isn't offered the next order
+    assert (await storage.get_driver(DRIVER))['status'] == 'busy'
+    assert storage.find_nearest_drivers(55.75, 37.61) == []
+
+
+async def test_order_within_deadline_is_kept():
+    storage = MemoryDatabase()
+    await storage.init()
+    await storage.register_user(PASSENGER, 'passenger', "Passenger", "+79000000001")
+    order_id = await storage.create_order(PASSENGER, "A", "B", 'economy', 5.0, 400)
+
+    expiry, notified = await run_sweeper(storage, {'pending': 60})
+
+    assert (await storage.get_order(order_id))['status'] == 'pending'
+    assert notified == []
+    assert expiry.stats()['timers'] == 1
@@ -0,0 +1,227 @@
+"""
+Geocoding off the event loop
+
+A stand-in geocoder blocks its thread for a second, like Nominatim on a
+bad day. Quotes must not stall other handlers meanwhile, must keep to the
+concurrency limit, and must be cancellable while they wait.
+"""
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+from geopy.distance import geodesic
+
+from geo import GeoService, RequestAbandoned
+from geocache import GeocodeCache
+
+DELAY = 1.0
+
+
+class BlockingGeocoder:
+    """Geocoder stand-in that blocks its thread for `delay` seconds per request"""
+
+    def __init__(self, delay=DELAY):
+        self.delay = delay
+        self.delays = {}  # address -> its own delay
+        self.calls = 0
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def geocode(self, address, timeout=None):
+        with self._lock:
+            self.calls += 1
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.delays.get(address, self.delay))
+        finally:
+            with self._lock:
+                self.active -= 1
+        return SimpleNamespace(latitude=55.75, longitude=37.61 + len(address) / 1000)
+
+
+class SlowRouter:
+    """Road graph stand-in whose every route takes `delay` seconds and is `length` km long"""
+
+    def __init__(self, delay=DELAY, length=99.0):
+        self.delay = delay
+        self.length = length
+
+    def route(self, source, target):
+        time.sleep(self.delay)
+        return self.length, [source, target]
+
+    def stats(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def geocoder():
+    return BlockingGeocoder()
+
+
+@pytest.fixture
+def make_service(geocoder, tmp_path):
+    def make(concurrency=2, timeout=DELAY * 10, prefetch_ttl=60):
+        # Only the memory tier of the cache is used, as it is never opened
+        cache = GeocodeCache(db_name=str(tmp_path / "geocode_cache.db"))
+        return GeoService(
+            geocoder=geocoder, concurrency=concurrency, timeout=timeout, cache=cache, prefetch_ttl=prefetch_ttl
+        )
+    return make
+
+
+async def test_quote_does_not_block_other_handlers(make_service, geocoder):
+    geo_service = make_service()
+    started = time.perf_counter()
+    quote = asyncio.create_task(geo_service.calculate_distance("Tverskaya 1", "Arbat 10"))
+
+    async def handler():
+        # A few awaits, like answering another user's message
+        for _ in range(5):
+            await asyncio.sleep(0.01)
+        return time.perf_counter() - started
+
+    handled_in = await handler()
+    assert handled_in < DELAY / 4
+    assert not quote.done()
+
+    assert await quote is not None
+    assert time.perf_counter() - started >= DELAY
+    assert geocoder.calls == 2
+    await geo_service.close()
+
+
+async def test_route_returns_its_coordinates(make_service, geocoder):
+    geocoder.delay = 0
+    geo_service = make_service()
+
+    distance, from_coords, to_coords = await geo_service.calculate_route("Tverskaya 1", "Arbat 10")
+
+    assert distance is not None
+    assert from_coords == (55.75, 37.61 + len("Tverskaya 1") / 1000)
+    assert to_coords == (55.75, 37.61 + len("Arbat 10") / 1000)
+    assert geocoder.calls == 2
+    await geo_service.close()
+
+
+async def test_route_within_deadline(make_service, geocoder):
+    geocoder.delay = 0
+    geo_service = make_service()
+    geo_service.router = SlowRouter(delay=0)
+
+    distance, _, _ = await geo_service.calculate_route("Tverskaya 1", "Arbat 10")
+
+    assert distance == 99.0
+    await geo_service.close()
+
+
+async def test_slow_route_falls_back_to_straight_line(make_service, geocoder):
+    geocoder.delay = 0
+    geo_service = make_service()
+    geo_service.router = SlowRouter()
+    started = time.perf_counter()
+
+    distance, from_coords, to_coords = await geo_service.calculate_route("Tverskaya 1", "Arbat 10", timeout=DELAY / 5)
+
+    assert time.perf_counter() - started < DELAY / 2
+    assert distance == round(geodesic(from_coords, to_coords).kilometers, 2)
+    assert geo_service.stats()['routing']['timeouts'] == 1
+    await geo_service.close()
+
+
+async def test_prefetch_is_dropped_once_used(make_service, geocoder):
+    geocoder.delay = 0
+    geo_service = make_service()
+    geo_service.prefetch(1, 'from', "Tverskaya 1")
+    geo_service.prefetch(1, 'to', "Arbat 10")
+    assert geo_service.stats()['prefetches'] == 2
+
+    distance, _, _ = await geo_service.calculate_route("Tverskaya 1", "Arbat 10", user_id=1)
+
+    assert distance is not None
+    assert geocoder.calls == 2
+    assert geo_service.stats()['prefetches'] == 0
+    await geo_service.close()
+
+
+async def test_unused_prefetch_expires(make_service, geocoder):
+    geocoder.delay = 0
+    geo_service = make_service(prefetch_ttl=DELAY / 10)
+    # The user types an address and walks away
+    geo_service.prefetch(1, 'from', "Tverskaya 1")
+    await asyncio.sleep(DELAY / 20)
+    assert geo_service.stats()['prefetches'] == 1
+
+    await asyncio.sleep(DELAY / 5)
+    assert geo_service.stats()['prefetches'] == 0
+    await geo_service.close()
+
+
+async def test_concurrency_limit(make_service, geocoder):
+    geocoder.delay = DELAY / 5
+    geo_service = make_service(concurrency=2)
+
+    results = await asyncio.gather(*(geo_service.get_coordinates(f"Street {i}") for i in range(6)))
+
+    assert all(coords is not None for coords in results)
+    assert geocoder.calls == 6
+    assert geocoder.max_active == 2
+    await geo_service.close()
+
+
+async def test_timed_out_request_holds_its_slot(make_service, geocoder):
+    geocoder.delay = DELAY / 20
+    geocoder.delays["Slow street 1"] = DELAY / 2
+    geo_service = make_service(concurrency=1, timeout=DELAY / 5)
+
+    assert await geo_service.get_coordinates("Slow street 1") is None
+    # The geocoder thread is still blocked, so the next request waits for it
+    # before its own timeout starts, instead of timing out queued behind it
+    assert geocoder.active == 1
+    assert await geo_service.get_coordinates("Tverskaya 1") is not None
+    assert geocoder.calls == 2
+    assert geocoder.max_active == 1
+    await geo_service.close()
+
+
+async def test_cancel_user_requests(make_service, geocoder):
+    geo_service = make_service()
+    route = ("Tverskaya 1", "Arbat 10")
+    leaving = asyncio.create_task(geo_service.run_for_user(1, geo_service.calculate_distance(*route)))
+    staying = asyncio.create_task(geo_service.run_for_user(2, geo_service.calculate_distance(*route)))
+    await asyncio.sleep(0.05)
+
+    started = time.perf_counter()
+    geo_service.cancel_user_requests(1)
+    with pytest.raises(RequestAbandoned):
+        await leaving
+    assert time.perf_counter() - started < DELAY / 4
+
+    # The lookups are shared, so the other user's quote carries on
+    assert await staying is not None
+    assert geocoder.calls == 2
+    assert geo_service.stats()['inflight'] == 0
+    await geo_service.close()
+
+
+async def test_abandoned_lookup_is_cancelled(make_service, geocoder):
+    geo_service = make_service(concurrency=1)
+    quote = asyncio.create_task(geo_service.run_for_user(1, geo_service.calculate_distance("Tverskaya 1", "Arbat 10")))
+    await asyncio.sleep(0.05)
+
+    geo_service.cancel_user_requests(1)
+    with pytest.raises(RequestAbandoned):
+        await quote
+
+    # The second address was still queued behind the semaphore and never reaches the geocoder
+    assert geo_service.stats()['inflight'] == 0
+    await asyncio.sleep(DELAY * 1.2)
+    assert geocoder.calls == 1
+    await geo_service.close()
@@ -0,0 +1,44 @@
+"""
+Geocode cache lifetimes across its memory and SQLite tiers
+"""
+import asyncio
+import time
+
+from geocache import GeocodeCache
+
+KEY = "тверская 1"
+COORDS = (55.75, 37.61)
+
+
+async def test_disk_hit_keeps_the_row_lifetime(tmp_path):
+    cache = GeocodeCache(db_name=str(tmp_path / "geocode_cache.db"), ttl=100)
+    await cache.open()
+    try:
+        await cache.set(KEY, COORDS)
+        # Geocoded almost a full TTL ago, as if the bot had been restarted since
+        await cache._conn.execute("UPDATE geocode_cache SET created_at = ?", (time.time() - 99.8,))
+        cache.memory.clear()
+
+        assert await cache.get(KEY) == COORDS
+        assert cache.disk_hits == 1
+
+        await asyncio.sleep(0.3)
+        # Expired in memory together with the row, not a full TTL after the disk hit
+        assert await cache.get(KEY) is None
+    finally:
+        await cache.close()
+
+
+async def test_fresh_entry_is_served_from_memory(tmp_path):
+    cache = GeocodeCache(db_name=str(tmp_path / "geocode_cache.db"), ttl=100)
+    await cache.open()
+    try:
+        await cache.set(KEY, COORDS)
+        cache.memory.clear()
+
+        assert await cache.get(KEY) == COORDS
+        assert await cache.get(KEY) == COORDS
+        assert cache.disk_hits == 1
+        assert cache.memory.hits == 1
+    finally:
+        await cache.close()
@@ -0,0 +1,58 @@
+"""
+Pending order book against a plain sorted reference
+"""
+import random
+
+from orderbook import PendingOrderBook
+
+PASSENGER = {'full_name': "Passenger", 'phone': "+79000000001", 'rating': 5.0}
+
+
+def make_order(order_id, created_at, ride_class='economy', pickup=(None, None)):
+    return {
+        'order_id': order_id, 'created_at': created_at, 'passenger_id': order_id % 7, 'from_address': "A",
+        'to_address': "B", 'ride_class': ride_class, 'distance': 5.0, 'estimated_cost': 400,
+        'pickup_latitude': pickup[0], 'pickup_longitude': pickup[1]
+    }
+
+
+def test_random_adds_and_removes_keep_creation_order():
+    rng = random.Random(1)
+    book = PendingOrderBook()
+    reference = {}  # order_id -> order
+    for order_id in range(3000):
+        # Mostly in time order, with some late and duplicate timestamps
+        created_at = f"2024-01-01 {rng.randint(0, order_id // 100):05d}"
+        order = make_order(order_id, created_at, rng.choice(['economy', 'comfort']))
+        book.add(order, PASSENGER)
+        reference[order_id] = order
+        if reference and rng.random() < 0.4:
+            removed = rng.choice(list(reference))
+            assert book.remove(removed).order_id == removed
+            del reference[removed]
+        assert book.remove(-1) is None
+
+    def expected(ride_class=None):
+        orders = [order for order in reference.values() if ride_class in (None, order['ride_class'])]
+        return [order['order_id'] for order in sorted(orders, key=lambda order: (order['created_at'], order['order_id']))]
+
+    assert len(book) == len(reference)
+    assert [record.order_id for record in book.orders()] == expected()
+    for ride_class in ('economy', 'comfort'):
+        assert [record.order_id for record in book.orders(ride_class)] == expected(ride_class)
+    assert sum(book.stats()['classes'].values()) == len(reference)
+
+    for order_id in list(reference):
+        book.remove(order_id)
+    assert book.orders() == [] and book.stats()['passengers'] == 0
+
+
+def test_filter_by_distance():
+    book = PendingOrderBook()
+    book.add(make_order(1, "2024-01-01 10:00", pickup=(55.75, 37.61)), PASSENGER)
+    book.add(make_order(2, "2024-01-01 10:01", pickup=(55.95, 37.61)), PASSENGER)
+    book.add(make_order(3, "2024-01-01 10:02"), PASSENGER)
+
+    # Orders without a pickup match any position
+    assert [record.order_id for record in book.orders(near=(55.76, 37.61), radius_km=5)] == [1, 3]
+    assert [record.order_id for record in book.orders(near=(55.76, 37.61), radius_km=50)] == [1, 2, 3]
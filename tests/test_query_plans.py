@@ -0,0 +1,70 @@
+"""
+Query plans of every Database statement
+
+Runs each Database method against a migrated database under
+capture_queries() and checks that no statement scans a whole table or
+sorts in a temporary b-tree.
+"""
+from db import Database
+from storage import StorageEngine
+
+PASSENGER = 1
+DRIVER = 10
+
+
+async def test_no_slow_query_plans(database_path):
+    db = Database(database_path)
+    await db.init()
+    called = set()
+
+    async def call(name, *args, **kwargs):
+        called.add(name)
+        return await getattr(db, name)(*args, **kwargs)
+
+    try:
+        async with db.capture_queries() as statements:
+            # Startup loaders read whole tables into memory by design and aren't checked
+            await call('register_user', PASSENGER, 'passenger', "Passenger", "+79000000001")
+            await call('register_user', DRIVER, 'driver', "Driver", "+79000000002")
+            await call('register_driver', DRIVER, "Lada Vesta", "A001AA77")
+            await call('get_user', PASSENGER)
+            await call('get_driver', DRIVER)
+            await call('get_available_drivers')
+            await call('update_driver_status', DRIVER, 'offline')
+            await call('update_driver_status', DRIVER, 'available')
+            await call('update_driver_locations', [(DRIVER, 55.75, 37.61)])
+            await call('update_user_rating', PASSENGER, 4.5)
+
+            order_id = await call('create_order', PASSENGER, "A", "B", 'economy', 5.0, 400, pickup=(55.75, 37.61))
+            await call('get_order', order_id)
+            await call('get_open_orders')
+            await call('record_decline', order_id, DRIVER)
+            await call('accept_order', order_id, DRIVER)
+            await call('get_active_order', PASSENGER, 'passenger')
+            await call('get_active_order', DRIVER, 'driver')
+            await call('transition_order', order_id, DRIVER, 'accepted', 'driver_arrived')
+            await call('transition_order', order_id, DRIVER, 'driver_arrived', 'in_progress')
+            await call('transition_order', order_id, DRIVER, 'in_progress', 'completed')
+            cancelled = await call('create_order', PASSENGER, "A", "B", 'comfort', 3.0, 300)
+            await call('transition_order', cancelled, PASSENGER, 'pending', 'cancelled')
+
+            for role, user_id in (('passenger', PASSENGER), ('driver', DRIVER)):
+                page = await call('get_order_history', user_id, role, limit=1)
+                cursor = (page[0]['created_at'], page[0]['order_id'])
+                await call('get_order_history', user_id, role, limit=1, before=cursor)
+                await call('get_order_history', user_id, role, limit=1, after=cursor)
+                await call('get_completed_orders_count', user_id, role)
+
+            await call('add_rating', order_id, PASSENGER, DRIVER, 5)
+            await call('add_rating', order_id, DRIVER, PASSENGER, 4, comment="Ok")
+            for period in ('today', 'week', 'month', None):
+                await call('get_driver_earnings', DRIVER, period)
+            await call('backfill_earnings')
+
+        assert statements
+        assert await db.find_slow_plans(statements) == []
+    finally:
+        await db.close()
+
+    # A new storage method has to be added above
+    assert StorageEngine.__abstractmethods__ - {'init', 'close'} <= called
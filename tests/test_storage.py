@@ -0,0 +1,369 @@
+"""
+StorageEngine contract, run against every engine
+
+Each test runs once on Database (a temporary SQLite file) and once on
+MemoryDatabase, so both engines are held to the same behaviour.
+"""
+import asyncio
+import datetime
+
+import pytest
+
+from db import Database
+from storage import ORDER_TRANSITIONS, earnings_period_start
+
+PASSENGER = 1
+DRIVER = 10
+OTHER_DRIVER = 11
+STRANGER = 99
+
+STATUSES = ('pending', 'accepted', 'driver_started', 'driver_arrived', 'in_progress', 'completed', 'cancelled')
+ALLOWED = [(source, target) for source, targets in ORDER_TRANSITIONS.items() for target in targets]
+REJECTED = [
+    (source, target) for source in STATUSES for target in STATUSES
+    if target not in ORDER_TRANSITIONS.get(source, ())
+]
+
+# Shortest way to bring a pending order into each status, as (from, to) steps
+PATHS = {
+    'pending': [],
+    'accepted': [('pending', 'accepted')],
+    'driver_started': [('pending', 'accepted'), ('accepted', 'driver_started')],
+    'driver_arrived': [('pending', 'accepted'), ('accepted', 'driver_arrived')],
+    'in_progress': [('pending', 'accepted'), ('accepted', 'driver_arrived'), ('driver_arrived', 'in_progress')],
+    'completed': [('pending', 'accepted'), ('accepted', 'driver_arrived'), ('driver_arrived', 'completed')],
+    'cancelled': [('pending', 'cancelled')],
+}
+
+
+async def register(db):
+    await db.register_user(PASSENGER, 'passenger', "Passenger", "+79000000001")
+    for driver_id in (DRIVER, OTHER_DRIVER):
+        await db.register_user(driver_id, 'driver', f"Driver {driver_id}", "+79000000002")
+        await db.register_driver(driver_id, "Lada Vesta", f"A{driver_id}AA77")
+
+
+async def new_order(db, passenger_id=PASSENGER, cost=400):
+    return await db.create_order(passenger_id, "Тверская 1", "Арбат 2", 'economy', 5.0, cost, pickup=(55.75, 37.61))
+
+
+async def order_in(db, status, driver_id=DRIVER):
+    """Create an order and walk it into `status`"""
+    order_id = await new_order(db)
+    for source, target in PATHS[status]:
+        if target == 'accepted':
+            assert await db.accept_order(order_id, driver_id)
+        else:
+            assert await db.transition_order(order_id, None, source, target)
+    return order_id
+
+
+async def complete_ride(db, driver_id=DRIVER, cost=400):
+    order_id = await order_in(db, 'driver_arrived', driver_id)
+    assert await db.transition_order(order_id, driver_id, 'driver_arrived', 'completed', actual_cost=cost)
+    return order_id
+
+
+def test_statuses_cover_the_lifecycle():
+    assert set(ORDER_TRANSITIONS) | {'completed', 'cancelled'} == set(STATUSES)
+    assert set(PATHS) == set(STATUSES)
+
+
+# Users and drivers
+async def test_register_and_get_user(open_storage):
+    async with open_storage() as db:
+        assert await db.get_user(PASSENGER) is None
+        await register(db)
+
+        user = await db.get_user(PASSENGER)
+        assert (user['user_id'], user['role'], user['full_name'], user['phone']) == (
+            PASSENGER, 'passenger', "Passenger", "+79000000001"
+        )
+        assert user['rating'] == 5.0
+        assert user['rating_count'] == 0
+
+        # Registering again replaces the profile
+        await db.register_user(PASSENGER, 'passenger', "Renamed", "+79000000009")
+        user = await db.get_user(PASSENGER)
+        assert (user['full_name'], user['phone']) == ("Renamed", "+79000000009")
+
+
+async def test_register_and_get_driver(open_storage):
+    async with open_storage() as db:
+        assert await db.get_driver(DRIVER) is None
+        await register(db)
+
+        driver = await db.get_driver(DRIVER)
+        assert (driver['user_id'], driver['car_model'], driver['car_number']) == (DRIVER, "Lada Vesta", "A10AA77")
+        assert driver['status'] == 'available'
+        assert driver['total_earnings'] == 0
+        assert driver['latitude'] is None
+
+        available = await db.get_available_drivers()
+        assert sorted(driver['user_id'] for driver in available) == [DRIVER, OTHER_DRIVER]
+        assert {driver['full_name'] for driver in available} == {"Driver 10", "Driver 11"}
+
+
+async def test_is_driver(open_storage):
+    async with open_storage() as db:
+        assert not db.is_driver(DRIVER)
+        await register(db)
+        await db.update_driver_status(OTHER_DRIVER, 'offline')
+
+        assert db.is_driver(DRIVER) and db.is_driver(OTHER_DRIVER)
+        assert not db.is_driver(PASSENGER)
+
+
+async def test_is_driver_after_restart(database_path):
+    db = Database(database_path)
+    await db.init()
+    await register(db)
+    await db.update_driver_status(OTHER_DRIVER, 'offline')
+    await db.close()
+
+    # The driver index is rebuilt from the drivers table
+    db = Database(database_path)
+    await db.init()
+    try:
+        assert db.is_driver(DRIVER) and db.is_driver(OTHER_DRIVER)
+        assert not db.is_driver(PASSENGER)
+    finally:
+        await db.close()
+
+
+async def test_driver_status_and_location(open_storage):
+    async with open_storage() as db:
+        await register(db)
+        await db.update_driver_location(DRIVER, 55.75, 37.61)
+        await db.update_driver_location(OTHER_DRIVER, 55.76, 37.62)
+
+        driver = await db.get_driver(DRIVER)
+        assert (driver['latitude'], driver['longitude']) == (55.75, 37.61)
+        assert [driver_id for driver_id, _ in db.find_nearest_drivers(55.75, 37.61)] == [DRIVER, OTHER_DRIVER]
+
+        await db.update_driver_status(DRIVER, 'offline')
+        assert (await db.get_driver(DRIVER))['status'] == 'offline'
+        assert [driver['user_id'] for driver in await db.get_available_drivers()] == [OTHER_DRIVER]
+        assert [driver_id for driver_id, _ in db.find_nearest_drivers(55.75, 37.61)] == [OTHER_DRIVER]
+
+
+# Orders
+async def test_create_order(open_storage):
+    async with open_storage() as db:
+        await register(db)
+        order_id = await new_order(db)
+
+        order = await db.get_order(order_id)
+        assert order['passenger_id'] == PASSENGER
+        assert order['driver_id'] is None
+        assert order['status'] == 'pending'
+        assert (order['from_address'], order['to_address'], order['ride_class']) == ("Тверская 1", "Арбат 2", 'economy')
+        assert (order['distance'], order['estimated_cost']) == (5.0, 400)
+        assert (order['pickup_latitude'], order['pickup_longitude']) == (55.75, 37.61)
+        assert order['created_at'] and order['status_changed_at']
+
+        assert (await db.get_active_order(PASSENGER))['order_id'] == order_id
+        assert [order['order_id'] for order in await db.get_pending_orders()] == [order_id]
+        assert [order['order_id'] for order in await db.get_open_orders()] == [order_id]
+        assert await db.get_order(order_id + 1000) is None
+
+
+async def test_accept_order_is_compare_and_swap(open_storage):
+    async with open_storage() as db:
+        await register(db)
+        order_id = await new_order(db)
+
+        results = await asyncio.gather(db.accept_order(order_id, DRIVER), db.accept_order(order_id, OTHER_DRIVER))
+        winners = [result for result in results if result is not None]
+        assert len(winners) == 1
+        winner = winners[0]['driver_id']
+        loser = OTHER_DRIVER if winner == DRIVER else DRIVER
+
+        order = await db.get_order(order_id)
+        assert (order['status'], order['driver_id']) == ('accepted', winner)
+        assert (await db.get_driver(winner))['status'] == 'busy'
+        assert (await db.get_driver(loser))['status'] == 'available'
+        assert (await db.get_active_order(winner, 'driver'))['order_id'] == order_id
+        assert await db.get_pending_orders() == []
+
+        # Accepted, cancelled or unknown orders can't be taken
+        assert await db.accept_order(order_id, loser) is None
+        cancelled = await order_in(db, 'cancelled')
+        assert await db.accept_order(cancelled, loser) is None
+        assert await db.accept_order(cancelled + 1000, loser) is None
+
+
+@pytest.mark.parametrize('source, target', ALLOWED)
+async def test_allowed_transition(open_storage, source, target):
+    async with open_storage() as db:
+        await register(db)
+        order_id = await order_in(db, source)
+
+        if target == 'accepted':
+            order = await db.accept_order(order_id, DRIVER)
+        else:
+            order = await db.transition_order(order_id, None, source, target)
+        assert order['status'] == target
+        assert (await db.get_order(order_id))['status'] == target
+
+        if target == 'in_progress':
+            assert order['started_at']
+        if target == 'completed':
+            assert order['completed_at']
+            assert order['actual_cost'] == order['estimated_cost']
+        if target in ('completed', 'cancelled'):
+            assert await db.get_active_order(PASSENGER) is None
+            assert (await db.get_driver(DRIVER))['status'] == 'available'
+
+
+@pytest.mark.parametrize('source, target', REJECTED)
+async def test_rejected_transition(open_storage, source, target):
+    async with open_storage() as db:
+        await register(db)
+        order_id = await order_in(db, source)
+
+        with pytest.raises(ValueError):
+            await db.transition_order(order_id, None, source, target)
+        assert (await db.get_order(order_id))['status'] == source
+
+
+async def test_transition_checks_current_status_and_actor(open_storage):
+    async with open_storage() as db:
+        await register(db)
+        order_id = await order_in(db, 'accepted')
+
+        # The order isn't in the expected status
+        assert await db.transition_order(order_id, None, 'driver_started', 'driver_arrived') is None
+        # Only the order's passenger or driver may act on it
+        assert await db.transition_order(order_id, STRANGER, 'accepted', 'driver_started') is None
+        assert await db.transition_order(order_id, OTHER_DRIVER, 'accepted', 'cancelled') is None
+        assert (await db.get_order(order_id))['status'] == 'accepted'
+
+        assert await db.transition_order(order_id, DRIVER, 'accepted', 'driver_started')
+        assert await db.transition_order(order_id, PASSENGER, ('accepted', 'driver_started'), 'cancelled')
+        assert (await db.get_order(order_id))['status'] == 'cancelled'
+
+
+async def test_cancellation_releases_driver(open_storage):
+    async with open_storage() as db:
+        await register(db)
+        await db.update_driver_location(DRIVER, 55.75, 37.61)
+
+        order_id = await order_in(db, 'accepted')
+        assert (await db.get_driver(DRIVER))['status'] == 'busy'
+        assert await db.transition_order(order_id, PASSENGER, 'accepted', 'cancelled')
+        assert (await db.get_driver(DRIVER))['status'] == 'available'
+        assert DRIVER in [driver_id for driver_id, _ in db.find_nearest_drivers(55.75, 37.61)]
+
+        # A system cancellation can keep the driver out of the pool
+        order_id = await order_in(db, 'driver_started')
+        assert await db.transition_order(order_id, None, 'driver_started', 'cancelled', driver_status='busy')
+        assert (await db.get_driver(DRIVER))['status'] == 'busy'
+        assert DRIVER not in [driver_id for driver_id, _ in db.find_nearest_drivers(55.75, 37.61)]
+
+
+# History
+async def test_order_history_keyset_pages(open_storage):
+    async with open_storage() as db:
+        await register(db)
+        order_ids = [await new_order(db) for _ in range(7)]
+        newest_first = order_ids[::-1]
+
+        def ids(page):
+            return [order['order_id'] for order in page]
+
+        def cursor(order):
+            return order['created_at'], order['order_id']
+
+        # Walking older
+        pages, before = [], None
+        while True:
+            page = await db.get_order_history(PASSENGER, limit=3, before=before)
+            if not page:
+                break
+            pages.append(ids(page))
+            before = cursor(page[-1])
+        assert pages == [newest_first[0:3], newest_first[3:6], newest_first[6:7]]
+
+        # Walking newer from the oldest page, pages stay newest first
+        fourth = (await db.get_order_history(PASSENGER, limit=4))[-1]
+        oldest = await db.get_order_history(PASSENGER, limit=3, before=cursor(fourth))
+        assert ids(oldest) == newest_first[4:7]
+        newer = await db.get_order_history(PASSENGER, limit=3, after=cursor(oldest[0]))
+        assert ids(newer) == newest_first[1:4]
+        newest = await db.get_order_history(PASSENGER, limit=3, after=cursor(newer[0]))
+        assert ids(newest) == newest_first[0:1]
+        assert await db.get_order_history(PASSENGER, limit=3, after=cursor(newest[0])) == []
+
+        # Drivers see the orders they took
+        assert await db.get_order_history(DRIVER, 'driver') == []
+        await db.accept_order(order_ids[2], DRIVER)
+        assert ids(await db.get_order_history(DRIVER, 'driver')) == [order_ids[2]]
+
+        streamed = [order['order_id'] async for order in db.iter_order_history(PASSENGER, batch_size=2)]
+        assert streamed == newest_first
+
+
+# Ratings
+async def test_add_rating_aggregates(open_storage):
+    async with open_storage() as db:
+        await register(db)
+        rides = [await complete_ride(db) for _ in range(3)]
+
+        for order_id, rating in zip(rides, (5, 3, 4)):
+            await db.add_rating(order_id, PASSENGER, DRIVER, rating)
+        await db.add_rating(rides[0], DRIVER, PASSENGER, 2, comment="Late")
+
+        driver = await db.get_user(DRIVER)
+        assert driver['rating'] == pytest.approx(4.0)
+        assert driver['rating_count'] == 3
+        assert driver['rating_sum'] == pytest.approx(12)
+        assert driver['rating_decay_weight'] > 0
+
+        passenger = await db.get_user(PASSENGER)
+        assert passenger['rating'] == pytest.approx(2.0)
+        assert passenger['rating_count'] == 1
+
+        order = await db.get_order(rides[0])
+        assert (order['driver_rating'], order['passenger_rating']) == (5, 2)
+        assert (await db.get_order(rides[1]))['driver_rating'] == 3
+
+
+# Earnings
+async def test_driver_earnings_per_period(open_storage, monkeypatch):
+    async with open_storage() as db:
+        await register(db)
+
+        # Rides finished over the last year, completion times come from the clock
+        rides = []
+        for days_ago, cost in ((0, 100), (2, 200), (10, 400), (40, 800), (400, 1600)):
+            moment = datetime.datetime.now() - datetime.timedelta(days=days_ago)
+
+            class Clock(datetime.datetime):
+                @classmethod
+                def now(cls, tz=None):
+                    return moment if tz is None else moment.astimezone(tz)
+
+            with monkeypatch.context() as patch:
+                patch.setattr(datetime, 'datetime', Clock)
+                await complete_ride(db, cost=cost)
+            rides.append((moment.date().isoformat(), cost))
+
+        # Neither unfinished rides nor other drivers count
+        await order_in(db, 'driver_arrived')
+        await complete_ride(db, OTHER_DRIVER, cost=50)
+
+        for period in ('today', 'week', 'month', None):
+            start = earnings_period_start(period)
+            expected = sum(cost for day, cost in rides if start is None or day >= start)
+            assert await db.get_driver_earnings(DRIVER, period) == pytest.approx(expected)
+        assert await db.get_driver_earnings(DRIVER, 'today') == pytest.approx(100)
+        assert await db.get_driver_earnings(STRANGER) == 0
+        assert (await db.get_driver(DRIVER))['total_earnings'] == pytest.approx(3100)
+        assert await db.get_completed_orders_count(DRIVER) == 5
+        assert await db.get_completed_orders_count(PASSENGER, 'passenger') == 6
+
+        # The rollups can be rebuilt from the completed orders
+        await db.backfill_earnings()
+        assert await db.get_driver_earnings(DRIVER) == pytest.approx(3100)
+        assert await db.get_driver_earnings(DRIVER, 'month') == pytest.approx(700)
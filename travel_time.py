@@ -0,0 +1,106 @@
+import datetime
+
+from config import TRAVEL_SPEED_PRIOR_KMH, TRAVEL_SPEED_PRIOR_KM
+
+# Rides outside these bounds are mistaps or forgotten "complete" buttons
+MIN_RIDE_HOURS = 1 / 60
+MAX_RIDE_HOURS = 4
+MIN_RIDE_SPEED = 3
+MAX_RIDE_SPEED = 130
+
+# Zone of statistics that cover the whole city
+CITY = ''
+
+
+def hour_of_week(when):
+    """0 for Monday 00:00-00:59 local time, up to 167 for Sunday 23:00-23:59"""
+    return when.weekday() * 24 + when.hour
+
+
+def ride_sample(order, zone=CITY):
+    """
+    Speed sample of a completed order as (hour_of_week, zone, distance_km, hours)
+
+    Returns None when the order has no ride duration (it was completed
+    without being started) or the numbers are implausible.
+    """
+    if not order['started_at'] or not order['completed_at'] or not order['distance']:
+        return None
+
+    started = datetime.datetime.fromisoformat(order['started_at'])
+    completed = datetime.datetime.fromisoformat(order['completed_at'])
+    hours = (completed - started).total_seconds() / 3600
+    if not MIN_RIDE_HOURS <= hours <= MAX_RIDE_HOURS:
+        return None
+    if not MIN_RIDE_SPEED <= order['distance'] / hours <= MAX_RIDE_SPEED:
+        return None
+
+    return (hour_of_week(started), zone, order['distance'], hours)
+
+
+def sample_keys(hour, zone):
+    """Statistics rows a sample contributes to: its zone's and the whole city's"""
+    return [(hour, zone), (hour, CITY)] if zone != CITY else [(hour, CITY)]
+
+
+class SpeedModel:
+    """
+    Average ride speed per hour of the week, optionally per zone
+
+    Each bucket keeps running totals of distance and time, so adding a ride
+    and answering a query are both O(1). Sparse buckets are shrunk towards
+    their parent (zone -> city hour -> TRAVEL_SPEED_PRIOR_KMH) as if the
+    parent had contributed `prior_km` of driving.
+    """
+
+    def __init__(self, prior_kmh=TRAVEL_SPEED_PRIOR_KMH, prior_km=TRAVEL_SPEED_PRIOR_KM):
+        self.prior_kmh = prior_kmh
+        self.prior_km = prior_km
+        self._buckets = {}  # (hour_of_week, zone) -> [distance_km, hours, rides]
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def clear(self):
+        self._buckets.clear()
+
+    def load(self, hour, zone, distance, hours, rides):
+        """Set one bucket from stored totals"""
+        self._buckets[(hour, zone)] = [distance, hours, rides]
+
+    def add(self, hour, zone, distance, hours):
+        """Add one ride, as returned by ride_sample()"""
+        for key in sample_keys(hour, zone):
+            bucket = self._buckets.setdefault(key, [0.0, 0.0, 0])
+            bucket[0] += distance
+            bucket[1] += hours
+            bucket[2] += 1
+
+    def _blend(self, key, prior_kmh):
+        bucket = self._buckets.get(key)
+        if not bucket:
+            return prior_kmh
+        return (bucket[0] + self.prior_km) / (bucket[1] + self.prior_km / prior_kmh)
+
+    def speed(self, when=None, zone=CITY):
+        """Expected speed in km/h for a ride starting at `when` (local time, default now)"""
+        hour = hour_of_week(when or datetime.datetime.now())
+        speed = self._blend((hour, CITY), self.prior_kmh)
+        if zone != CITY:
+            speed = self._blend((hour, zone), speed)
+        return speed
+
+    def estimate_minutes(self, distance, when=None, zone=CITY):
+        """Expected duration in minutes of a ride of `distance` km"""
+        return distance / self.speed(when, zone) * 60
+
+    def stats(self):
+        """Rides and mean speed over the whole city"""
+        city = [bucket for (_, zone), bucket in self._buckets.items() if zone == CITY]
+        distance = sum(bucket[0] for bucket in city)
+        hours = sum(bucket[1] for bucket in city)
+        return {
+            'buckets': len(self._buckets),
+            'rides': sum(bucket[2] for bucket in city),
+            'mean_speed': distance / hours if hours else None
+        }